@@ -0,0 +1,408 @@
+"""
+Offline benchmarks of the scraping, parsing and ingest hot paths, using the
+fixtures in tests/ as inputs and a mock OpenAI server instead of the API.
+
+    python benchmarks/bench.py                      # compare with baseline.json
+    python benchmarks/bench.py --save-baseline      # store the results as baseline
+    python benchmarks/bench.py --database-ini database.ini
+
+With --database-ini the ingest and parse_schema benchmarks run against the
+[postgresql] server of that file (e.g. the docker-compose database), inside a
+fundai_benchmark schema that is dropped afterwards.
+
+With --page-url the listed pages are loaded in Chromium with every load profile,
+reporting the bytes and seconds each profile saves per page compared with a
+full page load. These numbers depend on the network and are not compared with
+the baseline.
+
+Timings depend on the machine, so every run also measures a reference step of
+standard library code that fundai does not change. A benchmark regresses when its
+time relative to the reference step of the same run grew by more than tolerance
+compared with the baseline, which makes a baseline saved on one machine usable
+on a faster or slower one.
+"""
+
+import asyncio
+import html
+import json
+import logging
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, List, Optional
+
+import typer
+from typing_extensions import Annotated
+from openai import AsyncOpenAI
+
+from fundai.browser import BrowserPool, load_profiles
+from fundai.convert import TextConverter, html_to_text
+from fundai.db import DatabaseClient, init_search_urls, load_config
+from fundai.llm import AsyncExtractor
+from fundai.repair import repair_json
+from fundai.rules import extract_fields
+from fundai.scraper import (
+    aparse_schema,
+    get_links_from_page,
+    get_max_page,
+    parse_schema,
+    post_process_pages,
+)
+
+root = Path(__file__).resolve().parent.parent
+baseline_path = Path(__file__).resolve().parent / "baseline.json"
+app = typer.Typer()
+
+
+def fixture(name: str) -> str:
+    return (root / "tests" / name).read_text()
+
+
+search_page = fixture("raw_search_page.txt").replace("\\n", "\n")
+listing = fixture("raw_page_content.txt")
+structured = fixture("structured_page_content.txt")
+# a listing as stored in raw_page_content: the part post_process_pages keeps,
+# surrounded by the page chrome it cuts off
+full_listing = (
+    search_page[:4000]
+    + "\n"
+    + listing
+    + "\n#### Wat is jouw huis waard?\n"
+    + search_page[-4000:]
+)
+listing_html = "<html><body>{}</body></html>".format(
+    "".join(
+        f"<p>{html.escape(line)}</p>" if line.strip() else "<br>"
+        for line in full_listing.splitlines()
+    )
+)
+llm_output = f"```json\n{structured}\n```"
+reference = "reference"
+
+
+def reference_step():
+    """
+    Parse, serialize and sort the fixtures with the standard library only, the
+    yardstick of the speed of the machine the benchmarks run on
+    """
+    json.dumps(json.loads(structured), sort_keys=True)
+    sorted(listing.split())
+
+
+def measure(
+    fn: Callable[[], Any], units: int = 1, min_time: float = 0.2, repeat: int = 5
+) -> dict[str, float]:
+    """
+    Time fn like timeit: calibrate the number of calls to take at least min_time,
+    then keep the fastest of repeat rounds
+    :param units: items processed by one call, e.g. rows or pages
+    :return: seconds per unit and units per second of the fastest round
+    """
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        loops *= 2 if elapsed == 0 else max(2, min(10, int(min_time / elapsed) + 1))
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        best = min(best, time.perf_counter() - start)
+    per_unit = best / (loops * units)
+    return {"seconds_per_unit": per_unit, "units_per_second": 1 / per_unit}
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    """
+    Chat completion endpoint answering every request with the fixture schema
+    """
+
+    body = json.dumps(
+        {
+            "id": "chatcmpl-1",
+            "object": "chat.completion",
+            "created": 0,
+            "model": "gpt-3.5-turbo-1106",
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": llm_output},
+                }
+            ],
+            "usage": {
+                "prompt_tokens": 900,
+                "completion_tokens": 500,
+                "total_tokens": 1400,
+            },
+        }
+    ).encode()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MemoryDatabase:
+    """
+    Stand-in for DatabaseClient.insert_values, keeping the rows in memory
+    """
+
+    def __init__(self):
+        self.rows = []
+
+    def insert_values(self, values, table_name, column_names, **kwargs) -> int:
+        values = list(values)
+        self.rows.extend(values)
+        return len(values)
+
+
+def mock_client(base_url: str) -> AsyncOpenAI:
+    return AsyncOpenAI(base_url=base_url, api_key="benchmark", max_retries=0)
+
+
+def unlimited_extractor(base_url: str) -> AsyncExtractor:
+    return AsyncExtractor(
+        mock_client(base_url),
+        concurrency=8,
+        requests_per_minute=10**9,
+        tokens_per_minute=10**12,
+    )
+
+
+def offline_benchmarks(base_url: str, pages: int) -> dict[str, dict[str, float]]:
+    results = {
+        reference: measure(reference_step),
+        "get_links_from_page": measure(
+            lambda: get_links_from_page(search_page, "koop", "rotterdam")
+        ),
+        "get_max_page": measure(lambda: get_max_page(search_page)),
+        "post_process_pages": measure(
+            lambda: post_process_pages(full_listing, "https://www.funda.nl/")
+        ),
+        "extract_fields": measure(lambda: extract_fields(listing)),
+        "html_to_text": measure(lambda: html_to_text(listing_html)),
+        "json_repair": measure(lambda: repair_json(llm_output)),
+    }
+
+    with TextConverter() as converter:
+
+        async def convert_pages():
+            await asyncio.gather(
+                *[converter.convert(listing_html) for _ in range(pages)]
+            )
+
+        asyncio.run(convert_pages())  # start the worker processes
+        results["text_converter_pool"] = measure(
+            lambda: asyncio.run(convert_pages()), units=pages, repeat=3
+        )
+
+    rows = [
+        (f"https://www.funda.nl/koop/rotterdam/huis-{i}/", full_listing)
+        for i in range(pages)
+    ]
+
+    def extract_pages():
+        asyncio.run(
+            aparse_schema(
+                rows, MemoryDatabase(), unlimited_extractor(base_url), use_rules=False
+            )
+        )
+
+    results["aparse_schema_mock_llm"] = measure(extract_pages, units=pages, repeat=3)
+    return results
+
+
+def database_benchmarks(
+    config: dict[str, str], base_url: str, rows: int, pages: int
+) -> dict[str, dict[str, float]]:
+    with DatabaseClient(config) as admin:
+        admin.execute("DROP SCHEMA IF EXISTS fundai_benchmark CASCADE")
+        admin.execute("CREATE SCHEMA fundai_benchmark")
+    db = DatabaseClient(dict(config, options="-c search_path=fundai_benchmark"))
+    try:
+        init_search_urls(db)
+        urls = [f"https://www.funda.nl/koop/rotterdam/huis-{i}/" for i in range(rows)]
+        url_rows = [(None, url) for url in urls]
+        results = {}
+        for method in ("copy", "values"):
+
+            def insert():
+                db.execute("TRUNCATE search_page_urls CASCADE")
+                db.insert_values(
+                    url_rows, "search_page_urls", ["date", "url"], method=method
+                )
+
+            results[f"insert_values_{method}"] = measure(insert, units=rows, repeat=3)
+
+        def upsert():
+            db.insert_values(
+                url_rows, "search_page_urls", ["date", "url"], conflict_columns=["url"]
+            )
+
+        results["insert_values_upsert"] = measure(upsert, units=rows, repeat=3)
+
+        db.insert_values(
+            [(url, full_listing) for url in urls[:pages]],
+            "raw_page_content",
+            ["url", "page_content"],
+        )
+
+        def parse():
+            db.execute("DELETE FROM raw_property_listings")
+            parse_schema(
+                "koop",
+                "rotterdam",
+                db,
+                requests_per_minute=10**9,
+                tokens_per_minute=10**12,
+                client=mock_client(base_url),
+                use_cache=False,
+                use_rules=False,
+            )
+
+        results["parse_schema_mock_llm"] = measure(parse, units=pages, repeat=3)
+    finally:
+        db.close()
+        with DatabaseClient(config) as admin:
+            admin.execute("DROP SCHEMA IF EXISTS fundai_benchmark CASCADE")
+    return results
+
+
+def page_load_benchmarks(urls: list[str]) -> dict[str, dict[str, float]]:
+    """
+    Load urls one at a time with every load profile
+    :return: pages, bytes, seconds and blocked requests per page of every profile
+    """
+
+    async def load(profile: str) -> dict[str, float]:
+        async with BrowserPool(
+            concurrency=1, profile=profile, reference_every=0
+        ) as pool:
+            for url in urls:
+                await pool.fetch(url)
+            return pool.page_stats()
+
+    return {profile: asyncio.run(load(profile)) for profile in load_profiles}
+
+
+def print_page_loads(results: dict[str, dict[str, float]]):
+    full = results["full"]
+    print(
+        f"{'profile':<10}{'kB/page':>10}{'s/page':>10}{'blocked':>10}"
+        f"{'kB saved':>10}{'s saved':>10}"
+    )
+    for profile, result in results.items():
+        print(
+            f"{profile:<10}{result['bytes_per_page'] / 1e3:>10.1f}"
+            f"{result['seconds_per_page']:>10.2f}{result['blocked_per_page']:>10.1f}"
+            f"{(full['bytes_per_page'] - result['bytes_per_page']) / 1e3:>10.1f}"
+            f"{full['seconds_per_page'] - result['seconds_per_page']:>10.2f}"
+        )
+
+
+def compare(
+    results: dict[str, dict[str, float]],
+    baseline: dict[str, dict[str, float]],
+    tolerance: float,
+) -> list[str]:
+    """
+    Print the results next to the baseline. Ratios are corrected for the speed of
+    the machine with the reference step when both runs measured it.
+    :return: names of benchmarks more than tolerance slower than the baseline
+    """
+    speed = 1.0
+    if reference in results and reference in baseline:
+        speed = (
+            results[reference]["seconds_per_unit"]
+            / baseline[reference]["seconds_per_unit"]
+        )
+        print(f"Reference step takes {speed:.2f}x its baseline time on this machine")
+    else:
+        print("No reference step in the baseline, comparing absolute timings")
+    regressions = []
+    print(
+        f"{'benchmark':<26}{'per unit':>14}{'units/s':>14}{'baseline':>14}{'ratio':>8}"
+    )
+    for name, result in results.items():
+        line = (
+            f"{name:<26}{result['seconds_per_unit'] * 1e6:>12.1f}us"
+            f"{result['units_per_second']:>14.0f}"
+        )
+        if name in baseline and name != reference:
+            ratio = result["seconds_per_unit"] / baseline[name]["seconds_per_unit"]
+            ratio /= speed
+            line += f"{baseline[name]['seconds_per_unit'] * 1e6:>12.1f}us{ratio:>8.2f}"
+            if ratio > 1 + tolerance:
+                regressions.append(name)
+                line += "  REGRESSION"
+        print(line)
+    return regressions
+
+
+@app.command()
+def main(
+    database_ini: Annotated[
+        str, typer.Option(help="Also benchmark ingest and parse_schema on this server")
+    ] = "",
+    output: Annotated[str, typer.Option(help="Write the results as JSON here")] = "",
+    save_baseline: Annotated[
+        bool, typer.Option(help="Store the results in benchmarks/baseline.json")
+    ] = False,
+    tolerance: Annotated[
+        float,
+        typer.Option(
+            help="Slowdown relative to the baseline, corrected for the speed of the "
+            "machine, that fails the run",
+        ),
+    ] = 0.25,
+    rows: Annotated[int, typer.Option(help="Rows per ingest benchmark")] = 10_000,
+    pages: Annotated[int, typer.Option(help="Pages per pipeline benchmark")] = 50,
+    page_url: Annotated[
+        Optional[List[str]],
+        typer.Option(help="Measure the Chromium load profiles on this live page"),
+    ] = None,
+):
+    logging.basicConfig(level=logging.WARNING)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockOpenAIHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}/v1"
+    try:
+        results = offline_benchmarks(base_url, pages)
+        if database_ini:
+            results.update(
+                database_benchmarks(load_config(database_ini), base_url, rows, pages)
+            )
+    finally:
+        server.shutdown()
+
+    baseline = json.loads(baseline_path.read_text()) if baseline_path.exists() else {}
+    regressions = compare(results, baseline, tolerance)
+    if page_url:
+        print_page_loads(page_load_benchmarks(page_url))
+    if output:
+        Path(output).write_text(json.dumps(results, indent=2))
+    if save_baseline:
+        baseline_path.write_text(json.dumps({**baseline, **results}, indent=2) + "\n")
+        print(f"Saved baseline to {baseline_path}")
+    elif regressions:
+        print(f"Slower than the baseline: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    app()
@@ -1,3 +1,78 @@
-from fundai.scraper import *
-from fundai.db import *
-from fundai.utils import *
+"""
+The names of fundai.scraper, fundai.db and fundai.utils are available from the
+package itself, e.g. ``from fundai import DatabaseClient``. They are resolved on
+first access, so importing a light module such as fundai.main does not load
+langchain, openai and pandas. __all__ lists the names defined by these modules,
+for ``from fundai import *``, dir() and completion.
+"""
+
+import importlib
+
+# searched in this order, the former star imports let later modules win
+_reexported = ("fundai.utils", "fundai.db", "fundai.scraper")
+
+__all__ = [
+    # fundai.utils
+    "model_name",
+    "prompt_template",
+    # fundai.db
+    "load_config",
+    "copy_value",
+    "CopyRowStream",
+    "DatabaseClient",
+    "BatchWriter",
+    "init_search_urls",
+    "create_extraction_cache",
+    "token_usage_columns",
+    "create_token_usage",
+    "dead_letter_columns",
+    "create_dead_letter",
+    "page_compression_methods",
+    "compress_raw_pages",
+    "create_work_state",
+    "property_listing_columns",
+    "property_listing_indexed_columns",
+    "property_listing_indexed_expressions",
+    "create_property_listings",
+    "refresh_property_listings",
+    "create_listing_history",
+    "clean_raw_propert_listings",
+    # fundai.scraper
+    "AsyncChromiumLoaderHeader",
+    "post_process_pages",
+    "get_max_page",
+    "get_links_from_page",
+    "aprocess_page",
+    "process_page",
+    "astream_pages",
+    "ascrape_pages_to_db",
+    "scrape_pages_to_db",
+    "search_page_url",
+    "aiter_links",
+    "aget_all_links",
+    "get_all_links",
+    "obtain_schema_openai",
+    "push_schema",
+    "obtain_schema_and_push",
+    "aextract_schema",
+    "aobtain_schema_and_push",
+    "aparse_schema",
+    "pending_pages",
+    "claimed_pages",
+    "parse_schema",
+]
+
+
+def __getattr__(name: str):
+    if not name.startswith("_"):
+        for module_name in _reexported:
+            module = importlib.import_module(module_name)
+            if hasattr(module, name):
+                value = getattr(module, name)
+                globals()[name] = value
+                return value
+    raise AttributeError(f"module 'fundai' has no attribute {name!r}")
+
+
+def __dir__() -> list[str]:
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,283 @@
+import json
+import logging
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Iterable, Iterator
+
+from psycopg2.extras import Json
+
+from fundai.db import (
+    BatchWriter,
+    DatabaseClient,
+    create_dead_letter,
+    create_token_usage,
+    dead_letter_columns,
+    token_usage_columns,
+)
+from fundai.llm import ExtractionError, dead_letter_row
+from fundai.metrics import metrics
+from fundai.repair import coerce_schema, prompt_fields, repair_json
+from fundai.rules import build_prompt, extract_fields
+from fundai.scraper import post_process_pages
+from fundai.utils import model_name, prompt_template
+
+logger = logging.getLogger(__name__)
+
+# limits of a single OpenAI batch input file, bytes kept below the 200 MB upload limit
+max_batch_requests = 50_000
+max_batch_bytes = 190 * 2**20
+
+
+def batch_request(
+    url: str, page_content: str, prompt: str = prompt_template, model: str = model_name
+) -> dict[str, Any]:
+    """
+    Chat completion request of one page in the Batch API input format, identified
+    by its URL
+    """
+    return {
+        "custom_id": url,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": prompt},
+                {"role": "user", "content": page_content},
+            ],
+        },
+    }
+
+
+class ChunkedJsonlWriter:
+    """
+    Write JSON lines to numbered files, starting a new file before one would
+    exceed max_lines lines or max_bytes bytes
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        prefix: str = "requests",
+        max_lines: int = max_batch_requests,
+        max_bytes: int = max_batch_bytes,
+    ) -> None:
+        self.directory = directory
+        self.prefix = prefix
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.files: list[Path] = []
+        self.lines = 0
+        self._file = None
+        self._lines = self._bytes = 0
+
+    def write(self, record: dict[str, Any]):
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode()
+        if (
+            self._file is None
+            or self._lines >= self.max_lines
+            or self._bytes + len(line) > self.max_bytes
+        ):
+            self._rotate()
+        self._file.write(line)
+        self._lines += 1
+        self._bytes += len(line)
+        self.lines += 1
+
+    def _rotate(self):
+        self.close()
+        path = self.directory / f"{self.prefix}-{len(self.files) + 1:04d}.jsonl"
+        self._file = open(path, "wb")
+        self.files.append(path)
+        self._lines = self._bytes = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self) -> "ChunkedJsonlWriter":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def export_batch(
+    pages: Iterable[tuple[str, str]],
+    directory: str,
+    db: DatabaseClient,
+    use_rules: bool = True,
+    max_requests: int = max_batch_requests,
+    max_bytes: int = max_batch_bytes,
+    batch_size: int = 100,
+) -> list[Path]:
+    """
+    Write the pages as Batch API requests to directory/requests-<id>-0001.jsonl, ...
+    where id names this export, so exports to the same directory do not overwrite
+    each other. With use_rules, pages the rules resolve completely are inserted
+    into raw_property_listings right away, the others only ask for their
+    unresolved fields and the fields the rules did extract are kept in
+    directory/fields-<id>.jsonl for ingest_batch_output.
+    :param pages: (url, page_content) pairs, e.g. from fundai.scraper.pending_pages
+    :param max_requests: requests per file at most
+    :param max_bytes: bytes per file at most
+    :return: request files written
+    """
+    out = Path(directory)
+    out.mkdir(parents=True, exist_ok=True)
+    export_id = f"{datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:6]}"
+    n_rules = 0
+    with BatchWriter(
+        db,
+        "raw_property_listings",
+        ["url", "raw_data"],
+        batch_size=batch_size,
+        conflict_columns=["url"],
+    ) as writer, ChunkedJsonlWriter(
+        out, f"requests-{export_id}", max_requests, max_bytes
+    ) as requests, open(
+        out / f"fields-{export_id}.jsonl", "w"
+    ) as fields:
+        for url, page in pages:
+            split_p = post_process_pages(page, url)
+            if not use_rules:
+                requests.write(batch_request(url, split_p))
+                continue
+            extraction = extract_fields(split_p)
+            if not extraction.unresolved:
+                writer.add((url, Json(extraction.fields)))
+                n_rules += 1
+                continue
+            if extraction.fields:
+                record = {
+                    "custom_id": url,
+                    "fields": extraction.fields,
+                    "unresolved": extraction.unresolved,
+                }
+                fields.write(json.dumps(record) + "\n")
+            requests.write(
+                batch_request(
+                    url, extraction.llm_input(), build_prompt(extraction.unresolved)
+                )
+            )
+    logger.info(
+        f"Wrote {requests.lines} batch requests to {len(requests.files)} files in "
+        f"{out}, {n_rules} pages were extracted without LLM"
+    )
+    return requests.files
+
+
+def batch_fields_files(directory: str) -> list[Path]:
+    """
+    fields files export_batch wrote to directory, oldest export first
+    """
+    return sorted(Path(directory).glob("fields-*.jsonl"))
+
+
+def read_batch_results(
+    path: str,
+) -> Iterator[tuple[str, dict[str, Any] | ExtractionError, dict[str, Any] | None]]:
+    """
+    Stream a Batch API output file, repairing the JSON of the answers locally
+    :return: custom_id, schema (an ExtractionError when the request failed or the
+        answer holds no JSON object) and token usage including the model of every line
+    """
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            url = result["custom_id"]
+            response = result.get("response") or {}
+            body = response.get("body") or {}
+            usage = body.get("usage")
+            if usage is not None:
+                usage = {**usage, "model": body.get("model", model_name)}
+            if result.get("error") or response.get("status_code") != 200:
+                error = result.get("error") or body.get("error")
+                logger.error(f"Batch request for {url} failed: {error}")
+                yield url, ExtractionError(url, "request_failed", str(error)), usage
+                continue
+            content = body["choices"][0]["message"]["content"]
+            try:
+                schema = repair_json(content)
+            except ValueError as err:
+                logger.error(f"Parsing data schema of {url} failed: {err}")
+                schema = ExtractionError(url, "invalid_json", content)
+            yield url, schema, usage
+
+
+def ingest_batch_output(
+    paths: Iterable[str],
+    db: DatabaseClient,
+    fields_paths: Iterable[str | Path] = (),
+    batch_size: int = 500,
+) -> tuple[int, int]:
+    """
+    Bulk upsert the schemas of Batch API output files into raw_property_listings,
+    their token usage into llm_token_usage and the failed results into
+    llm_dead_letter. Values are coerced to the types of prompt_template, values
+    that cannot be are left empty.
+    :param paths: output files downloaded from the Batch API
+    :param fields_paths: fields files written by export_batch, the LLM answers are
+        only used for the fields the rules left unresolved. A page in several
+        files takes the fields of the last one, see batch_fields_files.
+    :return: number of ingested and failed results
+    """
+    rule_fields: dict[str, dict[str, Any]] = {}
+    for fields_path in fields_paths:
+        with open(fields_path) as f:
+            for line in f:
+                record = json.loads(line)
+                rule_fields[record["custom_id"]] = record
+    create_token_usage(db)
+    create_dead_letter(db)
+    types = prompt_fields()
+    ingested = failed = 0
+    with BatchWriter(
+        db,
+        "raw_property_listings",
+        ["url", "raw_data"],
+        batch_size=batch_size,
+        conflict_columns=["url"],
+        update=True,
+    ) as writer, BatchWriter(
+        db, "llm_token_usage", token_usage_columns, batch_size=batch_size
+    ) as usage_writer, BatchWriter(
+        db, "llm_dead_letter", dead_letter_columns, batch_size=batch_size
+    ) as dead_letter_writer:
+        for path in paths:
+            for url, schema, usage in read_batch_results(path):
+                if usage is not None:
+                    usage_writer.add(
+                        (
+                            url,
+                            usage["model"],
+                            1,
+                            usage["prompt_tokens"],
+                            usage["completion_tokens"],
+                            usage["total_tokens"],
+                        )
+                    )
+                if isinstance(schema, ExtractionError):
+                    failed += 1
+                    metrics.inc("fundai_stage_failures_total", stage="extract")
+                    model = usage["model"] if usage is not None else model_name
+                    dead_letter_writer.add(dead_letter_row(url, model, schema))
+                    continue
+                record = rule_fields.get(url)
+                fields = record["unresolved"] if record is not None else types
+                schema, invalid = coerce_schema(
+                    schema, {field: types[field] for field in fields if field in types}
+                )
+                if invalid:
+                    logger.warning(f"Invalid fields of {url} left empty: {invalid}")
+                if record is not None:
+                    schema = {**record["fields"], **schema}
+                writer.add((url, Json(schema)))
+                ingested += 1
+                metrics.inc("fundai_stage_items_total", stage="extract")
+    logger.info(f"Ingested {ingested} batch results, {failed} failed")
+    return ingested, failed
@@ -0,0 +1,412 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator
+from urllib.parse import urlsplit
+
+from fundai.metrics import metrics
+from fundai.politeness import PageBlocked, parse_retry_after, throttle_statuses
+
+logger = logging.getLogger(__name__)
+
+ua = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/86.0.4240.183 Safari/537.36"
+
+# analytics, advertising and consent scripts loaded by funda pages
+tracking_domains = (
+    "google-analytics.com",
+    "googletagmanager.com",
+    "googlesyndication.com",
+    "doubleclick.net",
+    "googleadservices.com",
+    "facebook.net",
+    "facebook.com",
+    "hotjar.com",
+    "bing.com",
+    "cookielaw.org",
+    "onetrust.com",
+    "nr-data.net",
+    "newrelic.com",
+    "criteo.com",
+    "criteo.net",
+    "adnxs.com",
+    "tiqcdn.com",
+)
+
+
+def _matches_domain(host: str, domains: tuple[str, ...]) -> bool:
+    return any(host == domain or host.endswith("." + domain) for domain in domains)
+
+
+class LoadProfile:
+    """
+    How Chromium loads a page: the resource types and domains whose requests are
+    aborted, the navigation event to wait for and the timeout of the page.
+    Html2TextTransformer only keeps the text of the DOM, so images, fonts,
+    stylesheets, map tiles and tracking scripts are downloaded for nothing.
+    """
+
+    def __init__(
+        self,
+        blocked_resource_types: tuple[str, ...] = (),
+        blocked_domains: tuple[str, ...] = (),
+        first_party_domains: tuple[str, ...] | None = None,
+        wait_until: str = "load",
+        wait_for_selector: str | None = None,
+        timeout: float = 30.0,
+    ) -> None:
+        """
+        :param blocked_resource_types: Playwright resource types to abort, e.g.
+            "image", "font", "stylesheet" or "media"
+        :param blocked_domains: domains, including their subdomains, to abort
+        :param first_party_domains: when given, requests to any other domain are
+            aborted as well
+        :param wait_until: navigation event goto waits for, "commit",
+            "domcontentloaded", "load" or "networkidle"
+        :param wait_for_selector: also wait until this selector is attached
+        :param timeout: seconds a page may take to load, including the selector
+        """
+        if wait_until not in ("commit", "domcontentloaded", "load", "networkidle"):
+            raise ValueError(f"Unknown wait condition {wait_until}")
+        self.blocked_resource_types = frozenset(blocked_resource_types)
+        self.blocked_domains = tuple(blocked_domains)
+        self.first_party_domains = first_party_domains
+        self.wait_until = wait_until
+        self.wait_for_selector = wait_for_selector
+        self.timeout = timeout
+
+    @property
+    def intercepts(self) -> bool:
+        return bool(
+            self.blocked_resource_types
+            or self.blocked_domains
+            or self.first_party_domains is not None
+        )
+
+    def blocks(self, url: str, resource_type: str) -> bool:
+        """
+        Whether a request of the page is aborted
+        """
+        if resource_type in self.blocked_resource_types:
+            return True
+        host = urlsplit(url).hostname or ""
+        if not host:
+            return False
+        if _matches_domain(host, self.blocked_domains):
+            return True
+        return self.first_party_domains is not None and not _matches_domain(
+            host, self.first_party_domains
+        )
+
+
+load_profiles = {
+    # what a regular browser does, the reference the other profiles are measured by
+    "full": LoadProfile(),
+    "lean": LoadProfile(
+        blocked_resource_types=("image", "media", "font", "stylesheet"),
+        blocked_domains=tracking_domains,
+        wait_until="domcontentloaded",
+    ),
+    # only funda itself, for when the lean profile still loads too much
+    "strict": LoadProfile(
+        blocked_resource_types=("image", "media", "font", "stylesheet"),
+        first_party_domains=("funda.nl", "fstatic.nl"),
+        wait_until="domcontentloaded",
+        timeout=20.0,
+    ),
+}
+
+
+def get_load_profile(profile: "str | LoadProfile") -> LoadProfile:
+    if isinstance(profile, LoadProfile):
+        return profile
+    try:
+        return load_profiles[profile]
+    except KeyError:
+        raise ValueError(
+            f"Unknown load profile {profile}, expected one of {list(load_profiles)}"
+        ) from None
+
+
+class PageLoad:
+    """
+    Requests, blocked requests and bytes of a single page load. Bytes are the
+    encoded body sizes of the responses as received, so chunked and compressed
+    responses are counted too. Sizes are read asynchronously, settle waits for them.
+    """
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.blocked = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self._sizes: list[asyncio.Future] = []
+
+    def on_response(self, response: Any):
+        self._sizes.append(asyncio.ensure_future(self._add_size(response)))
+
+    async def _add_size(self, response: Any):
+        try:
+            sizes = await response.request.sizes()
+            self.bytes += sizes["responseBodySize"]
+        except Exception:
+            # the page closed before the body was read, use the announced size
+            try:
+                self.bytes += int(response.headers.get("content-length", 0))
+            except ValueError:
+                pass
+
+    async def settle(self):
+        await asyncio.gather(*self._sizes)
+
+
+class _PooledContext:
+    def __init__(self, context: Any) -> None:
+        self.context = context
+        self.uses = 0
+
+
+class BrowserPool:
+    """
+    A single headless Chromium process shared by every fetch of a crawl.
+
+    Pages are opened in a bounded number of browser contexts. A context is
+    reused until it served `max_pages_per_context` pages, after which it is
+    closed and replaced to keep memory leaks in check. Contexts in which a
+    page errored are discarded, and the browser itself is relaunched when it
+    crashed. Pages are loaded according to a LoadProfile, by default the lean
+    one that skips everything the text conversion does not need. To measure what
+    the profile saves, every reference_every-th page, starting with the first,
+    is loaded with the full profile instead; the savings per page relative to
+    those reference loads are reported by page_stats. The metrics are labelled
+    with the profile a page was loaded with, so the savings are also the
+    difference between the fundai_browser_bytes_total and
+    fundai_browser_page_seconds_sum per page of the full profile and the one in use.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 4,
+        max_pages_per_context: int = 50,
+        headless: bool = True,
+        user_agent: str = ua,
+        profile: str | LoadProfile = "lean",
+        reference_every: int = 50,
+    ) -> None:
+        """
+        :param reference_every: pages per reference load with the full profile,
+            0 to never load a page in full
+        """
+        if concurrency < 1:
+            raise ValueError("concurrency should be at least 1")
+        self.concurrency = concurrency
+        self.max_pages_per_context = max_pages_per_context
+        self.headless = headless
+        self.user_agent = user_agent
+        self.profile = get_load_profile(profile)
+        self.profile_name = profile if isinstance(profile, str) else "custom"
+        self.reference_every = reference_every
+        self._playwright = None
+        self._browser = None
+        self._idle: list[_PooledContext] = []
+        self._semaphore: asyncio.Semaphore | None = None
+        self._launch_lock: asyncio.Lock | None = None
+        self.launches = 0
+        self.recycled = 0
+        self.stats: Counter = Counter()
+        self.reference_stats: Counter = Counter()
+        self._loads = 0
+
+    async def start(self) -> "BrowserPool":
+        from playwright.async_api import async_playwright
+
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._launch_lock = asyncio.Lock()
+        self._playwright = await async_playwright().start()
+        await self._launch()
+        return self
+
+    async def _launch(self):
+        self._idle = []
+        self._browser = await self._playwright.chromium.launch(headless=self.headless)
+        self.launches += 1
+        logger.info(f"Launched Chromium (launch number {self.launches})")
+
+    async def _ensure_browser(self):
+        async with self._launch_lock:
+            if self._browser is None or not self._browser.is_connected():
+                logger.warning("Chromium is not connected anymore, relaunching")
+                await self._launch()
+
+    async def _acquire_context(self) -> _PooledContext:
+        await self._ensure_browser()
+        if self._idle:
+            return self._idle.pop()
+        context = await self._browser.new_context(user_agent=self.user_agent)
+        return _PooledContext(context)
+
+    async def _release_context(self, pooled: _PooledContext, healthy: bool):
+        if healthy and pooled.uses < self.max_pages_per_context:
+            self._idle.append(pooled)
+            return
+        self.recycled += 1
+        try:
+            await pooled.context.close()
+        except Exception as err:
+            logger.debug(f"Closing recycled context failed: {err}")
+
+    @asynccontextmanager
+    async def page(self) -> AsyncIterator[Any]:
+        """
+        Borrow a fresh page from one of the pooled contexts
+        """
+        if self._semaphore is None:
+            raise RuntimeError("BrowserPool has not been started")
+        async with self._semaphore:
+            pooled = await self._acquire_context()
+            healthy = True
+            try:
+                page = await pooled.context.new_page()
+            except Exception:
+                await self._release_context(pooled, healthy=False)
+                raise
+            try:
+                yield page
+            except Exception:
+                healthy = False
+                raise
+            finally:
+                pooled.uses += 1
+                try:
+                    await page.close()
+                except Exception:
+                    healthy = False
+                await self._release_context(pooled, healthy)
+
+    async def fetch(self, url: str) -> str:
+        """
+        Navigate to url and return the rendered HTML
+        :param url: page to load
+        :return: HTML content of the page
+        :raises PageBlocked: when the page is answered with a 403 or 429
+        """
+        self._loads += 1
+        full = load_profiles["full"]
+        reference = (
+            self.reference_every > 0
+            and self.profile is not full
+            and (self._loads - 1) % self.reference_every == 0
+        )
+        profile = full if reference else self.profile
+        load = PageLoad()
+        async with self.page() as page:
+            if profile.intercepts:
+
+                async def _route(route):
+                    load.requests += 1
+                    request = route.request
+                    if profile.blocks(request.url, request.resource_type):
+                        load.blocked += 1
+                        await route.abort()
+                    else:
+                        await route.continue_()
+
+                await page.route("**/*", _route)
+            page.on("response", load.on_response)
+            timeout = profile.timeout * 1000
+            start = time.perf_counter()
+            response = await page.goto(
+                url, wait_until=profile.wait_until, timeout=timeout
+            )
+            if response is not None and response.status in throttle_statuses:
+                retry_after = response.headers.get("retry-after")
+                raise PageBlocked(
+                    url, f"status_{response.status}", parse_retry_after(retry_after)
+                )
+            if profile.wait_for_selector is not None:
+                await page.wait_for_selector(
+                    profile.wait_for_selector, state="attached", timeout=timeout
+                )
+            html = await page.content()
+            load.seconds = time.perf_counter() - start
+            await load.settle()
+        self._record(load, reference)
+        return html
+
+    def _record(self, load: PageLoad, reference: bool = False):
+        stats = self.reference_stats if reference else self.stats
+        stats["pages"] += 1
+        stats["requests"] += load.requests
+        stats["blocked"] += load.blocked
+        stats["bytes"] += load.bytes
+        stats["seconds"] += load.seconds
+        profile = "full" if reference else self.profile_name
+        metrics.observe("fundai_browser_page_seconds", load.seconds, profile=profile)
+        metrics.inc("fundai_browser_bytes_total", load.bytes, profile=profile)
+        metrics.inc(
+            "fundai_browser_requests_total",
+            load.blocked,
+            outcome="blocked",
+            profile=profile,
+        )
+        metrics.inc(
+            "fundai_browser_requests_total",
+            load.requests - load.blocked,
+            outcome="allowed",
+            profile=profile,
+        )
+
+    def page_stats(self) -> dict[str, float]:
+        """
+        Mean bytes, seconds and blocked requests per page loaded with the profile
+        so far. Once a reference page was loaded with the full profile, also the
+        bytes and seconds saved per page compared with it, and the share of the
+        bytes saved.
+        """
+        pages = max(self.stats["pages"], 1)
+        stats = {
+            "pages": self.stats["pages"],
+            "bytes_per_page": self.stats["bytes"] / pages,
+            "seconds_per_page": self.stats["seconds"] / pages,
+            "blocked_per_page": self.stats["blocked"] / pages,
+        }
+        references = self.reference_stats["pages"]
+        if references:
+            full_bytes = self.reference_stats["bytes"] / references
+            full_seconds = self.reference_stats["seconds"] / references
+            stats["reference_pages"] = references
+            stats["bytes_saved_per_page"] = full_bytes - stats["bytes_per_page"]
+            stats["seconds_saved_per_page"] = full_seconds - stats["seconds_per_page"]
+            stats["bytes_saved_share"] = (
+                stats["bytes_saved_per_page"] / full_bytes if full_bytes else 0.0
+            )
+        return stats
+
+    def pop_backend(self, url: str) -> str:
+        return "browser"
+
+    async def close(self):
+        if self.stats["pages"] or self.reference_stats["pages"]:
+            logger.info(f"Browser page loads: {self.page_stats()}")
+        for pooled in self._idle:
+            try:
+                await pooled.context.close()
+            except Exception:
+                pass
+        self._idle = []
+        if self._browser is not None:
+            try:
+                await self._browser.close()
+            except Exception:
+                pass
+            self._browser = None
+        if self._playwright is not None:
+            await self._playwright.stop()
+            self._playwright = None
+
+    async def __aenter__(self) -> "BrowserPool":
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.close()
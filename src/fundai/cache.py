@@ -0,0 +1,101 @@
+import hashlib
+import logging
+from typing import Any
+
+from psycopg2.extras import Json
+
+from fundai.db import DatabaseClient
+from fundai.utils import prompt_template, model_name
+
+logger = logging.getLogger(__name__)
+
+
+def sha256(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class ExtractionCache:
+    """
+    Persistent cache of extracted schemas in llm_extraction_cache, keyed on a hash of
+    the model, the prompt and the post processed page text. A change of prompt or
+    model therefore never hits old entries, evict removes them. Entries requested
+    with a prompt derived from prompt_template (see fundai.rules.build_prompt) are
+    stored under the hash of prompt_template they derive from.
+    """
+
+    def __init__(
+        self, db: DatabaseClient, model: str = model_name, prompt: str = prompt_template
+    ) -> None:
+        self.db = db
+        self.model = model
+        self.prompt_hash = sha256(prompt)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, page_content: str, prompt: str | None = None) -> str:
+        key = f"{self.model}\0{self.prompt_hash}\0{page_content}"
+        if prompt is not None and sha256(prompt) != self.prompt_hash:
+            key = f"{sha256(prompt)}\0{key}"
+        return sha256(key)
+
+    def get(
+        self, page_content: str, prompt: str | None = None
+    ) -> dict[str, Any] | None:
+        """
+        Look up the schema of page_content, marking the entry as used
+        """
+        query = """
+            UPDATE llm_extraction_cache
+            SET hits = hits + 1, last_used_at = now()
+            WHERE key = %s
+            RETURNING schema
+        """
+        with self.db.connection() as conn, conn.cursor() as cur:
+            cur.execute(query, [self.key(page_content, prompt)])
+            row = cur.fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put(self, page_content: str, schema: dict[str, Any], prompt: str | None = None):
+        query = """
+            INSERT INTO llm_extraction_cache (key, model, prompt_hash, schema)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (key) DO UPDATE SET schema = EXCLUDED.schema, last_used_at = now()
+        """
+        with self.db.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                query,
+                [
+                    self.key(page_content, prompt),
+                    self.model,
+                    self.prompt_hash,
+                    Json(schema),
+                ],
+            )
+
+    def evict(self, max_age_days: int | None = None) -> int:
+        """
+        Remove entries of other models or prompts, and entries not used for max_age_days
+        :return: number of evicted entries
+        """
+        query = """
+            DELETE FROM llm_extraction_cache
+            WHERE model <> %s OR prompt_hash <> %s
+                OR last_used_at < now() - make_interval(days => %s)
+        """
+        with self.db.connection() as conn, conn.cursor() as cur:
+            cur.execute(query, [self.model, self.prompt_hash, max_age_days])
+            evicted = cur.rowcount
+        logger.info(f"Evicted {evicted} entries from the extraction cache")
+        return evicted
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import html2text
+
+from fundai.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def html_to_text(html: str) -> str:
+    """
+    Convert a page like Html2TextTransformer(ignore_links=False) does for a single
+    document. A fresh handler is used per page, since a shared handler carries
+    state (e.g. of unclosed tables) over to the next page.
+    """
+    h = html2text.HTML2Text()
+    h.ignore_links = False
+    h.ignore_images = True
+    return h.handle(html)
+
+
+class TextConverter:
+    """
+    Convert HTML to text in a pool of worker processes, so conversion of one page
+    overlaps with fetching the next ones instead of holding the event loop.
+    Workers are spawned rather than forked, the scraper runs threads for its writers.
+    """
+
+    def __init__(self, processes: int | None = None) -> None:
+        """
+        :param processes: number of worker processes, one per CPU when None and
+            conversion in the calling thread when 0
+        """
+        self.processes = (os.cpu_count() or 1) if processes is None else processes
+        self._executor: ProcessPoolExecutor | None = None
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            logger.info(f"Starting {self.processes} HTML conversion processes")
+            self._executor = ProcessPoolExecutor(
+                self.processes, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    async def convert(self, html: str) -> str:
+        with metrics.timer("fundai_stage_seconds", stage="convert"):
+            if self.processes == 0:
+                text = html_to_text(html)
+            else:
+                text = await asyncio.get_running_loop().run_in_executor(
+                    self._pool(), html_to_text, html
+                )
+        metrics.inc("fundai_stage_items_total", stage="convert")
+        return text
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    def __enter__(self) -> "TextConverter":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
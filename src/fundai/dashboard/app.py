@@ -1,8 +1,80 @@
 import streamlit as st
 import plotly.express as px
-import pandas as pd
 from fundai import DatabaseClient, load_config
+from fundai.dashboard.data import DashboardData, time_series_periods
 
-db = DatabaseClient(load_config())
-df = db.read_df("select * from property_listing")
-print(df)
+# Streamlit reruns this script on every interaction, the client, its connection
+# pool and the query cache are created once per server process instead.
+
+
+@st.cache_resource
+def get_data() -> DashboardData:
+    return DashboardData(DatabaseClient(load_config()), ttl=300)
+
+
+data = get_data()
+st.title("fundai")
+
+with st.sidebar:
+    cities = data.cities()
+    city = st.selectbox("City", [None, *cities], format_func=lambda c: c or "All")
+    neighborhoods = st.multiselect("Neighborhoods", data.neighborhoods(city))
+    min_price, max_price = st.slider(
+        "Asking price", 0, 3_000_000, (0, 3_000_000), step=25_000
+    )
+    min_area, max_area = st.slider("Living area (m²)", 0, 500, (0, 500), step=5)
+    period = st.selectbox("Period", time_series_periods, index=1)
+    if st.button("Refresh data"):
+        data.clear()
+
+filters = {
+    "city": city,
+    "neighborhoods": neighborhoods,
+    "min_price": min_price or None,
+    "max_price": max_price if max_price < 3_000_000 else None,
+    "min_living_area": min_area or None,
+    "max_living_area": max_area if max_area < 500 else None,
+}
+
+summary = data.summary(**filters)
+listings, median_price, median_m2 = st.columns(3)
+listings.metric("Listings", f"{summary['listings']:,}")
+median_price.metric("Median asking price", f"€ {summary['median_price'] or 0:,.0f}")
+median_m2.metric("Median price per m²", f"€ {summary['median_price_per_m2'] or 0:,.0f}")
+
+st.subheader("Price per m² by neighborhood")
+by_neighborhood = data.price_per_m2_by_neighborhood(min_listings=3, **filters)
+st.plotly_chart(
+    px.bar(
+        by_neighborhood.head(30),
+        x="neighborhood",
+        y="median_price_per_m2",
+        hover_data=["listings", "mean_price_per_m2"],
+    )
+)
+
+st.subheader("Energy labels")
+st.plotly_chart(
+    px.bar(data.energy_label_counts(**filters), x="energy_label", y="listings")
+)
+
+st.subheader("Listings found over time")
+series = data.time_series(period, **filters)
+st.plotly_chart(px.line(series, x="period", y=["listings"]))
+st.plotly_chart(px.line(series, x="period", y=["median_price_per_m2"]))
+
+st.subheader("Latest listings")
+st.dataframe(
+    data.listings(
+        [
+            "address",
+            "neighborhood",
+            "asking_price",
+            "living_area",
+            "energy_label",
+            "status",
+            "url",
+        ],
+        **filters,
+    )
+)
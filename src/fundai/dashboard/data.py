@@ -0,0 +1,252 @@
+import logging
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Sequence
+
+from fundai.db import DatabaseClient, property_listing_columns
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# columns the dashboard may select from property_listing, besides the typed ones
+listing_columns = ["id", "url", *(name for name, _ in property_listing_columns)]
+# asking price per m² as stated on the page, computed from price and area otherwise
+price_per_m2 = """coalesce(
+    asking_price_per_m2,
+    price_per_m2,
+    round(coalesce(asking_price, price)::NUMERIC / nullif(living_area, 0))
+)"""
+time_series_periods = ("day", "week", "month", "quarter", "year")
+
+
+def listing_filter(
+    city: str | None = None,
+    neighborhoods: Sequence[str] = (),
+    min_price: int | None = None,
+    max_price: int | None = None,
+    min_living_area: int | None = None,
+    max_living_area: int | None = None,
+    energy_labels: Sequence[str] = (),
+    statuses: Sequence[str] = (),
+) -> tuple[str, dict[str, Any]]:
+    """
+    WHERE clause selecting the listings of property_listing (aliased pl) that
+    match the dashboard filters, unset filters select everything
+    :return: the clause and its parameters
+    """
+    conditions = []
+    params: dict[str, Any] = {}
+    # city and price are compared as in property_listing_indexed_expressions of
+    # fundai.db, any other expression would not use their indexes
+    if city:
+        conditions.append("lower(pl.city) = lower(%(city)s)")
+        params["city"] = city
+    if neighborhoods:
+        conditions.append("pl.neighborhood = ANY(%(neighborhoods)s)")
+        params["neighborhoods"] = list(neighborhoods)
+    price = "coalesce(pl.asking_price, pl.price)"
+    for name, column, op, value in [
+        ("min_price", price, ">=", min_price),
+        ("max_price", price, "<=", max_price),
+        ("min_living_area", "pl.living_area", ">=", min_living_area),
+        ("max_living_area", "pl.living_area", "<=", max_living_area),
+    ]:
+        if value is not None:
+            conditions.append(f"{column} {op} %({name})s")
+            params[name] = value
+    if energy_labels:
+        conditions.append("upper(pl.energy_label) = ANY(%(energy_labels)s)")
+        params["energy_labels"] = [label.upper() for label in energy_labels]
+    if statuses:
+        conditions.append("lower(pl.status) = ANY(%(statuses)s)")
+        params["statuses"] = [status.lower() for status in statuses]
+    return "WHERE " + " AND ".join(conditions or ["TRUE"]), params
+
+
+def _cache_key(query: str, params: dict[str, Any]) -> tuple:
+    return query, tuple(
+        (k, tuple(v) if isinstance(v, list) else v) for k, v in sorted(params.items())
+    )
+
+
+class DashboardData:
+    """
+    Queries behind the dashboard. Filters and aggregations run in Postgres on the
+    typed property_listing table and only the columns a chart needs are read,
+    so a rerun of the Streamlit script transfers a few aggregated rows instead of
+    every listing. Results are cached for ttl seconds, shared by every session
+    of the process together with the pool of db.
+    """
+
+    def __init__(self, db: DatabaseClient, ttl: float = 300) -> None:
+        self.db = db
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._cache: dict[tuple, tuple[float, "pd.DataFrame"]] = {}
+        self._lock = threading.Lock()
+
+    def query(self, query: str, params: dict[str, Any] | None = None) -> "pd.DataFrame":
+        """
+        Result of query as a DataFrame, read from the cache while it is younger
+        than ttl seconds. Callers get a copy they are free to modify.
+        """
+        params = params or {}
+        key = _cache_key(query, params)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] > now:
+                self.hits += 1
+                return cached[1].copy()
+        df = self.db.read_df(query, params=params)
+        with self._lock:
+            self.misses += 1
+            self._cache = {k: v for k, v in self._cache.items() if v[0] > now}
+            self._cache[key] = (now + self.ttl, df)
+        return df.copy()
+
+    def clear(self):
+        with self._lock:
+            self._cache = {}
+
+    def cities(self) -> list[str]:
+        df = self.query(
+            "SELECT DISTINCT city FROM property_listing WHERE city IS NOT NULL "
+            "ORDER BY city"
+        )
+        return df["city"].tolist()
+
+    def neighborhoods(self, city: str | None = None) -> list[str]:
+        where, params = listing_filter(city=city)
+        df = self.query(
+            f"""
+            SELECT DISTINCT neighborhood
+            FROM property_listing pl
+            {where} AND neighborhood IS NOT NULL
+            ORDER BY neighborhood
+            """,
+            params,
+        )
+        return df["neighborhood"].tolist()
+
+    def summary(self, **filters: Any) -> dict[str, Any]:
+        """
+        Number of listings, median asking price and median price per m²
+        """
+        where, params = listing_filter(**filters)
+        df = self.query(
+            f"""
+            SELECT
+                count(*) AS listings,
+                percentile_cont(0.5) WITHIN GROUP (
+                    ORDER BY coalesce(pl.asking_price, pl.price)
+                ) AS median_price,
+                percentile_cont(0.5) WITHIN GROUP (ORDER BY {price_per_m2})
+                    AS median_price_per_m2
+            FROM property_listing pl
+            {where}
+            """,
+            params,
+        )
+        return df.to_dict("records")[0]
+
+    def price_per_m2_by_neighborhood(
+        self, min_listings: int = 1, **filters: Any
+    ) -> "pd.DataFrame":
+        """
+        Listings, median and mean price per m² of every neighborhood, most
+        expensive first
+        :param min_listings: leave out neighborhoods with fewer listings
+        """
+        where, params = listing_filter(**filters)
+        params["min_listings"] = min_listings
+        return self.query(
+            f"""
+            SELECT
+                pl.neighborhood,
+                count(*) AS listings,
+                percentile_cont(0.5) WITHIN GROUP (ORDER BY {price_per_m2})
+                    AS median_price_per_m2,
+                round(avg({price_per_m2})) AS mean_price_per_m2
+            FROM property_listing pl
+            {where} AND pl.neighborhood IS NOT NULL AND {price_per_m2} IS NOT NULL
+            GROUP BY pl.neighborhood
+            HAVING count(*) >= %(min_listings)s
+            ORDER BY median_price_per_m2 DESC
+            """,
+            params,
+        )
+
+    def energy_label_counts(self, **filters: Any) -> "pd.DataFrame":
+        """
+        Listings per energy label, "onbekend" when the label is missing
+        """
+        where, params = listing_filter(**filters)
+        return self.query(
+            f"""
+            SELECT
+                coalesce(upper(trim(pl.energy_label)), 'onbekend') AS energy_label,
+                count(*) AS listings
+            FROM property_listing pl
+            {where}
+            GROUP BY 1
+            ORDER BY 1
+            """,
+            params,
+        )
+
+    def time_series(self, period: str = "week", **filters: Any) -> "pd.DataFrame":
+        """
+        Listings found and their median asking price and price per m² per period,
+        by the date their URL was first found
+        :param period: "day", "week", "month", "quarter" or "year"
+        """
+        if period not in time_series_periods:
+            raise ValueError(f"Unknown period {period}, expected {time_series_periods}")
+        where, params = listing_filter(**filters)
+        return self.query(
+            f"""
+            SELECT
+                date_trunc('{period}', s.date) AS period,
+                count(*) AS listings,
+                percentile_cont(0.5) WITHIN GROUP (
+                    ORDER BY coalesce(pl.asking_price, pl.price)
+                ) AS median_price,
+                percentile_cont(0.5) WITHIN GROUP (ORDER BY {price_per_m2})
+                    AS median_price_per_m2
+            FROM property_listing pl
+            JOIN search_page_urls s ON s.url = pl.url
+            {where} AND s.date IS NOT NULL
+            GROUP BY 1
+            ORDER BY 1
+            """,
+            params,
+        )
+
+    def listings(
+        self, columns: Sequence[str], limit: int = 500, **filters: Any
+    ) -> "pd.DataFrame":
+        """
+        Only the given columns of the listings matching the filters, newest first
+        :param columns: columns of property_listing to read
+        :param limit: listings returned at most
+        """
+        unknown = set(columns) - set(listing_columns)
+        if unknown:
+            raise ValueError(f"Unknown property_listing columns {sorted(unknown)}")
+        where, params = listing_filter(**filters)
+        params["limit"] = limit
+        selected = ", ".join(f"pl.{column}" for column in columns)
+        return self.query(
+            f"""
+            SELECT {selected}
+            FROM property_listing pl
+            {where}
+            ORDER BY pl.id DESC
+            LIMIT %(limit)s
+            """,
+            params,
+        )
@@ -1,12 +1,26 @@
-from datetime import datetime
+import io
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import date, datetime
 from configparser import ConfigParser
 
-import pandas as pd
 import pytz
 import psycopg2
+from psycopg2.extensions import STATUS_READY
 from psycopg2.extras import Json, execute_values
+from psycopg2.pool import ThreadedConnectionPool
 import logging
-from typing import Any, Sequence
+from typing import TYPE_CHECKING, Any, Iterable, Iterator, Sequence
+
+from fundai.metrics import metrics
+
+if TYPE_CHECKING:
+    # pandas is imported by the methods returning DataFrames, most commands never
+    # build one and its import takes about half a second
+    import pandas as pd
 
 logger = logging.getLogger(__name__)
 
@@ -28,48 +42,375 @@ def load_config(filename="database.ini", section="postgresql") -> dict[str, str]
     return config
 
 
-def connect(config: dict[str, str]):
-    with psycopg2.connect(**config) as conn:
-        print("Connected to the PostgreSQL server.")
-        return conn
+def copy_value(value: Any) -> str:
+    """
+    Format a single value in the text format of COPY ... FROM STDIN
+    :param value: python value, dicts and lists are written as JSON
+    :return: escaped field
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, Json):
+        value = value.adapted
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    elif isinstance(value, bool):
+        value = "t" if value else "f"
+    elif isinstance(value, (datetime, date)):
+        value = value.isoformat()
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+class CopyRowStream(io.TextIOBase):
+    """
+    File-like object that lazily renders rows in COPY text format, so rows
+    are streamed to the server without building the whole payload in memory
+    """
+
+    def __init__(self, rows: Iterable[Sequence[Any]]) -> None:
+        self._rows = iter(rows)
+        self._buffer = ""
+        self.n_rows = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self._buffer) < size:
+            try:
+                row = next(self._rows)
+            except StopIteration:
+                break
+            self._buffer += "\t".join(copy_value(v) for v in row) + "\n"
+            self.n_rows += 1
+        if size < 0:
+            size = len(self._buffer)
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
 
 
 class DatabaseClient:
-    def __init__(self, config: dict[str, str]) -> None:
-        self.conn = connect(config)
-        logger.info("Connection to postgres database successful")
-        self.conn.autocommit = True
+    """
+    Postgres client backed by a pool of autocommit connections, safe to share
+    between the threads and tasks of a pipeline. Every call checks a connection
+    out for its duration, waiting when all max_connections are in use.
+    Connections idle for longer than health_check_interval seconds are pinged
+    before use, and broken connections are replaced by new ones.
+    """
+
+    def __init__(
+        self,
+        config: dict[str, str],
+        min_connections: int = 4,
+        max_connections: int = 8,
+        health_check_interval: float = 30.0,
+    ) -> None:
+        """
+        :param config: connection parameters, min_connections and max_connections
+            in the config (e.g. from database.ini) override the arguments
+        :param min_connections: connections kept open between calls, connections
+            opened above it are closed when they are returned
+        :param max_connections: connections open at most
+        :param health_check_interval: idle seconds after which a connection is pinged
+        """
+        config = dict(config)
+        self.max_connections = int(config.pop("max_connections", max_connections))
+        self.min_connections = min(
+            int(config.pop("min_connections", min_connections)), self.max_connections
+        )
+        self.config = config
+        self.health_check_interval = health_check_interval
+        self.pool = ThreadedConnectionPool(
+            self.min_connections, self.max_connections, **config
+        )
+        self._slots = threading.BoundedSemaphore(self.max_connections)
+        self._last_used: dict[int, float] = {}
+        self.reconnects = 0
+        logger.info(
+            f"Connection pool to postgres database opened "
+            f"({self.min_connections}-{self.max_connections} connections)"
+        )
+
+    def _healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn))
+        if last_used and time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
+    def _checkout(self):
+        for _ in range(self.max_connections + 1):
+            conn = self.pool.getconn()
+            if not conn.closed:
+                conn.autocommit = True
+            if self._healthy(conn):
+                return conn
+            logger.warning("Replacing broken database connection")
+            self.reconnects += 1
+            self._last_used.pop(id(conn), None)
+            self.pool.putconn(conn, close=True)
+        raise psycopg2.OperationalError("No healthy database connection available")
+
+    @contextmanager
+    def connection(self):
+        """
+        Check out an autocommit connection from the pool. A connection that broke
+        while in use is closed instead of being returned to the pool.
+        """
+        self._slots.acquire()
+        try:
+            conn = self._checkout()
+            try:
+                yield conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # ping the connection before it is used again
+                self._last_used.pop(id(conn), None)
+                raise
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+            finally:
+                if not conn.closed and conn.status != STATUS_READY:
+                    try:
+                        conn.rollback()
+                    except psycopg2.Error:
+                        pass
+                self.pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            self._slots.release()
+
+    def close(self):
+        self.pool.closeall()
+
+    def __enter__(self) -> "DatabaseClient":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     def init(self, query: str):
-        with self.conn.cursor() as cur:
+        with self.connection() as conn, conn.cursor() as cur:
             cur.execute(query)
-            self.conn.commit()
 
     def insert_values(
-        self, values: Sequence[Any], table_name: str, column_names: list[str]
-    ):
-        with self.conn.cursor() as cur:
-            columns_str = ", ".join(column_names)
-            query = f"INSERT INTO {table_name} ({columns_str}) VALUES (%s, %s);"
-            cur.executemany(query, values)
-            self.conn.commit()
+        self,
+        values: Iterable[Sequence[Any]],
+        table_name: str,
+        column_names: list[str],
+        conflict_columns: list[str] | None = None,
+        update: bool = False,
+        method: str = "copy",
+        page_size: int = 1000,
+    ) -> int:
+        """
+        Bulk insert rows with any number of columns
+        :param values: rows, in the order of column_names
+        :param table_name: target table
+        :param column_names: columns to insert
+        :param conflict_columns: when given, rows conflicting on these columns are
+            skipped (ON CONFLICT DO NOTHING) or updated when update is set
+        :param update: overwrite the other columns of conflicting rows
+        :param method: "copy" streams rows through COPY FROM STDIN, "values"
+            sends pages of multi-row INSERTs using execute_values
+        :param page_size: rows per statement for the "values" method
+        :return: number of rows sent
+        """
+        columns_str = ", ".join(column_names)
+        conflict = ""
+        if conflict_columns:
+            conflict = f"ON CONFLICT ({', '.join(conflict_columns)}) DO NOTHING"
+            updated = [c for c in column_names if c not in conflict_columns]
+            if update and updated:
+                set_str = ", ".join(f"{c} = EXCLUDED.{c}" for c in updated)
+                conflict = f"ON CONFLICT ({', '.join(conflict_columns)}) DO UPDATE SET {set_str}"
+
+        start = time.perf_counter()
+        with self.connection() as conn, conn.cursor() as cur:
+            if method == "values":
+                values = list(values)
+                query = f"INSERT INTO {table_name} ({columns_str}) VALUES %s {conflict}"
+                execute_values(cur, query, values, page_size=page_size)
+                n_rows = len(values)
+            elif method == "copy" and not conflict:
+                stream = CopyRowStream(values)
+                cur.copy_expert(f"COPY {table_name} ({columns_str}) FROM STDIN", stream)
+                n_rows = stream.n_rows
+            elif method == "copy":
+                # COPY has no ON CONFLICT, stage the rows in a temporary table first;
+                # it is recreated so every call stages exactly its own columns
+                staging = f"_staging_{table_name}"
+                cur.execute(f"DROP TABLE IF EXISTS {staging}")
+                cur.execute(
+                    f"CREATE TEMP TABLE {staging} AS "
+                    f"SELECT {columns_str} FROM {table_name} WITH NO DATA"
+                )
+                stream = CopyRowStream(values)
+                cur.copy_expert(f"COPY {staging} ({columns_str}) FROM STDIN", stream)
+                n_rows = stream.n_rows
+                # a row may only be updated once per statement
+                distinct = (
+                    f"DISTINCT ON ({', '.join(conflict_columns)}) " if update else ""
+                )
+                cur.execute(
+                    f"INSERT INTO {table_name} ({columns_str}) "
+                    f"SELECT {distinct}{columns_str} FROM {staging} {conflict}"
+                )
+                cur.execute(f"DROP TABLE {staging}")
+            else:
+                raise ValueError(f"Unknown insert method {method}")
+        elapsed = time.perf_counter() - start
+        metrics.observe("fundai_stage_seconds", elapsed, stage="insert")
+        metrics.inc("fundai_rows_inserted_total", n_rows, table=table_name)
+        logger.info(
+            f"Inserted {n_rows} rows into {table_name} in {elapsed:.2f}s "
+            f"({n_rows / max(elapsed, 1e-9):.0f} rows/s)"
+        )
+        return n_rows
 
     def read(self, query: str) -> dict:
-        with self.conn.cursor() as cur:
+        with self.connection() as conn, conn.cursor() as cur:
             cur.execute(query)
             return cur.fetchall()
 
-    def read_df(self, query: str) -> pd.DataFrame:
-        with self.conn.cursor() as cur:
-            cur.execute(query)
+    def read_df(
+        self,
+        query: str,
+        chunksize: int | None = None,
+        params: Sequence[Any] | dict[str, Any] | None = None,
+    ) -> "pd.DataFrame | Iterator[pd.DataFrame]":
+        """
+        Read the result of query into a DataFrame
+        :param query: query to execute
+        :param chunksize: when given, return an iterator of DataFrames of at most
+            chunksize rows, streamed with a server-side cursor
+        :param params: parameters of the placeholders in query
+        """
+        import pandas as pd
+
+        if chunksize is not None:
+            return self.iter_df(query, chunksize, params)
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute(query, params)
             df = pd.DataFrame(
                 data=cur.fetchall(), columns=[c.name for c in cur.description]
             )
         return df
 
-    def execute(self, query: str):
-        with self.conn.cursor() as cur:
+    @contextmanager
+    def server_cursor(self, itersize: int = 2000):
+        """
+        Named (server-side) cursor on a pooled connection, so results are fetched
+        in batches of itersize rows instead of all at once. The connection leaves
+        autocommit for the lifetime of the cursor, writes made meanwhile go through
+        other connections of the pool.
+        """
+        with self.connection() as conn:
+            conn.autocommit = False
+            try:
+                with conn.cursor(name=f"fundai_{uuid.uuid4().hex}") as cur:
+                    cur.itersize = itersize
+                    yield cur
+            finally:
+                if not conn.closed:
+                    conn.rollback()
+                    conn.autocommit = True
+
+    def iter_batches(self, query: str, batch_size: int = 2000) -> Iterator[list[tuple]]:
+        """
+        Stream the rows of query in lists of at most batch_size rows
+        """
+        with self.server_cursor(batch_size) as cur:
             cur.execute(query)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield rows
+
+    def iter_df(
+        self,
+        query: str,
+        chunksize: int = 10_000,
+        params: Sequence[Any] | dict[str, Any] | None = None,
+    ) -> "Iterator[pd.DataFrame]":
+        """
+        Stream the result of query as DataFrames of at most chunksize rows
+        """
+        import pandas as pd
+
+        with self.server_cursor(chunksize) as cur:
+            cur.execute(query, params)
+            columns = None
+            while True:
+                rows = cur.fetchmany(chunksize)
+                if columns is None:
+                    columns = [c.name for c in cur.description]
+                if not rows:
+                    return
+                yield pd.DataFrame(data=rows, columns=columns)
+
+    def execute(self, query: str, params: Sequence[Any] | None = None):
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute(query, params)
+
+
+class BatchWriter:
+    """
+    Buffer rows and bulk insert them with DatabaseClient.insert_values once
+    batch_size rows have been collected. Safe to share between threads.
+    """
+
+    def __init__(
+        self,
+        db: DatabaseClient,
+        table_name: str,
+        column_names: list[str],
+        batch_size: int = 500,
+        **insert_kwargs,
+    ) -> None:
+        self.db = db
+        self.table_name = table_name
+        self.column_names = column_names
+        self.batch_size = batch_size
+        self.insert_kwargs = insert_kwargs
+        self.written = 0
+        self._rows: list[Sequence[Any]] = []
+        self._lock = threading.Lock()
+
+    def add(self, row: Sequence[Any]):
+        with self._lock:
+            self._rows.append(row)
+            if len(self._rows) >= self.batch_size:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._rows:
+            return
+        rows, self._rows = self._rows, []
+        self.written += self.db.insert_values(
+            rows, self.table_name, self.column_names, **self.insert_kwargs
+        )
+
+    def __enter__(self) -> "BatchWriter":
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
 
 
 def init_search_urls(db: DatabaseClient):
@@ -86,59 +427,12 @@ def init_search_urls(db: DatabaseClient):
         (
             url VARCHAR(255) UNIQUE,
             page_content TEXT,
+            fetch_backend VARCHAR(16),
             FOREIGN KEY (url) REFERENCES search_page_urls(url)
         )
     """
-    house_data = """
-    CREATE VIEW property_listings (
-    id SERIAL PRIMARY KEY,
-    url TEXT,
-    address TEXT,
-    postal_code TEXT,
-    city TEXT,
-    neighborhood TEXT,
-    living_area INTEGER,
-    bedrooms INTEGER,
-    price INTEGER,
-    price_per_m2 INTEGER,
-    description TEXT,
-    asking_price INTEGER,
-    asking_price_per_m2 INTEGER,
-    status TEXT,
-    acceptance TEXT,
-    vve_contribution NUMERIC,
-    type_of_apartment TEXT,
-    type_of_construction TEXT,
-    year_of_construction INTEGER,
-    accessibility TEXT,
-    living_area_m2 INTEGER,
-    volume INTEGER,
-    number_of_rooms INTEGER,
-    number_of_bedrooms INTEGER,
-    number_of_bathrooms INTEGER,
-    bathroom_facilities TEXT,
-    number_of_floors INTEGER,
-    located_on TEXT,
-    facilities TEXT,
-    energy_label TEXT,
-    insulation TEXT,
-    heating TEXT,
-    hot_water TEXT,
-    boiler_brand TEXT,
-    boiler_type TEXT,
-    boiler_ownership TEXT,
-    cadastral_number TEXT,
-    ownership_status TEXT,
-    type_of_parking TEXT,
-    registered_with_chamber_of_commerce BOOLEAN,
-    annual_meeting BOOLEAN,
-    periodic_contribution BOOLEAN,
-    reserve_fund BOOLEAN,
-    maintenance_plan BOOLEAN,
-    building_insurance BOOLEAN,
-    agency_name TEXT,
-    phone_number TEXT
-    );
+    fetch_backend = """
+    ALTER TABLE raw_page_content ADD COLUMN IF NOT EXISTS fetch_backend VARCHAR(16)
     """
     raw_property_listings = """
     CREATE TABLE IF NOT EXISTS raw_property_listings (
@@ -148,70 +442,582 @@ def init_search_urls(db: DatabaseClient):
         FOREIGN KEY (url) REFERENCES search_page_urls(url)
     );
     """
-    db.init(raw_property_listings)
-    logger.info("Created raw_property_listings table")
-    db.init(house_data)
-    logger.info("Created house table")
-    db.init(house_page_content)
-    logger.info("Created raw_page_content table")
     db.init(search_page_urls)
     logger.info("Created search_page_urls table")
+    db.init(house_page_content)
+    db.init(fetch_backend)
+    logger.info("Created raw_page_content table")
+    db.init(raw_property_listings)
+    logger.info("Created raw_property_listings table")
+    create_work_state(db)
+    logger.info("Created home_type, area and state columns")
+    create_property_listings(db)
+    logger.info("Created property_listing table")
+    create_listing_history(db)
+    logger.info("Created listing_history table and revisit columns")
+    create_extraction_cache(db)
+    logger.info("Created llm_extraction_cache table")
+    create_token_usage(db)
+    logger.info("Created llm_token_usage table")
+    create_dead_letter(db)
+    logger.info("Created llm_dead_letter table")
 
 
-def create_property_listings(db: DatabaseClient):
-    query = """
-    CREATE OR REPLACE VIEW property_listing AS 
-    SELECT 
+def create_extraction_cache(db: DatabaseClient):
+    extraction_cache = """
+    CREATE TABLE IF NOT EXISTS llm_extraction_cache (
+        key CHAR(64) PRIMARY KEY,
+        model TEXT,
+        prompt_hash CHAR(64),
+        schema JSONB,
+        hits INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        last_used_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """
+    db.init(extraction_cache)
+
+
+token_usage_columns = [
+    "url",
+    "model",
+    "requests",
+    "prompt_tokens",
+    "completion_tokens",
+    "total_tokens",
+]
+
+
+def create_token_usage(db: DatabaseClient):
+    """
+    Table of the LLM requests and tokens spent per listing and model, one row per
+    extraction so repeated parses of a listing add up
+    """
+    token_usage = """
+    CREATE TABLE IF NOT EXISTS llm_token_usage (
+        id SERIAL PRIMARY KEY,
+        url VARCHAR(255),
+        model TEXT,
+        requests INTEGER,
+        prompt_tokens INTEGER,
+        completion_tokens INTEGER,
+        total_tokens INTEGER,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS llm_token_usage_model_idx
+        ON llm_token_usage (model, created_at);
+    """
+    db.init(token_usage)
+
+
+dead_letter_columns = ["url", "model", "reason", "output"]
+
+
+def create_dead_letter(db: DatabaseClient):
+    """
+    Table of the extractions that failed after local JSON repair and re-asking
+    for the invalid fields, with the last model output for inspection. A trigger
+    moves the search_page_urls of a scraped page that is dead-lettered to the
+    failed state, so it is not claimed or exported for parsing again. Set their
+    state back to scraped to retry them.
+    """
+    dead_letter = """
+    CREATE TABLE IF NOT EXISTS llm_dead_letter (
+        id SERIAL PRIMARY KEY,
+        url VARCHAR(255),
+        model TEXT,
+        reason TEXT,
+        output TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    """
+    db.init(dead_letter)
+
+    trigger = """
+    CREATE OR REPLACE FUNCTION fundai_mark_failed() RETURNS TRIGGER AS $$
+    BEGIN
+        UPDATE search_page_urls s
+        SET state = 'failed', claimed_by = NULL, lease_until = NULL
+        FROM new_rows n WHERE s.url = n.url AND s.state = 'scraped';
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS search_page_urls_failed ON llm_dead_letter;
+    CREATE TRIGGER search_page_urls_failed
+        AFTER INSERT ON llm_dead_letter
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION fundai_mark_failed();
+    """
+    db.execute(trigger)
+
+
+page_compression_methods = ("lz4", "pglz")
+
+
+def compress_raw_pages(
+    db: DatabaseClient,
+    method: str = "lz4",
+    batch_size: int = 1000,
+    vacuum_full: bool = False,
+) -> int:
+    """
+    Store raw_page_content.page_content with the given TOAST compression method,
+    and recompress the existing rows, which keep the method they were written with.
+    Postgres decompresses the column transparently, so readers are unaffected.
+    lz4 needs a server built with lz4 support, pglz is the Postgres default.
+    :param method: lz4 or pglz
+    :param batch_size: rows rewritten per statement
+    :param vacuum_full: rewrite the table afterwards to return the freed space to
+        the OS, this locks the table while it runs
+    :return: number of recompressed rows
+    """
+    if method not in page_compression_methods:
+        raise ValueError(f"Unknown compression method {method}")
+    size_query = "SELECT pg_total_relation_size('raw_page_content')"
+    size_before = db.read(size_query)[0][0]
+    db.execute(f"""
+        ALTER TABLE raw_page_content
+            ALTER COLUMN page_content SET STORAGE EXTENDED,
+            ALTER COLUMN page_content SET COMPRESSION {method}
+        """)
+    # concatenating forces a new datum, compressed with the column's method;
+    # walk the urls once so pages that cannot be compressed are not rewritten again
+    rewrite = f"""
+    WITH batch AS (
+        SELECT url, pg_column_compression(page_content) AS compression
+        FROM raw_page_content
+        WHERE url > %s
+        ORDER BY url
+        LIMIT {batch_size}
+    ), rewritten AS (
+        UPDATE raw_page_content c
+        SET page_content = c.page_content || ''
+        FROM batch
+        WHERE c.url = batch.url
+            AND batch.compression IS DISTINCT FROM %s
+            AND octet_length(c.page_content) > 2000
+        RETURNING c.url
+    )
+    SELECT (SELECT max(url) FROM batch), (SELECT count(*) FROM rewritten)
+    """
+    last_url, recompressed = "", 0
+    while True:
+        with db.connection() as conn, conn.cursor() as cur:
+            cur.execute(rewrite, [last_url, method])
+            last_url, n_rows = cur.fetchone()
+        if last_url is None:
+            break
+        recompressed += n_rows
+    db.execute(f"VACUUM {'FULL ' if vacuum_full else ''}ANALYZE raw_page_content")
+    size_after = db.read(size_query)[0][0]
+    logger.info(
+        f"Recompressed {recompressed} pages with {method}, raw_page_content went "
+        f"from {size_before / 2**20:.1f} MiB to {size_after / 2**20:.1f} MiB"
+    )
+    return recompressed
+
+
+def create_work_state(db: DatabaseClient):
+    """
+    Add indexed home_type, area and state columns to search_page_urls so pending
+    work is found with an index lookup instead of LIKE '%/koop/rotterdam/%' scans.
+    home_type and area are generated from the URL, state moves from new to scraped
+    to parsed through triggers on raw_page_content and raw_property_listings, and
+    from scraped to failed when the extraction is dead-lettered (see
+    create_dead_letter).
+    claimed_by, lease_until and attempts hold the leases of fundai.workqueue, a
+    change of state releases the lease.
+    Safe to run on an existing database, existing rows are backfilled.
+    """
+    columns = """
+    ALTER TABLE search_page_urls
+        ADD COLUMN IF NOT EXISTS home_type TEXT
+            GENERATED ALWAYS AS (split_part(url, '/', 4)) STORED,
+        ADD COLUMN IF NOT EXISTS area TEXT
+            GENERATED ALWAYS AS (split_part(url, '/', 5)) STORED,
+        ADD COLUMN IF NOT EXISTS state VARCHAR(16) NOT NULL DEFAULT 'new',
+        ADD COLUMN IF NOT EXISTS claimed_by TEXT,
+        ADD COLUMN IF NOT EXISTS lease_until TIMESTAMPTZ,
+        ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
+    CREATE INDEX IF NOT EXISTS search_page_urls_work_idx
+        ON search_page_urls (home_type, area, state);
+    """
+    db.execute(columns)
+
+    triggers = """
+    CREATE OR REPLACE FUNCTION fundai_mark_scraped() RETURNS TRIGGER AS $$
+    BEGIN
+        UPDATE search_page_urls s
+        SET state = 'scraped', claimed_by = NULL, lease_until = NULL, attempts = 0
+        FROM new_rows n WHERE s.url = n.url AND s.state = 'new';
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION fundai_mark_parsed() RETURNS TRIGGER AS $$
+    BEGIN
+        UPDATE search_page_urls s
+        SET state = 'parsed', claimed_by = NULL, lease_until = NULL, attempts = 0
+        FROM new_rows n WHERE s.url = n.url AND s.state <> 'parsed';
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION fundai_mark_unparsed() RETURNS TRIGGER AS $$
+    BEGIN
+        UPDATE search_page_urls s SET state = 'scraped', attempts = 0
+        FROM old_rows o WHERE s.url = o.url AND s.state = 'parsed';
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS search_page_urls_scraped ON raw_page_content;
+    CREATE TRIGGER search_page_urls_scraped
+        AFTER INSERT ON raw_page_content
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION fundai_mark_scraped();
+
+    DROP TRIGGER IF EXISTS search_page_urls_parsed ON raw_property_listings;
+    CREATE TRIGGER search_page_urls_parsed
+        AFTER INSERT ON raw_property_listings
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION fundai_mark_parsed();
+
+    DROP TRIGGER IF EXISTS search_page_urls_unparsed ON raw_property_listings;
+    CREATE TRIGGER search_page_urls_unparsed
+        AFTER DELETE ON raw_property_listings
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION fundai_mark_unparsed();
+    """
+    db.execute(triggers)
+
+    backfill = """
+    UPDATE search_page_urls s
+    SET state = actual.state
+    FROM (
+        SELECT
+            u.url,
+            CASE
+                WHEN EXISTS (SELECT 1 FROM raw_property_listings r WHERE r.url = u.url)
+                    THEN 'parsed'
+                WHEN u.state = 'failed' THEN 'failed'
+                WHEN EXISTS (SELECT 1 FROM raw_page_content c WHERE c.url = u.url)
+                    THEN 'scraped'
+                ELSE 'new'
+            END AS state
+        FROM search_page_urls u
+    ) actual
+    WHERE actual.url = s.url AND actual.state <> s.state
+    """
+    db.execute(backfill)
+
+
+# Typed columns of property_listing, in the order of fundai.utils.prompt_template
+property_listing_columns = [
+    ("address", "TEXT"),
+    ("postal_code", "TEXT"),
+    ("city", "TEXT"),
+    ("neighborhood", "TEXT"),
+    ("living_area", "INTEGER"),
+    ("bedrooms", "INTEGER"),
+    ("price", "INTEGER"),
+    ("price_per_m2", "INTEGER"),
+    ("description", "TEXT"),
+    ("asking_price", "INTEGER"),
+    ("asking_price_per_m2", "INTEGER"),
+    ("status", "TEXT"),
+    ("acceptance", "TEXT"),
+    ("vve_contribution", "NUMERIC"),
+    ("type_of_apartment", "TEXT"),
+    ("type_of_construction", "TEXT"),
+    ("year_of_construction", "INTEGER"),
+    ("accessibility", "TEXT"),
+    ("living_area_m2", "INTEGER"),
+    ("volume", "INTEGER"),
+    ("number_of_rooms", "INTEGER"),
+    ("number_of_bedrooms", "INTEGER"),
+    ("number_of_bathrooms", "INTEGER"),
+    ("bathroom_facilities", "TEXT"),
+    ("number_of_floors", "INTEGER"),
+    ("located_on", "TEXT"),
+    ("facilities", "TEXT"),
+    ("energy_label", "TEXT"),
+    ("insulation", "TEXT"),
+    ("heating", "TEXT"),
+    ("hot_water", "TEXT"),
+    ("boiler_brand", "TEXT"),
+    ("boiler_type", "TEXT"),
+    ("boiler_ownership", "TEXT"),
+    ("cadastral_number", "TEXT"),
+    ("ownership_status", "TEXT"),
+    ("type_of_parking", "TEXT"),
+    ("registered_with_chamber_of_commerce", "BOOLEAN"),
+    ("annual_meeting", "BOOLEAN"),
+    ("periodic_contribution", "BOOLEAN"),
+    ("reserve_fund", "BOOLEAN"),
+    ("maintenance_plan", "BOOLEAN"),
+    ("building_insurance", "BOOLEAN"),
+    ("agency_name", "TEXT"),
+    ("phone_number", "TEXT"),
+]
+
+property_listing_indexed_columns = [
+    "city",
+    "neighborhood",
+    "postal_code",
+    "price",
+    "living_area",
+]
+# expressions filtered on by fundai.dashboard, which the column indexes cannot serve
+property_listing_indexed_expressions = {
+    "city_lower": "lower(city)",
+    "asking_price_or_price": "coalesce(asking_price, price)",
+}
+
+_cast_functions = {
+    "TEXT": "",
+    "INTEGER": "fundai_to_int",
+    "NUMERIC": "fundai_to_numeric",
+    "BOOLEAN": "fundai_to_bool",
+}
+
+
+def _upsert_property_listing_query(source: str) -> str:
+    """
+    Upsert the typed version of every raw_property_listings row in source
+    :param source: table or subquery with the columns of raw_property_listings
+    """
+    names = [name for name, _ in property_listing_columns]
+    expressions = [
+        f"{_cast_functions[kind]}(raw_data->>'{name}')"
+        for name, kind in property_listing_columns
+    ]
+    updates = ", ".join(
+        f"{c} = EXCLUDED.{c}" for c in ["url", *names, "raw_hash", "refreshed_at"]
+    )
+    return f"""
+    INSERT INTO property_listing (id, url, {", ".join(names)}, raw_hash, refreshed_at)
+    SELECT
         id,
         url,
-        raw_data->>'address' AS address,
-        raw_data->>'postal_code' AS postal_code,
-        raw_data->>'city' AS city,
-        raw_data->>'neighborhood' AS neighborhood,
-        (raw_data->>'living_area')::INTEGER AS living_area,
-        (raw_data->>'bedrooms')::INTEGER AS bedrooms,
-        (raw_data->>'price')::INTEGER AS price,
-        (raw_data->>'price_per_m2')::INTEGER AS price_per_m2,
-        raw_data->>'description' AS description,
-        (raw_data->>'asking_price')::INTEGER AS asking_price,
-        (raw_data->>'asking_price_per_m2')::INTEGER AS asking_price_per_m2,
-        raw_data->>'status' AS status,
-        raw_data->>'acceptance' AS acceptance,
-        (raw_data->>'vve_contribution')::NUMERIC AS vve_contribution,
-        raw_data->>'type_of_apartment' AS type_of_apartment,
-        raw_data->>'type_of_construction' AS type_of_construction,
-        (raw_data->>'year_of_construction')::INTEGER AS year_of_construction,
-        raw_data->>'accessibility' AS accessibility,
-        (raw_data->>'living_area_m2')::INTEGER AS living_area_m2,
-        (raw_data->>'volume')::INTEGER AS volume,
-        (raw_data->>'number_of_rooms')::INTEGER AS number_of_rooms,
-        (raw_data->>'number_of_bedrooms')::INTEGER AS number_of_bedrooms,
-        (raw_data->>'number_of_bathrooms')::INTEGER AS number_of_bathrooms,
-        raw_data->>'bathroom_facilities' AS bathroom_facilities,
-        (raw_data->>'number_of_floors')::INTEGER AS number_of_floors,
-        raw_data->>'located_on' AS located_on,
-        raw_data->>'facilities' AS facilities,
-        raw_data->>'energy_label' AS energy_label,
-        raw_data->>'insulation' AS insulation,
-        raw_data->>'heating' AS heating,
-        raw_data->>'hot_water' AS hot_water,
-        raw_data->>'boiler_brand' AS boiler_brand,
-        raw_data->>'boiler_type' AS boiler_type,
-        raw_data->>'boiler_ownership' AS boiler_ownership,
-        raw_data->>'cadastral_number' AS cadastral_number,
-        raw_data->>'ownership_status' AS ownership_status,
-        raw_data->>'type_of_parking' AS type_of_parking,
-        (raw_data->>'registered_with_chamber_of_commerce')::BOOLEAN AS registered_with_chamber_of_commerce,
-        (raw_data->>'annual_meeting')::BOOLEAN AS annual_meeting,
-        (raw_data->>'periodic_contribution')::BOOLEAN AS periodic_contribution,
-        (raw_data->>'reserve_fund')::BOOLEAN AS reserve_fund,
-        (raw_data->>'maintenance_plan')::BOOLEAN AS maintenance_plan,
-        (raw_data->>'building_insurance')::BOOLEAN AS building_insurance,
-        raw_data->>'agency_name' AS agency_name,
-        raw_data->>'phone_number' AS phone_number
-    FROM raw_property_listings 
-    """
-    db.execute(query)
+        {", ".join(expressions)},
+        md5(raw_data::text),
+        now()
+    FROM {source}
+    ON CONFLICT (id) DO UPDATE SET {updates}
+    """
+
+
+def create_property_listings(db: DatabaseClient):
+    """
+    Create the typed property_listing table, kept up to date with
+    raw_property_listings by statement level triggers. Replaces the former
+    property_listing view, which re-cast the JSONB on every query.
+    """
+    drop_view = """
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM pg_views WHERE viewname = 'property_listing') THEN
+            DROP VIEW property_listing;
+        END IF;
+    END $$;
+    """
+    db.execute(drop_view)
+
+    # Lenient casts, the LLM returns values such as "€ 435.000 k.k.", "92 m²" or "Ja"
+    cast_functions = r"""
+    CREATE OR REPLACE FUNCTION fundai_to_numeric(value TEXT) RETURNS NUMERIC AS $$
+        SELECT CASE
+            WHEN value ~ '^\s*-?[0-9]+(\.[0-9]+)?\s*$' THEN value::NUMERIC
+            ELSE replace(
+                replace(substring(value FROM '[0-9][0-9.]*(?:,[0-9]+)?'), '.', ''),
+                ',', '.'
+            )::NUMERIC
+        END
+    $$ LANGUAGE SQL IMMUTABLE;
+
+    -- NULL outside the INTEGER range, an overflow would abort the whole statement
+    -- of the trigger, and with it every row of a COPY batch
+    CREATE OR REPLACE FUNCTION fundai_to_int(value TEXT) RETURNS INTEGER AS $$
+        SELECT CASE WHEN abs(n) <= 2147483647 THEN round(n)::INTEGER END
+        FROM fundai_to_numeric(value) n
+    $$ LANGUAGE SQL IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION fundai_to_bool(value TEXT) RETURNS BOOLEAN AS $$
+        SELECT CASE
+            WHEN lower(value) ~ '^\s*(true|ja|yes|t|1)' THEN TRUE
+            WHEN lower(value) ~ '^\s*(false|nee|no|f|0)' THEN FALSE
+        END
+    $$ LANGUAGE SQL IMMUTABLE;
+    """
+    db.execute(cast_functions)
+
+    columns = ",\n        ".join(
+        f"{name} {kind}" for name, kind in property_listing_columns
+    )
+    table = f"""
+    CREATE TABLE IF NOT EXISTS property_listing (
+        id INTEGER PRIMARY KEY,
+        url TEXT,
+        {columns},
+        raw_hash TEXT,
+        refreshed_at TIMESTAMPTZ
+    )
+    """
+    db.execute(table)
+    for column in property_listing_indexed_columns:
+        db.execute(
+            f"CREATE INDEX IF NOT EXISTS property_listing_{column}_idx "
+            f"ON property_listing ({column})"
+        )
+    for name, expression in property_listing_indexed_expressions.items():
+        db.execute(
+            f"CREATE INDEX IF NOT EXISTS property_listing_{name}_idx "
+            f"ON property_listing (({expression}))"
+        )
+
+    triggers = f"""
+    CREATE OR REPLACE FUNCTION fundai_upsert_property_listing() RETURNS TRIGGER AS $$
+    BEGIN
+        {_upsert_property_listing_query("new_rows")};
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION fundai_delete_property_listing() RETURNS TRIGGER AS $$
+    BEGIN
+        DELETE FROM property_listing WHERE id IN (SELECT id FROM old_rows);
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS property_listing_insert ON raw_property_listings;
+    CREATE TRIGGER property_listing_insert
+        AFTER INSERT ON raw_property_listings
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION fundai_upsert_property_listing();
+
+    DROP TRIGGER IF EXISTS property_listing_update ON raw_property_listings;
+    CREATE TRIGGER property_listing_update
+        AFTER UPDATE ON raw_property_listings
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION fundai_upsert_property_listing();
+
+    DROP TRIGGER IF EXISTS property_listing_delete ON raw_property_listings;
+    CREATE TRIGGER property_listing_delete
+        AFTER DELETE ON raw_property_listings
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION fundai_delete_property_listing();
+    """
+    db.execute(triggers)
+
+
+def refresh_property_listings(db: DatabaseClient):
+    """
+    Bring property_listing up to date for raw rows that are new or changed since
+    the last refresh, e.g. rows written before the triggers existed. Unchanged rows
+    are left untouched.
+    """
+    changed = """
+    (
+        SELECT raw.*
+        FROM raw_property_listings raw
+        LEFT JOIN property_listing pl ON pl.id = raw.id
+        WHERE pl.id IS NULL OR pl.raw_hash IS DISTINCT FROM md5(raw.raw_data::text)
+    ) AS changed
+    """
+    db.execute(_upsert_property_listing_query(changed))
+    db.execute("""
+        DELETE FROM property_listing pl
+        WHERE NOT EXISTS (SELECT 1 FROM raw_property_listings raw WHERE raw.id = pl.id)
+        """)
+    logger.info("Refreshed property_listing")
+
+
+def create_listing_history(db: DatabaseClient):
+    """
+    Add the revisit columns to raw_page_content and create listing_history, the
+    versions of price, asking_price and status of every listing. A version is
+    appended by triggers on raw_property_listings whenever one of them changes,
+    existing listings get their first version here. Needs the cast functions of
+    create_property_listings.
+    content_hash is the sha256 of the post processed page (see fundai.revisit),
+    last_checked_at when the page was last scraped or revisited.
+    """
+    revisit_columns = """
+    ALTER TABLE raw_page_content
+        ADD COLUMN IF NOT EXISTS content_hash CHAR(64),
+        ADD COLUMN IF NOT EXISTS last_checked_at TIMESTAMPTZ DEFAULT now();
+    CREATE INDEX IF NOT EXISTS raw_page_content_checked_idx
+        ON raw_page_content (last_checked_at);
+    """
+    db.execute(revisit_columns)
+
+    history = """
+    CREATE TABLE IF NOT EXISTS listing_history (
+        id SERIAL PRIMARY KEY,
+        url VARCHAR(255) NOT NULL,
+        version INTEGER NOT NULL,
+        price INTEGER,
+        asking_price INTEGER,
+        status TEXT,
+        observed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        UNIQUE (url, version)
+    );
+
+    CREATE OR REPLACE FUNCTION fundai_append_listing_history() RETURNS TRIGGER AS $$
+    BEGIN
+        INSERT INTO listing_history (url, version, price, asking_price, status)
+        SELECT n.url, coalesce(h.version, 0) + 1, n.price, n.asking_price, n.status
+        FROM (
+            SELECT
+                url,
+                fundai_to_int(raw_data->>'price') AS price,
+                fundai_to_int(raw_data->>'asking_price') AS asking_price,
+                raw_data->>'status' AS status
+            FROM new_rows
+        ) n
+        LEFT JOIN LATERAL (
+            SELECT version, price, asking_price, status
+            FROM listing_history l
+            WHERE l.url = n.url
+            ORDER BY version DESC
+            LIMIT 1
+        ) h ON TRUE
+        WHERE h.version IS NULL
+            OR (h.price, h.asking_price, h.status)
+                IS DISTINCT FROM (n.price, n.asking_price, n.status);
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS listing_history_insert ON raw_property_listings;
+    CREATE TRIGGER listing_history_insert
+        AFTER INSERT ON raw_property_listings
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION fundai_append_listing_history();
+
+    DROP TRIGGER IF EXISTS listing_history_update ON raw_property_listings;
+    CREATE TRIGGER listing_history_update
+        AFTER UPDATE ON raw_property_listings
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION fundai_append_listing_history();
+    """
+    db.execute(history)
+
+    backfill = """
+    INSERT INTO listing_history (url, version, price, asking_price, status)
+    SELECT
+        url,
+        1,
+        fundai_to_int(raw_data->>'price'),
+        fundai_to_int(raw_data->>'asking_price'),
+        raw_data->>'status'
+    FROM raw_property_listings r
+    WHERE NOT EXISTS (SELECT 1 FROM listing_history l WHERE l.url = r.url)
+    """
+    db.execute(backfill)
 
 
 def clean_raw_propert_listings(db: DatabaseClient):
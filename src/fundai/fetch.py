@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable
+
+import httpx
+
+from fundai.browser import BrowserPool, LoadProfile, ua
+from fundai.politeness import (
+    AimdScheduler,
+    PageBlocked,
+    detect_block,
+    parse_retry_after,
+    throttle_statuses,
+)
+
+logger = logging.getLogger(__name__)
+
+# a list item whose text starts with Volgende, "* Volgende" after html_to_text
+_pager_marker = re.compile(r"<li\b[^>]*>(?:\s*<[^/][^>]*>)*\s*Volgende\b")
+# Bewaren as the text of an element
+_listing_marker = re.compile(r">\s*Bewaren\s*<")
+
+
+def has_expected_content(url: str, html: str) -> bool:
+    """
+    Whether a page fetched without a browser holds the content the pipeline needs:
+    the pager read by get_max_page on search pages, the "Bewaren" marker used by
+    post_process_pages on listing pages. Searches the raw html for the elements
+    html_to_text turns into these markers, converting every response to text on
+    the event loop would block it for far longer than the request took.
+    """
+    if "/zoeken/" in url:
+        return _pager_marker.search(html) is not None
+    return _listing_marker.search(html) is not None
+
+
+class HttpFetcher:
+    """
+    Fetch pages with a pooled async HTTP client, keeping connections alive between
+    requests and multiplexing them over HTTP/2.
+    """
+
+    def __init__(self, concurrency: int = 8, timeout: float = 30.0) -> None:
+        self.concurrency = concurrency
+        self.client = httpx.AsyncClient(
+            http2=True,
+            timeout=timeout,
+            follow_redirects=True,
+            headers={"User-Agent": ua, "Accept-Language": "nl-NL,nl;q=0.9"},
+            limits=httpx.Limits(
+                max_connections=concurrency, max_keepalive_connections=concurrency
+            ),
+        )
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(self, url: str) -> str:
+        async with self._semaphore:
+            response = await self.client.get(url)
+        response.raise_for_status()
+        return response.text
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class HybridFetcher:
+    """
+    Fetch pages over plain HTTP and only render them in Chromium when the response
+    fails content_check. The browser is launched on the first fallback, so crawls
+    served fully over HTTP never start it. The backend that served each URL is kept
+    in served_by until it is taken with pop_backend. Throttling statuses (403 and
+    429, see throttle_statuses) are raised as PageBlocked instead, rendering the
+    page would only add to the load the site complains about.
+    """
+
+    def __init__(
+        self,
+        http: HttpFetcher,
+        browser: BrowserPool | None = None,
+        content_check: Callable[[str, str], bool] = has_expected_content,
+        profile: str | LoadProfile = "lean",
+    ) -> None:
+        self.http = http
+        self.concurrency = http.concurrency
+        self.content_check = content_check
+        self._browser = browser
+        self._owns_browser = browser is None
+        self.profile = profile
+        self._browser_lock = asyncio.Lock()
+        self.served_by: dict[str, str] = {}
+        self.stats: Counter = Counter()
+
+    async def browser(self) -> BrowserPool:
+        async with self._browser_lock:
+            if self._browser is None:
+                self._browser = await BrowserPool(
+                    concurrency=self.concurrency, profile=self.profile
+                ).start()
+        return self._browser
+
+    async def fetch(self, url: str) -> str:
+        try:
+            html = await self.http.fetch(url)
+            if self.content_check(url, html):
+                self._record(url, "http")
+                return html
+            logger.info(f"{url} failed the content check, rendering it in Chromium")
+        except httpx.HTTPStatusError as err:
+            status = err.response.status_code
+            if status in throttle_statuses:
+                retry_after = err.response.headers.get("retry-after")
+                raise PageBlocked(
+                    url, f"status_{status}", parse_retry_after(retry_after)
+                ) from err
+            logger.info(f"HTTP fetch of {url} failed ({err}), rendering it in Chromium")
+        except httpx.HTTPError as err:
+            logger.info(f"HTTP fetch of {url} failed ({err}), rendering it in Chromium")
+        html = await (await self.browser()).fetch(url)
+        self._record(url, "browser")
+        return html
+
+    def _record(self, url: str, backend: str):
+        self.served_by[url] = backend
+        self.stats[backend] += 1
+
+    def pop_backend(self, url: str) -> str | None:
+        return self.served_by.pop(url, None)
+
+    async def close(self):
+        await self.http.close()
+        if self._browser is not None and self._owns_browser:
+            await self._browser.close()
+        logger.info(f"Pages served per backend: {dict(self.stats)}")
+
+
+class PoliteFetcher:
+    """
+    Fetch through another fetcher, scheduling the pages of every host with an
+    AimdScheduler so the crawl runs as fast as the site tolerates. Captcha and
+    error pages are raised as PageBlocked instead of returned as content, and the
+    backend recorded for them is dropped. Failed pages are tried again after a
+    backoff, at most max_retries times, before the error is raised.
+    """
+
+    def __init__(
+        self,
+        fetcher: BrowserPool | HybridFetcher,
+        scheduler: AimdScheduler | None = None,
+        max_retries: int = 2,
+        retry_delay: float = 5.0,
+    ) -> None:
+        """
+        :param fetcher: fetcher doing the requests, its concurrency stays the
+            limit over all hosts
+        :param retry_delay: seconds before the first retry of a failed page,
+            doubling with every retry, blocked pages wait for their host instead
+        """
+        self.fetcher = fetcher
+        self.concurrency = fetcher.concurrency
+        self.scheduler = scheduler or AimdScheduler(max_limit=fetcher.concurrency)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.stats: Counter = Counter()
+
+    async def fetch(self, url: str) -> str:
+        for attempt in range(self.max_retries + 1):
+            async with self.scheduler.slot(url):
+                start = time.perf_counter()
+                try:
+                    html = await self.fetcher.fetch(url)
+                    reason = detect_block(html)
+                    if reason is not None:
+                        raise PageBlocked(url, reason)
+                except Exception as err:
+                    # the page may have been served and recorded before the check
+                    self.fetcher.pop_backend(url)
+                    self.scheduler.record(url, time.perf_counter() - start, err)
+                    blocked = isinstance(err, PageBlocked)
+                    self.stats["blocked" if blocked else "failed"] += 1
+                    if attempt == self.max_retries:
+                        raise
+                    logger.warning(f"Fetching {url} failed ({err}), retrying")
+                else:
+                    self.scheduler.record(url, time.perf_counter() - start)
+                    self.stats["fetched"] += 1
+                    return html
+            self.stats["retried"] += 1
+            if not blocked:
+                await asyncio.sleep(self.retry_delay * 2**attempt)
+
+    def pop_backend(self, url: str) -> str | None:
+        return self.fetcher.pop_backend(url)
+
+    async def close(self):
+        limits = {host: round(s.limit, 1) for host, s in self.scheduler.hosts.items()}
+        logger.info(f"Polite fetches: {dict(self.stats)}, final limits: {limits}")
+
+
+Fetcher = BrowserPool | HybridFetcher | PoliteFetcher
+
+
+@asynccontextmanager
+async def open_fetcher(
+    backend: str = "auto", concurrency: int = 4, load_profile: str = "lean"
+) -> AsyncIterator[Fetcher]:
+    """
+    Open the fetcher used by the scrape commands
+    :param backend: "auto" for HTTP with browser fallback, "browser" for Chromium only
+    :param concurrency: number of pages fetched at the same time
+    :param load_profile: fundai.browser.load_profiles entry Chromium loads pages with
+    :return: the fetcher, scheduling its requests with a PoliteFetcher
+    """
+    if backend == "browser":
+        async with BrowserPool(concurrency=concurrency, profile=load_profile) as pool:
+            fetcher = PoliteFetcher(pool)
+            try:
+                yield fetcher
+            finally:
+                await fetcher.close()
+    elif backend == "auto":
+        fetcher = PoliteFetcher(
+            HybridFetcher(HttpFetcher(concurrency=concurrency), profile=load_profile)
+        )
+        try:
+            yield fetcher
+        finally:
+            await fetcher.close()
+            await fetcher.fetcher.close()
+    else:
+        raise ValueError(f"Unknown fetch backend {backend}")
@@ -0,0 +1,403 @@
+import asyncio
+import logging
+import random
+import re
+import time
+from typing import Any, Mapping
+
+from fundai.metrics import metrics
+from fundai.repair import coerce_schema, prompt_fields, repair_json
+from fundai.rules import build_prompt
+from fundai.utils import prompt_template, model_name
+
+logger = logging.getLogger(__name__)
+
+
+class ExtractionError(ValueError):
+    """
+    No valid schema could be obtained for a page
+    :param reason: invalid_json when no answer held a JSON object
+    :param output: last output of the model
+    """
+
+    def __init__(self, url: str, reason: str, output: str) -> None:
+        super().__init__(f"No valid schema obtained for {url}: {reason}")
+        self.url = url
+        self.reason = reason
+        self.output = output
+
+
+def dead_letter_row(url: str, model: str, err: Exception) -> tuple[str, str, str, str]:
+    """
+    Row of llm_dead_letter for a page whose extraction failed with err
+    """
+    if isinstance(err, ExtractionError):
+        return url, model, err.reason, err.output
+    return url, model, "request_failed", str(err)
+
+
+class SchemaAnswers:
+    """
+    Data schema of one page assembled from at most max_attempts answers of the
+    model. Invalid JSON is repaired locally and only asked again when it cannot
+    be, values are coerced to the types of the prompt and fields left invalid are
+    asked again on their own. Shared by the sync and async extraction paths,
+    which send next_prompt until it is None.
+    """
+
+    def __init__(
+        self, url: str, prompt: str = prompt_template, max_attempts: int = 3
+    ) -> None:
+        self.url = url
+        self.max_attempts = max_attempts
+        self.fields = prompt_fields(prompt)
+        self.ask_fields = self.fields
+        self.next_prompt: str | None = prompt if max_attempts > 0 else None
+        self.attempts = 0
+        self.schema: dict[str, Any] | None = None
+        self.output = ""
+
+    def add(self, output: str) -> str | None:
+        """
+        Take the answer to next_prompt
+        :return: why the model is asked again, "invalid_json" or "invalid_fields",
+            None when it is not
+        """
+        self.attempts += 1
+        self.output = output
+        retry = self.attempts < self.max_attempts
+        try:
+            answer = repair_json(output)
+        except ValueError as err:
+            logger.error(
+                f"Parsing data schema of {self.url} failed, "
+                f"retry number: {self.attempts - 1}: {err}"
+            )
+            if not retry:
+                self.next_prompt = None
+                return None
+            return "invalid_json"
+        self.next_prompt = None
+        if not self.fields:
+            self.schema = answer
+            return None
+        coerced, invalid = coerce_schema(answer, self.ask_fields)
+        self.schema = {**(self.schema or {}), **coerced}
+        if not invalid:
+            return None
+        if retry:
+            logger.warning(f"Asking again for invalid fields of {self.url}: {invalid}")
+            self.ask_fields = {field: self.fields[field] for field in invalid}
+            self.next_prompt = build_prompt(invalid)
+            return "invalid_fields"
+        logger.warning(f"Invalid fields of {self.url} left empty: {invalid}")
+        for field in invalid:
+            metrics.inc("fundai_llm_invalid_fields_total", field=field)
+        return None
+
+    def result(self) -> dict[str, Any]:
+        """
+        :return: data schema, fields still invalid after max_attempts answers are None
+        :raises ExtractionError: when no answer held a JSON object
+        """
+        if self.schema is None:
+            raise ExtractionError(self.url, "invalid_json", self.output)
+        return self.schema
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token estimate used for rate limiting, about four characters per token
+    """
+    return len(text) // 4 + 1
+
+
+def parse_reset(value: str | None) -> float:
+    """
+    Parse the reset durations of the OpenAI rate limit headers, e.g. "1s", "6m0s" or "20ms",
+    plain seconds such as a retry-after value are accepted as well
+    :param value: header value
+    :return: duration in seconds
+    """
+    if not value:
+        return 0.0
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    seconds = 0.0
+    for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value):
+        seconds += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return seconds
+
+
+def backoff_delay(
+    attempt: int,
+    base_backoff: float = 1.0,
+    max_backoff: float = 60.0,
+    retry_after: float = 0.0,
+) -> float:
+    """
+    Exponential backoff with full jitter, never shorter than the server's retry-after
+    :param attempt: number of retries before this one
+    """
+    cap = min(max_backoff, base_backoff * 2**attempt)
+    return max(retry_after, random.uniform(0, cap))
+
+
+def retry_reason(err: Exception) -> str | None:
+    """
+    Why a failed request of an OpenAI compatible client is worth retrying
+    :return: "connection", "rate_limit" or "server", None when it is not
+    """
+    from openai import APIConnectionError, APIStatusError
+
+    if isinstance(err, APIConnectionError):
+        return "connection"
+    if isinstance(err, APIStatusError):
+        if err.status_code == 429:
+            return "rate_limit"
+        if err.status_code >= 500:
+            return "server"
+    return None
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at `per_minute` tokens per minute
+    """
+
+    def __init__(self, per_minute: int) -> None:
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60
+        self.tokens = float(per_minute)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    async def acquire(self, amount: float = 1):
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def adjust(self, amount: float):
+        """
+        Give back (positive) or take (negative) tokens after the real usage is known
+        """
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def sync(self, remaining: float | None, reset: float):
+        """
+        Align the bucket with the remaining budget reported by the server
+        """
+        if remaining is None:
+            return
+        self._refill()
+        self.tokens = min(self.tokens, remaining)
+        if remaining <= 0 and reset > 0:
+            self._paused_until = time.monotonic() + reset
+
+
+class RateLimiter:
+    """
+    Combined requests/minute and tokens/minute limiter
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int) -> None:
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    async def acquire(self, n_tokens: int):
+        await self.requests.acquire(1)
+        await self.tokens.acquire(n_tokens)
+
+    def update_from_headers(self, headers: Mapping[str, str]):
+        def _int(name: str) -> int | None:
+            value = headers.get(name)
+            try:
+                return int(value) if value is not None else None
+            except ValueError:
+                return None
+
+        self.requests.sync(
+            _int("x-ratelimit-remaining-requests"),
+            parse_reset(headers.get("x-ratelimit-reset-requests")),
+        )
+        self.tokens.sync(
+            _int("x-ratelimit-remaining-tokens"),
+            parse_reset(headers.get("x-ratelimit-reset-tokens")),
+        )
+
+
+class AsyncExtractor:
+    """
+    Extract data schemas from page contents with an async OpenAI compatible client,
+    bounded by a concurrency limit and requests/tokens per minute budgets.
+    When a cache (see fundai.cache.ExtractionCache) is given, pages seen before
+    skip the API call. The token usage of every URL is kept in usage until it is
+    taken with pop_usage.
+    Answers are repaired and coerced locally (see fundai.repair), only the fields
+    that hold invalid values are asked again, at most max_attempts answers per page.
+    """
+
+    def __init__(
+        self,
+        client,
+        concurrency: int = 8,
+        requests_per_minute: int = 500,
+        tokens_per_minute: int = 200_000,
+        max_retries: int = 10,
+        max_attempts: int = 3,
+        max_completion_tokens: int = 1_000,
+        base_backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        model: str = model_name,
+        cache=None,
+    ) -> None:
+        self.client = client
+        self.cache = cache
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.max_retries = max_retries
+        self.max_attempts = max_attempts
+        self.max_completion_tokens = max_completion_tokens
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.model = model
+        self.requests = 0
+        self.retries = 0
+        self.tokens_used = 0
+        self.usage: dict[str, dict[str, int]] = {}
+
+    def backoff(self, attempt: int, retry_after: float = 0.0) -> float:
+        """
+        See backoff_delay
+        """
+        return backoff_delay(attempt, self.base_backoff, self.max_backoff, retry_after)
+
+    async def _complete(self, page_content: str, prompt: str) -> tuple[str, Any]:
+        from openai import APIConnectionError, APIStatusError
+
+        estimate = estimate_tokens(prompt + page_content) + self.max_completion_tokens
+        attempt = 0
+        while True:
+            await self.limiter.acquire(estimate)
+            self.requests += 1
+            try:
+                with metrics.timer("fundai_stage_seconds", stage="llm_request"):
+                    raw = await self.client.chat.completions.with_raw_response.create(
+                        model=self.model,
+                        messages=[
+                            {"role": "system", "content": prompt},
+                            {"role": "user", "content": page_content},
+                        ],
+                    )
+            except (APIStatusError, APIConnectionError) as err:
+                status = getattr(err, "status_code", None)
+                reason = retry_reason(err)
+                if reason is None or attempt >= self.max_retries:
+                    metrics.inc("fundai_stage_failures_total", stage="llm_request")
+                    raise
+                metrics.inc("fundai_llm_retries_total", reason=reason)
+                headers = err.response.headers if status is not None else {}
+                self.limiter.update_from_headers(headers)
+                delay = self.backoff(attempt, parse_reset(headers.get("retry-after")))
+                logger.warning(
+                    f"LLM request failed with status {status}, retrying in {delay:.2f}s"
+                )
+                self.retries += 1
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            self.limiter.update_from_headers(raw.headers)
+            completion = raw.parse()
+            if completion.usage is not None:
+                self.tokens_used += completion.usage.total_tokens
+                self.limiter.tokens.adjust(estimate - completion.usage.total_tokens)
+                for kind in ("prompt", "completion"):
+                    metrics.inc(
+                        "fundai_llm_tokens_total",
+                        getattr(completion.usage, f"{kind}_tokens"),
+                        model=self.model,
+                        kind=kind,
+                    )
+            return completion.choices[0].message.content, completion.usage
+
+    def _record_usage(self, url: str, usage: Any):
+        totals = self.usage.setdefault(
+            url,
+            {
+                "requests": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "total_tokens": 0,
+            },
+        )
+        totals["requests"] += 1
+        if usage is not None:
+            totals["prompt_tokens"] += usage.prompt_tokens
+            totals["completion_tokens"] += usage.completion_tokens
+            totals["total_tokens"] += usage.total_tokens
+
+    def pop_usage(self, url: str) -> dict[str, int] | None:
+        """
+        Take the requests and tokens spent on url, None when no request was made
+        """
+        return self.usage.pop(url, None)
+
+    async def extract(
+        self, page_content: str, url: str, prompt: str = prompt_template
+    ) -> dict[str, Any]:
+        """
+        Obtain the data schema of one page, asking the model at most max_attempts
+        times as described in SchemaAnswers
+        :param page_content: post processed page content
+        :param url: URL of the page, used for logging
+        :param prompt: system prompt, defaults to the full prompt_template
+        :return: data schema, fields still invalid after max_attempts answers are None
+        :raises ExtractionError: when no answer held a JSON object
+        """
+        fields = prompt_fields(prompt)
+        if self.cache is not None:
+            schema = await asyncio.to_thread(self.cache.get, page_content, prompt)
+            metrics.inc(
+                "fundai_llm_cache_total", result="miss" if schema is None else "hit"
+            )
+            if schema is not None:
+                logger.info(f"Schema for {url} found in cache")
+                return coerce_schema(schema, fields)[0] if fields else schema
+        answers = SchemaAnswers(url, prompt, self.max_attempts)
+        async with self.semaphore:
+            while answers.next_prompt is not None:
+                output, usage = await self._complete(page_content, answers.next_prompt)
+                self._record_usage(url, usage)
+                logger.info(f"Tokens used: {usage}")
+                reason = answers.add(output)
+                if reason is not None:
+                    self.retries += 1
+                    metrics.inc("fundai_llm_retries_total", reason=reason)
+                if reason == "invalid_json":
+                    await asyncio.sleep(self.backoff(answers.attempts - 1))
+        schema = answers.result()
+        logger.info(f"Schema for {url} extracted")
+        if self.cache is not None:
+            await asyncio.to_thread(self.cache.put, page_content, schema, prompt)
+        return schema
@@ -1,45 +1,109 @@
 from datetime import datetime
+from functools import lru_cache
 
 import pytz
 import typer
+from typing import List, Optional
 from typing_extensions import Annotated
 
-from fundai.scraper import get_all_links, process_page, parse_schema
+from fundai.metrics import metrics
 from fundai.db import (
     init_search_urls,
     DatabaseClient,
     load_config,
     create_property_listings,
+    create_listing_history,
     clean_raw_propert_listings,
+    refresh_property_listings,
+    compress_raw_pages,
 )
+from fundai.workqueue import WorkQueue
 import logging
 
+# The scraping and extraction modules load langchain, openai and playwright,
+# commands import them when they run so the database commands start fast.
+# tests/test_import_time.py guards the import time of this module.
+
 logging.basicConfig(level=logging.INFO)
 app = typer.Typer()
 logger = logging.getLogger(__name__)
 
 
+@app.callback()
+def main(
+    ctx: typer.Context,
+    metrics_file: Annotated[
+        Optional[str],
+        typer.Option(help="Write pipeline metrics here, Prometheus format for .prom"),
+    ] = None,
+):
+    if metrics_file:
+        ctx.call_on_close(lambda: metrics.write(metrics_file))
+
+
+@lru_cache
+def get_db() -> DatabaseClient:
+    """
+    Pooled client shared by every step run in this process
+    """
+    return DatabaseClient(load_config())
+
+
 @app.command()
 def scrape_house_urls(
     home_type: Annotated[str, typer.Argument()] = "koop",
     area: Annotated[str, typer.Argument()] = "rotterdam",
+    concurrency: Annotated[int, typer.Option(help="Pages fetched in parallel")] = 4,
+    backend: Annotated[
+        str, typer.Option(help="auto: HTTP with browser fallback, browser: Chromium")
+    ] = "auto",
+    load_profile: Annotated[
+        str, typer.Option(help="How Chromium loads pages: full, lean or strict")
+    ] = "lean",
+    convert_processes: Annotated[
+        Optional[int], typer.Option(help="HTML conversion processes, default per CPU")
+    ] = None,
+    full_sweep: Annotated[
+        bool, typer.Option(help="Render every search page instead of only new ones")
+    ] = False,
+    stop_after: Annotated[
+        int, typer.Option(help="Stop after this many pages without new URLs")
+    ] = 2,
 ):
     """
-    Obtain all house URLs across all search pages
+    Obtain house URLs from the search pages. By default the results are walked
+    newest first until stop_after pages in a row hold only known URLs; use
+    --full-sweep to periodically reconcile with every search page.
     :param home_type:
     :param area:
+    :param concurrency:
+    :param backend:
+    :param load_profile:
+    :param convert_processes:
+    :param full_sweep:
+    :param stop_after:
     :return:
     """
+    from fundai.scraper import get_all_links
 
-    urls = get_all_links(home_type, area)
-    db = DatabaseClient(load_config())
+    db = get_db()
     query = f"""
     SELECT 
         url 
     from search_page_urls 
-    WHERE url LIKE '%/{home_type}/{area}/%' 
+    WHERE home_type = '{home_type}' AND area = '{area}'
     """
     current_urls = {row[0] for row in db.read(query)}
+    urls = get_all_links(
+        home_type,
+        area,
+        concurrency=concurrency,
+        backend=backend,
+        load_profile=load_profile,
+        convert_processes=convert_processes,
+        known_urls=current_urls,
+        stop_after=None if full_sweep else stop_after,
+    )
     new_urls = urls - current_urls
     logger.info(f"Inserting {len(new_urls)} new URLs")
     if new_urls:
@@ -47,7 +111,7 @@ def scrape_house_urls(
         ts = datetime.now(amsterdam_tz)
         values = [(ts, url) for url in new_urls]
         columns = ["date", "url"]
-        db.insert_values(values, "search_page_urls", columns)
+        db.insert_values(values, "search_page_urls", columns, conflict_columns=["url"])
     logger.info("Successfully inserted all urls")
 
 
@@ -55,53 +119,309 @@ def scrape_house_urls(
 def scrape_house_pages(
     home_type: Annotated[str, typer.Argument()] = "koop",
     area: Annotated[str, typer.Argument()] = "rotterdam",
+    concurrency: Annotated[int, typer.Option(help="Pages fetched in parallel")] = 4,
+    backend: Annotated[
+        str, typer.Option(help="auto: HTTP with browser fallback, browser: Chromium")
+    ] = "auto",
+    load_profile: Annotated[
+        str, typer.Option(help="How Chromium loads pages: full, lean or strict")
+    ] = "lean",
+    convert_processes: Annotated[
+        Optional[int], typer.Option(help="HTML conversion processes, default per CPU")
+    ] = None,
+    batch_size: Annotated[int, typer.Option(help="Pages per insert")] = 50,
+    max_in_flight: Annotated[
+        int, typer.Option(help="Pages held in memory at most, 0 for 2x concurrency")
+    ] = 0,
+    lease: Annotated[
+        float, typer.Option(help="Seconds claimed URLs are held before reclaimed")
+    ] = 600,
+    max_attempts: Annotated[
+        int, typer.Option(help="Claims of a URL before it is given up")
+    ] = 3,
 ):
-    db = DatabaseClient(load_config())
-    query = """
-        with all_ruls as (
-        SELECT 
-            url 
-        from search_page_urls 
-        WHERE url LIKE '%/{home_type}/{area}/%'
-        ),
-        processed_urls as (
-        SELECT 
-            url
-        from raw_page_content
-        WHERE url LIKE '%/{home_type}/{area}/%'
-        ) 
-        SELECT 
-         all_urls.url
-        FROM all_urls
-        WHERE all_urls.url NOT IN (select url from processed_urls)
-    """
-
-    pages_to_scrape = {row[0] for row in db.read(query)}
-    if not pages_to_scrape:
+    """
+    Scrape the pages of new URLs. URLs are claimed in batches of batch_size from
+    a queue in the database, so several workers can run at the same time.
+    """
+    from fundai.scraper import scrape_pages_to_db
+
+    db = get_db()
+    logger.info(f"Obtaining page content {home_type}/{area}")
+    with WorkQueue(
+        db,
+        home_type,
+        area,
+        "new",
+        batch_size=batch_size,
+        lease_seconds=lease,
+        max_attempts=max_attempts,
+    ) as queue:
+        written = scrape_pages_to_db(
+            queue,
+            db,
+            concurrency=concurrency,
+            backend=backend,
+            load_profile=load_profile,
+            convert_processes=convert_processes,
+            batch_size=batch_size,
+            max_in_flight=max_in_flight or None,
+        )
+    if not queue.claimed:
         logger.info("DB is up to date, all pages in seach_page_urls have been scraped")
         return
-    logger.info(f"Obtaining page content {home_type}/{area} for {len(pages_to_scrape)}")
-    pages = process_page(pages_to_scrape)
-    values = [[p.metadata["source"], p.page_content] for p in pages]
-    logger.info("Inserting page content...")
-    db.insert_values(values, "raw_page_content", ["url", "page_content"])
-    logger.info("Successfully inserted all page content")
+    logger.info(f"Successfully inserted page content of {written} pages")
 
 
 @app.command()
 def parse_house_pages(
     home_type: Annotated[str, typer.Argument()] = "koop",
     area: Annotated[str, typer.Argument()] = "rotterdam",
+    concurrency: Annotated[int, typer.Option(help="LLM requests in flight")] = 8,
+    requests_per_minute: Annotated[int, typer.Option(help="API request budget")] = 500,
+    tokens_per_minute: Annotated[int, typer.Option(help="API token budget")] = 200_000,
+    cache: Annotated[
+        bool, typer.Option(help="Reuse schemas of identical pages")
+    ] = True,
+    rules: Annotated[
+        bool, typer.Option(help="Extract Kenmerken fields without the LLM")
+    ] = True,
+    batch: Annotated[
+        bool, typer.Option(help="Write Batch API request files instead of calling")
+    ] = False,
+    batch_dir: Annotated[
+        str, typer.Option(help="Directory of the batch request files")
+    ] = "batches",
+    claim_size: Annotated[int, typer.Option(help="Pages claimed at a time")] = 100,
+    lease: Annotated[
+        float, typer.Option(help="Seconds claimed pages are held before reclaimed")
+    ] = 600,
+    max_attempts: Annotated[
+        int, typer.Option(help="Claims of a page before it is given up")
+    ] = 3,
 ):
-    db = DatabaseClient(load_config())
-    parse_schema(home_type, area, db)
+    """
+    Extract the data schema of scraped pages. Pages are claimed from a queue in
+    the database, so several workers can run at the same time. With --batch, the
+    pages are written as Batch API requests to upload, see ingest-batch-results
+    for the results.
+    """
+    from fundai.batch import export_batch
+    from fundai.scraper import parse_schema, pending_pages
+
+    db = get_db()
+    if batch:
+        export_batch(pending_pages(home_type, area, db), batch_dir, db, use_rules=rules)
+        return
+    with WorkQueue(
+        db,
+        home_type,
+        area,
+        "scraped",
+        batch_size=claim_size,
+        lease_seconds=lease,
+        max_attempts=max_attempts,
+    ) as queue:
+        parse_schema(
+            home_type,
+            area,
+            db,
+            concurrency=concurrency,
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+            use_cache=cache,
+            use_rules=rules,
+            queue=queue,
+        )
+
+
+@app.command()
+def ingest_batch_results(
+    results: Annotated[List[str], typer.Argument(help="Batch API output files")],
+    fields: Annotated[
+        Optional[List[str]],
+        typer.Option(help="fields files written next to the requests"),
+    ] = None,
+    batch_dir: Annotated[
+        str, typer.Option(help="Directory of the batch request files")
+    ] = "batches",
+):
+    """
+    Upsert the schemas of Batch API output files into raw_property_listings. The
+    fields the rules extracted are read from --fields, by default from every
+    fields file parse-schema --batch wrote to --batch-dir.
+    """
+    from fundai.batch import batch_fields_files, ingest_batch_output
+
+    db = get_db()
+    if fields is None:
+        fields = batch_fields_files(batch_dir)
+    ingest_batch_output(results, db, fields_paths=fields)
+
+
+@app.command()
+def evict_extraction_cache(
+    max_age_days: Annotated[
+        Optional[int], typer.Option(help="Also evict entries unused for this long")
+    ] = None,
+):
+    """
+    Remove cached schemas of outdated prompts or models
+    """
+    from fundai.cache import ExtractionCache
+
+    db = get_db()
+    ExtractionCache(db).evict(max_age_days)
+
+
+@app.command()
+def compress_raw_page_content(
+    method: Annotated[str, typer.Option(help="lz4 or pglz")] = "lz4",
+    batch_size: Annotated[
+        int, typer.Option(help="Rows rewritten per statement")
+    ] = 1000,
+    vacuum_full: Annotated[
+        bool, typer.Option(help="Return the freed space to the OS, locks the table")
+    ] = False,
+):
+    """
+    Switch the compression of stored page content and recompress existing pages
+    """
+    db = get_db()
+    compress_raw_pages(db, method, batch_size=batch_size, vacuum_full=vacuum_full)
+
+
+@app.command()
+def run(
+    home_type: Annotated[str, typer.Argument()] = "koop",
+    area: Annotated[str, typer.Argument()] = "rotterdam",
+    concurrency: Annotated[int, typer.Option(help="Pages fetched in parallel")] = 4,
+    backend: Annotated[
+        str, typer.Option(help="auto: HTTP with browser fallback, browser: Chromium")
+    ] = "auto",
+    load_profile: Annotated[
+        str, typer.Option(help="How Chromium loads pages: full, lean or strict")
+    ] = "lean",
+    convert_processes: Annotated[
+        Optional[int], typer.Option(help="HTML conversion processes, default per CPU")
+    ] = None,
+    llm_concurrency: Annotated[int, typer.Option(help="LLM requests in flight")] = 8,
+    requests_per_minute: Annotated[int, typer.Option(help="API request budget")] = 500,
+    tokens_per_minute: Annotated[int, typer.Option(help="API token budget")] = 200_000,
+    queue_size: Annotated[
+        int, typer.Option(help="Items waiting between two stages at most")
+    ] = 100,
+    batch_size: Annotated[
+        int, typer.Option(help="URLs claimed and rows inserted at a time")
+    ] = 50,
+    lease: Annotated[
+        float, typer.Option(help="Seconds claimed URLs are held before reclaimed")
+    ] = 600,
+    full_sweep: Annotated[
+        bool, typer.Option(help="Render every search page instead of only new ones")
+    ] = False,
+    stop_after: Annotated[
+        int, typer.Option(help="Stop after this many pages without new URLs")
+    ] = 2,
+    cache: Annotated[
+        bool, typer.Option(help="Reuse schemas of identical pages")
+    ] = True,
+    rules: Annotated[
+        bool, typer.Option(help="Extract Kenmerken fields without the LLM")
+    ] = True,
+):
+    """
+    Crawl, scrape and parse home_type/area with all stages running at the same
+    time, then refresh property_listing. Equivalent to scrape-house-urls,
+    scrape-house-pages, parse-house-pages and load-property-listing-view.
+    """
+    from fundai.pipeline import run_pipeline
+
+    db = get_db()
+    query = f"""
+    SELECT url from search_page_urls WHERE home_type = '{home_type}' AND area = '{area}'
+    """
+    counts = run_pipeline(
+        home_type,
+        area,
+        db,
+        known_urls={row[0] for row in db.read(query)},
+        stop_after=None if full_sweep else stop_after,
+        concurrency=concurrency,
+        backend=backend,
+        load_profile=load_profile,
+        convert_processes=convert_processes,
+        llm_concurrency=llm_concurrency,
+        requests_per_minute=requests_per_minute,
+        tokens_per_minute=tokens_per_minute,
+        queue_size=queue_size,
+        batch_size=batch_size,
+        lease_seconds=lease,
+        use_cache=cache,
+        use_rules=rules,
+    )
+    logger.info(f"Pipeline finished: {dict(counts)}")
+    load_property_listing_view()
+
+
+@app.command()
+def revisit_house_pages(
+    home_type: Annotated[str, typer.Argument()] = "koop",
+    area: Annotated[str, typer.Argument()] = "rotterdam",
+    every: Annotated[
+        float, typer.Option(help="Hours after which an active listing is revisited")
+    ] = 24,
+    limit: Annotated[
+        int, typer.Option(help="Pages revisited in this run at most, 0 for all due")
+    ] = 0,
+    concurrency: Annotated[int, typer.Option(help="Pages fetched in parallel")] = 4,
+    backend: Annotated[
+        str, typer.Option(help="auto: HTTP with browser fallback, browser: Chromium")
+    ] = "auto",
+    load_profile: Annotated[
+        str, typer.Option(help="How Chromium loads pages: full, lean or strict")
+    ] = "lean",
+    convert_processes: Annotated[
+        Optional[int], typer.Option(help="HTML conversion processes, default per CPU")
+    ] = None,
+    llm_concurrency: Annotated[int, typer.Option(help="LLM requests in flight")] = 8,
+    requests_per_minute: Annotated[int, typer.Option(help="API request budget")] = 500,
+    tokens_per_minute: Annotated[int, typer.Option(help="API token budget")] = 200_000,
+    rules: Annotated[
+        bool, typer.Option(help="Extract Kenmerken fields without the LLM")
+    ] = True,
+):
+    """
+    Fetch the active listings that are due again, e.g. from cron, and extract the
+    pages that changed. Price and status changes are kept in listing_history.
+    """
+    from fundai.revisit import revisit_pages
+
+    db = get_db()
+    create_listing_history(db)
+    revisit_pages(
+        home_type,
+        area,
+        db,
+        every_hours=every,
+        limit=limit or None,
+        concurrency=concurrency,
+        backend=backend,
+        load_profile=load_profile,
+        convert_processes=convert_processes,
+        llm_concurrency=llm_concurrency,
+        requests_per_minute=requests_per_minute,
+        tokens_per_minute=tokens_per_minute,
+        use_rules=rules,
+    )
 
 
 @app.command()
 def load_property_listing_view():
-    db = DatabaseClient(load_config())
-    clean_raw_propert_listings(db)
+    db = get_db()
     create_property_listings(db)
+    clean_raw_propert_listings(db)
+    refresh_property_listings(db)
 
 
 @app.command()
@@ -110,7 +430,7 @@ def init_db():
     Initialze the databse
     :return:
     """
-    db = DatabaseClient(load_config())
+    db = get_db()
     init_search_urls(db)
     logger.info("Database initialized")
 
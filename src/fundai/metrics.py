@@ -0,0 +1,177 @@
+import bisect
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+logger = logging.getLogger(__name__)
+
+# seconds, spanning a fast upsert to a slow LLM request
+default_buckets = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+class Histogram:
+    """
+    Cumulative bucket histogram as exported to Prometheus, with quantiles
+    interpolated within the buckets like histogram_quantile does
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = default_buckets) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float | None:
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n > 0:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+def _labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+class Metrics:
+    """
+    Thread-safe registry of labelled counters and latency histograms for the
+    pipeline stages (fetch, convert, extract, insert), exportable in the Prometheus
+    text format or as JSON
+    """
+
+    def __init__(self) -> None:
+        self.started = time.monotonic()
+        self.counters: dict[str, dict[tuple, float]] = {}
+        self.histograms: dict[str, dict[tuple, Histogram]] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, amount: float = 1, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            series.setdefault(key, Histogram()).observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        """
+        Observe the duration of the block, also when it raises
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self._lock:
+            self.started = time.monotonic()
+            self.counters = {}
+            self.histograms = {}
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                for key, value in series.items():
+                    lines.append(f"{name}{_labels(dict(key))} {value:g}")
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for key, hist in series.items():
+                    cumulative = 0
+                    for bound, n in zip(hist.buckets + (float("inf"),), hist.counts):
+                        cumulative += n
+                        le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                        labels = _labels({**dict(key), "le": le})
+                        lines.append(f"{name}_bucket{labels} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(dict(key))} {hist.sum:g}")
+                    lines.append(f"{name}_count{_labels(dict(key))} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self) -> dict[str, Any]:
+        """
+        Counters with their rate per second since the start, and histograms with
+        their count, mean, p50 and p95
+        """
+        with self._lock:
+            elapsed = max(time.monotonic() - self.started, 1e-9)
+            counters = {
+                name: [
+                    {"labels": dict(key), "value": value, "per_second": value / elapsed}
+                    for key, value in series.items()
+                ]
+                for name, series in self.counters.items()
+            }
+            histograms = {
+                name: [
+                    {
+                        "labels": dict(key),
+                        "count": hist.count,
+                        "mean": hist.sum / hist.count if hist.count else None,
+                        "p50": hist.quantile(0.5),
+                        "p95": hist.quantile(0.95),
+                    }
+                    for key, hist in series.items()
+                ]
+                for name, series in self.histograms.items()
+            }
+        return {
+            "elapsed_seconds": elapsed,
+            "counters": counters,
+            "histograms": histograms,
+        }
+
+    def write(self, path: str):
+        """
+        Write the metrics to path, in the Prometheus text format for .prom files
+        (e.g. for the node_exporter textfile collector) and as JSON otherwise
+        """
+        if path.endswith(".prom"):
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.to_dict(), indent=2)
+        with open(path, "w") as f:
+            f.write(text)
+        logger.info(f"Metrics written to {path}")
+
+
+# registry shared by the pipeline stages of this process
+metrics = Metrics()
@@ -0,0 +1,300 @@
+import asyncio
+import logging
+from collections import Counter
+from datetime import datetime
+from typing import Any, Awaitable, Callable
+
+import nest_asyncio
+import pytz
+
+from fundai.cache import ExtractionCache
+from fundai.convert import TextConverter
+from fundai.db import (
+    BatchWriter,
+    DatabaseClient,
+    create_dead_letter,
+    create_extraction_cache,
+    create_token_usage,
+    dead_letter_columns,
+    token_usage_columns,
+)
+from fundai.fetch import Fetcher, open_fetcher
+from fundai.llm import AsyncExtractor
+from fundai.rules import FieldCoverage
+from fundai.scraper import (
+    AsyncChromiumLoaderHeader,
+    aiter_links,
+    aobtain_schema_and_push,
+    claimed_pages,
+)
+from fundai.workqueue import WorkQueue
+
+logger = logging.getLogger(__name__)
+
+# end of stream marker passed down the stage queues
+_done = object()
+
+
+async def _drain(
+    queue: asyncio.Queue, handle: Callable[[Any], Awaitable[None]], workers: int
+):
+    """
+    Handle the items of queue with workers concurrent tasks until the end marker,
+    failures of single items are logged and skipped
+    """
+
+    async def _work():
+        while True:
+            item = await queue.get()
+            if item is _done:
+                # a slot was just freed, leave the marker for the other workers
+                queue.put_nowait(_done)
+                return
+            try:
+                await handle(item)
+            except Exception as err:
+                url = item[0] if isinstance(item, tuple) else item
+                logger.error(f"Pipeline stage failed on {url}: {err}")
+
+    await asyncio.gather(*[_work() for _ in range(workers)])
+
+
+async def _close_after(queue: asyncio.Queue, *stages: Awaitable[Any]):
+    await asyncio.gather(*stages)
+    await queue.put(_done)
+
+
+async def arun_pipeline(
+    home_type: str,
+    area: str,
+    db: DatabaseClient,
+    pool: Fetcher,
+    converter: TextConverter,
+    extractor: AsyncExtractor,
+    known_urls: set[str] | None = None,
+    stop_after: int | None = 2,
+    queue_size: int = 100,
+    convert_workers: int | None = None,
+    batch_size: int = 50,
+    lease_seconds: float = 600,
+    use_rules: bool = True,
+) -> Counter:
+    """
+    Crawl, scrape and parse home_type/area in one pass. The stages run at the same
+    time, connected by queues of at most queue_size items, so a slow stage holds
+    back the ones before it instead of letting work pile up in memory:
+
+    search pages -> new URLs -> fetch -> convert -> extract
+
+    New URLs are stored in search_page_urls and claimed back through a WorkQueue,
+    together with the URLs a previous run left unscraped. Pages left unparsed by
+    a previous run are claimed as well and join the extract stage. Pages that
+    could not be fetched are deferred, to be claimed again after a backoff.
+    :param pool: started fetcher, its concurrency is that of the fetch stage
+    :param converter: HTML converter, its processes set the convert concurrency
+    :param extractor: LLM extractor, twice its concurrency extract at a time
+    :param known_urls: URLs already stored, used by the incremental crawl
+    :param stop_after: consecutive known search pages after which to stop, None
+        for a full sweep
+    :param convert_workers: pages converted at a time, defaults to the converter
+        processes
+    :param batch_size: URLs claimed and rows inserted at a time
+    :return: items handled per stage
+    """
+    known_urls = set(known_urls or ())
+    counts = Counter()
+    urls: asyncio.Queue = asyncio.Queue(queue_size)
+    pages: asyncio.Queue = asyncio.Queue(queue_size)
+    texts: asyncio.Queue = asyncio.Queue(queue_size)
+    discovered = asyncio.Event()
+    crawling = True
+    handed_off: set[str] = set()
+    loader = AsyncChromiumLoaderHeader([], pool=pool)
+    coverage = FieldCoverage()
+    new_urls = WorkQueue(db, home_type, area, "new", batch_size, lease_seconds)
+    scraped_urls = WorkQueue(db, home_type, area, "scraped", batch_size, lease_seconds)
+    amsterdam_tz = pytz.timezone("Europe/Amsterdam")
+
+    async def crawl():
+        nonlocal crawling
+        try:
+            async for links in aiter_links(
+                home_type, area, pool, known_urls, stop_after, converter
+            ):
+                links = links - known_urls
+                if not links:
+                    continue
+                known_urls.update(links)
+                ts = datetime.now(amsterdam_tz)
+                await asyncio.to_thread(
+                    db.insert_values,
+                    [(ts, url) for url in links],
+                    "search_page_urls",
+                    ["date", "url"],
+                    conflict_columns=["url"],
+                )
+                counts["discovered"] += len(links)
+                discovered.set()
+        except Exception as err:
+            logger.error(f"Crawling /{home_type}/{area} failed: {err}")
+        finally:
+            crawling = False
+            discovered.set()
+
+    async def feed_urls():
+        while True:
+            discovered.clear()
+            claimed = await asyncio.to_thread(new_urls.claim)
+            for url in claimed:
+                await urls.put(url)
+            if not claimed:
+                if not crawling:
+                    return
+                await discovered.wait()
+
+    async def fetch(url: str):
+        try:
+            html = await loader.ascrape_playwright(url)
+        except Exception:
+            counts["fetch_failed"] += 1
+            await asyncio.to_thread(new_urls.defer, [url])
+            return
+        counts["fetched"] += 1
+        await pages.put((url, html, pool.pop_backend(url)))
+
+    async def convert(item: tuple[str, str, str]):
+        url, html, backend = item
+        text = await converter.convert(html)
+        counts["scraped"] += 1
+        handed_off.add(url)
+        await asyncio.to_thread(page_writer.add, (url, text, backend))
+        await texts.put((url, text))
+
+    async def feed_unparsed():
+        backlog = claimed_pages(scraped_urls, db)
+        while True:
+            row = await asyncio.to_thread(next, backlog, None)
+            if row is None:
+                return
+            if row[0] not in handed_off:
+                handed_off.add(row[0])
+                await texts.put(row)
+
+    async def extract(item: tuple[str, str]):
+        url, text = item
+        parsed = await aobtain_schema_and_push(
+            text,
+            url,
+            listing_writer,
+            extractor,
+            coverage,
+            use_rules,
+            usage_writer,
+            dead_letter_writer,
+        )
+        counts["parsed" if parsed else "failed"] += 1
+
+    with new_urls, scraped_urls, BatchWriter(
+        db,
+        "raw_page_content",
+        ["url", "page_content", "fetch_backend"],
+        batch_size=batch_size,
+        conflict_columns=["url"],
+    ) as page_writer, BatchWriter(
+        db,
+        "raw_property_listings",
+        ["url", "raw_data"],
+        batch_size=batch_size,
+        conflict_columns=["url"],
+    ) as listing_writer, BatchWriter(
+        db, "llm_token_usage", token_usage_columns, batch_size=batch_size
+    ) as usage_writer, BatchWriter(
+        db, "llm_dead_letter", dead_letter_columns, batch_size=batch_size
+    ) as dead_letter_writer:
+        await asyncio.gather(
+            crawl(),
+            _close_after(urls, feed_urls()),
+            _close_after(pages, _drain(urls, fetch, pool.concurrency)),
+            _close_after(
+                texts,
+                _drain(pages, convert, convert_workers or max(converter.processes, 1)),
+                feed_unparsed(),
+            ),
+            _drain(texts, extract, 2 * extractor.concurrency),
+        )
+    logger.info(
+        f"Pipeline of /{home_type}/{area} done: {dict(counts)}, "
+        f"{extractor.requests} LLM requests and {extractor.tokens_used} tokens"
+    )
+    if use_rules:
+        logger.info(f"Rule based field coverage: {coverage.rates()}")
+    return counts
+
+
+def run_pipeline(
+    home_type: str,
+    area: str,
+    db: DatabaseClient,
+    known_urls: set[str] | None = None,
+    stop_after: int | None = 2,
+    concurrency: int = 4,
+    backend: str = "auto",
+    load_profile: str = "lean",
+    convert_processes: int | None = None,
+    llm_concurrency: int = 8,
+    requests_per_minute: int = 500,
+    tokens_per_minute: int = 200_000,
+    client=None,
+    queue_size: int = 100,
+    batch_size: int = 50,
+    lease_seconds: float = 600,
+    use_cache: bool = True,
+    use_rules: bool = True,
+) -> Counter:
+    """
+    Synchronous wrapper around arun_pipeline, opening the fetcher, converter and
+    extractor of the run
+    :param concurrency: number of pages fetched at the same time
+    :param backend: "auto" for HTTP with browser fallback, "browser" for Chromium only
+    :param load_profile: how Chromium loads pages, "full", "lean" or "strict"
+    :param convert_processes: HTML conversion processes, one per CPU when None
+    :param llm_concurrency: maximum number of LLM requests in flight
+    :param client: async OpenAI compatible client, defaults to AsyncOpenAI()
+    :param use_cache: reuse schemas of identical pages from llm_extraction_cache
+    """
+    create_token_usage(db)
+    create_dead_letter(db)
+    if use_cache:
+        create_extraction_cache(db)
+    if client is None:
+        from openai import AsyncOpenAI
+
+        client = AsyncOpenAI(max_retries=0)
+    extractor = AsyncExtractor(
+        client,
+        concurrency=llm_concurrency,
+        requests_per_minute=requests_per_minute,
+        tokens_per_minute=tokens_per_minute,
+        cache=ExtractionCache(db) if use_cache else None,
+    )
+    nest_asyncio.apply()
+
+    async def _run() -> Counter:
+        async with open_fetcher(backend, concurrency, load_profile) as pool:
+            with TextConverter(convert_processes) as converter:
+                return await arun_pipeline(
+                    home_type,
+                    area,
+                    db,
+                    pool,
+                    converter,
+                    extractor,
+                    known_urls=known_urls,
+                    stop_after=stop_after,
+                    queue_size=queue_size,
+                    batch_size=batch_size,
+                    lease_seconds=lease_seconds,
+                    use_rules=use_rules,
+                )
+
+    return asyncio.run(_run())
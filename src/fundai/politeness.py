@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+from urllib.parse import urlsplit
+
+from fundai.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# statuses with which a site asks the crawler to slow down
+throttle_statuses = (403, 429)
+# lower cased texts of the bot checks and block pages served instead of a page
+captcha_markers = (
+    "je bent bijna op de pagina",
+    "ben je een robot",
+    "verify you are a human",
+    "px-captcha",
+    "cf-chl-",
+    "g-recaptcha-response",
+)
+# only a block when the page is small, full listings may contain these words
+block_markers = (
+    "captcha",
+    "access denied",
+    "request blocked",
+    "too many requests",
+    "service unavailable",
+)
+block_page_chars = 20_000
+min_page_chars = 500
+
+
+class PageBlocked(Exception):
+    """
+    The site refused a page, with a throttling status or a captcha or error page
+    instead of the content
+    """
+
+    def __init__(self, url: str, reason: str, retry_after: float | None = None):
+        super().__init__(f"{url} was blocked: {reason}")
+        self.url = url
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """
+    Seconds of a Retry-After header, None when absent or given as a date
+    """
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def detect_block(html: str) -> str | None:
+    """
+    Whether html is a captcha or error page instead of the requested page
+    :return: "captcha", "blocked" or "empty_page", None for a regular page
+    """
+    if len(html.strip()) < min_page_chars:
+        return "empty_page"
+    text = html.lower()
+    if any(marker in text for marker in captcha_markers):
+        return "captcha"
+    if len(html) < block_page_chars and any(m in text for m in block_markers):
+        return "blocked"
+    return None
+
+
+class _HostState:
+    def __init__(self, limit: float) -> None:
+        self.limit = limit
+        self.in_flight = 0
+        self.latency: float | None = None
+        self.error_rate = 0.0
+        self.blocks = 0
+        self.paused_until = 0.0
+        self.last_decrease = float("-inf")
+        self.changed = asyncio.Condition()
+
+
+class AimdScheduler:
+    """
+    Per host concurrency limit adjusted with additive increase, multiplicative
+    decrease (AIMD), as TCP does with its congestion window. Every response that
+    came back in time raises the limit by increase per limit responses, so one
+    per round of requests. The limit is multiplied by decrease when the mean
+    latency exceeds target_latency, the error rate exceeds max_error_rate or the
+    host throttles or blocks a page, at most once per cooldown seconds so a burst
+    of failures of requests that were in flight together counts once. Blocks also
+    pause the host for its Retry-After or an exponential backoff.
+    """
+
+    def __init__(
+        self,
+        initial: float = 2,
+        min_limit: float = 1,
+        max_limit: float = 8,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        target_latency: float = 5.0,
+        max_error_rate: float = 0.2,
+        cooldown: float = 5.0,
+        backoff: float = 30.0,
+        max_backoff: float = 600.0,
+        smoothing: float = 0.2,
+    ) -> None:
+        """
+        :param initial: concurrency a host starts with
+        :param target_latency: mean seconds per page above which to slow down
+        :param max_error_rate: mean share of failed pages above which to slow down
+        :param backoff: seconds a host is paused after its first block, doubling
+            with every block in a row up to max_backoff
+        :param smoothing: weight of the latest page in the mean latency and error rate
+        """
+        self.initial = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.cooldown = cooldown
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.smoothing = smoothing
+        self.hosts: dict[str, _HostState] = {}
+
+    def host(self, url: str) -> _HostState:
+        host = urlsplit(url).hostname or ""
+        if host not in self.hosts:
+            self.hosts[host] = _HostState(self.initial)
+        return self.hosts[host]
+
+    def limit(self, url: str) -> int:
+        return max(int(self.host(url).limit), 1)
+
+    @asynccontextmanager
+    async def slot(self, url: str) -> AsyncIterator[None]:
+        """
+        Wait until the host of url is not paused and below its limit
+        """
+        state = self.host(url)
+        async with state.changed:
+            while True:
+                pause = state.paused_until - time.monotonic()
+                if pause > 0:
+                    try:
+                        await asyncio.wait_for(state.changed.wait(), pause)
+                    except asyncio.TimeoutError:
+                        pass
+                elif state.in_flight < self.limit(url):
+                    break
+                else:
+                    await state.changed.wait()
+            state.in_flight += 1
+        try:
+            yield
+        finally:
+            async with state.changed:
+                state.in_flight -= 1
+                state.changed.notify_all()
+
+    def record(self, url: str, seconds: float, error: Exception | None = None):
+        """
+        Adjust the limit of the host of url to the outcome of a page
+        :param seconds: time the page took
+        :param error: exception the page failed with, None when it succeeded
+        """
+        state = self.host(url)
+        a = self.smoothing
+        failed = error is not None
+        state.error_rate = (1 - a) * state.error_rate + a * failed
+        if isinstance(error, PageBlocked):
+            state.blocks += 1
+            pause = error.retry_after
+            if pause is None:
+                pause = min(self.backoff * 2 ** (state.blocks - 1), self.max_backoff)
+            state.paused_until = max(state.paused_until, time.monotonic() + pause)
+            metrics.inc("fundai_fetch_blocked_total", reason=error.reason)
+            self._decrease(url, state, f"{error.reason}, pausing {pause:.0f}s")
+            return
+        if failed:
+            if state.error_rate > self.max_error_rate:
+                self._decrease(url, state, f"error rate {state.error_rate:.2f}")
+            return
+        state.blocks = 0
+        state.latency = (
+            seconds if state.latency is None else (1 - a) * state.latency + a * seconds
+        )
+        if state.latency > self.target_latency:
+            self._decrease(url, state, f"latency {state.latency:.1f}s")
+        elif state.limit < self.max_limit:
+            state.limit = min(state.limit + self.increase / state.limit, self.max_limit)
+
+    def _decrease(self, url: str, state: _HostState, cause: str):
+        now = time.monotonic()
+        if now - state.last_decrease < self.cooldown:
+            return
+        state.last_decrease = now
+        limit = max(state.limit * self.decrease, self.min_limit)
+        if limit < state.limit:
+            logger.info(
+                f"Lowering concurrency of {urlsplit(url).hostname} from "
+                f"{state.limit:.1f} to {limit:.1f}: {cause}"
+            )
+        state.limit = limit
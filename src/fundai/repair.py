@@ -0,0 +1,125 @@
+import json
+import re
+from typing import Any
+
+from fundai.rules import parse_bool, parse_int, prompt_field_types
+from fundai.utils import prompt_template
+
+# a value or closing bracket followed by the next key on a new line, without comma
+_missing_comma = re.compile(r'(["\d\]}]|true|false|null)(\s*\n\s*")')
+_closing_fence = re.compile(r"\s*```\s*$")
+_trailing_comma = re.compile(r",(\s*[}\]])")
+_python_literal = re.compile(r'("(?:[^"\\]|\\.)*")|\b(True|False|None)\b')
+_python_literals = {"True": "true", "False": "false", "None": "null"}
+# a key or separator left without value at the end of cut off output
+_dangling_key = re.compile(r'(,\s*"[^"]*"\s*:?\s*|,\s*|:\s*)$')
+_dangling_comma = re.compile(r",\s*$")
+
+
+def _close_truncated(text: str) -> str:
+    """
+    Close the objects and arrays left open by output that was cut off, dropping
+    the key or value that was being written
+    """
+    stack = []
+    string_start = None
+    escaped = False
+    for i, char in enumerate(text):
+        if string_start is not None:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                string_start = None
+        elif char == '"':
+            string_start = i
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]" and stack:
+            stack.pop()
+    if string_start is not None:
+        text = text[:string_start]
+    dangling = _dangling_comma if stack and stack[-1] == "]" else _dangling_key
+    text = dangling.sub("", text.rstrip())
+    return text + "".join(reversed(stack))
+
+
+def repair_json(output: str) -> dict[str, Any]:
+    """
+    Parse the JSON object in LLM output, fixing the defects models tend to produce:
+    markdown fences and surrounding prose, missing or trailing commas, Python
+    literals and output cut off before the end
+    :raises ValueError: when no JSON object can be recovered
+    """
+    start = output.find("{")
+    if start == -1:
+        raise ValueError("No JSON object in output")
+    end = output.rfind("}")
+    if end > start:
+        text = output[start : end + 1]
+    else:
+        text = _closing_fence.sub("", output[start:])
+    try:
+        schema = json.loads(text)
+    except json.JSONDecodeError:
+        text = _python_literal.sub(
+            lambda m: m.group(1) or _python_literals[m.group(2)], text
+        )
+        text = _missing_comma.sub(r"\1,\2", text)
+        text = _trailing_comma.sub(r"\1", _close_truncated(text))
+        try:
+            schema = json.loads(text)
+        except json.JSONDecodeError as err:
+            raise ValueError(f"Unrepairable JSON: {err}") from err
+        if not schema:
+            raise ValueError("Unrepairable JSON: no field recovered")
+    if not isinstance(schema, dict):
+        raise ValueError(f"Expected a JSON object, got {type(schema).__name__}")
+    return schema
+
+
+def prompt_fields(prompt: str = prompt_template) -> dict[str, str]:
+    """
+    Fields and SQL types requested by prompt_template or a prompt derived from it
+    with fundai.rules.build_prompt
+    """
+    types = prompt_field_types()
+    requested = re.findall(r"^\s*(\w+) (?:TEXT|INTEGER|BOOLEAN)", prompt, re.M)
+    return {field: types[field] for field in requested if field in types}
+
+
+def coerce_schema(
+    schema: dict[str, Any], fields: dict[str, str] | None = None
+) -> tuple[dict[str, Any], list[str]]:
+    """
+    Coerce the values of a schema to the types declared in prompt_template, e.g.
+    "Voor 1906" to 1906 or "Ja" to True. Requested fields missing from the schema
+    are None.
+    :param fields: fields and types to keep, all prompt_template fields when None
+    :return: the coerced schema, and the fields holding a value that could not be
+        coerced, which are set to None
+    """
+    fields = fields if fields is not None else prompt_field_types()
+    coerced: dict[str, Any] = {}
+    invalid = []
+    for field, sql_type in fields.items():
+        value = schema.get(field)
+        if isinstance(value, str) and value.strip().lower() in ("", "null", "none"):
+            value = None
+        if value is None:
+            coerced[field] = None
+            continue
+        if sql_type == "INTEGER":
+            coerced[field] = parse_int(value)
+        elif sql_type == "BOOLEAN":
+            coerced[field] = parse_bool(value)
+        elif isinstance(value, list):
+            coerced[field] = ", ".join(map(str, value))
+        elif isinstance(value, dict):
+            coerced[field] = json.dumps(value, ensure_ascii=False)
+        else:
+            coerced[field] = str(value)
+        if coerced[field] is None:
+            invalid.append(field)
+    return coerced, invalid
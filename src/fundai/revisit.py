@@ -0,0 +1,245 @@
+import asyncio
+import logging
+from collections import Counter
+
+import nest_asyncio
+
+from fundai.cache import ExtractionCache, sha256
+from fundai.convert import TextConverter
+from fundai.db import (
+    BatchWriter,
+    DatabaseClient,
+    create_dead_letter,
+    create_extraction_cache,
+    create_token_usage,
+    dead_letter_columns,
+    token_usage_columns,
+)
+from fundai.fetch import Fetcher, open_fetcher
+from fundai.llm import AsyncExtractor
+from fundai.rules import FieldCoverage
+from fundai.scraper import (
+    AsyncChromiumLoaderHeader,
+    aobtain_schema_and_push,
+    post_process_pages,
+)
+
+logger = logging.getLogger(__name__)
+
+# lower cased statuses after which a listing is not revisited anymore
+final_statuses = ("verkocht", "verhuurd")
+
+
+def content_hash(page: str, url: str) -> str:
+    """
+    Hash of the part of a page post_process_pages keeps, so changes of the page
+    around the listing do not count as a change
+    """
+    return sha256(post_process_pages(page, url))
+
+
+def claim_due_pages(
+    db: DatabaseClient,
+    home_type: str,
+    area: str,
+    every_hours: float = 24,
+    limit: int = 50,
+) -> list[tuple[str, str | None, str | None]]:
+    """
+    Claim the active listings of home_type/area that were not checked for
+    every_hours, least recently checked first. Claiming sets last_checked_at,
+    and rows locked by other workers are skipped, so workers never revisit the
+    same page; a page whose worker died is due again after every_hours.
+    :return: url, stored content hash and, when no hash is stored yet, the stored
+        page content of every claimed page
+    """
+    statuses = ", ".join(f"'{status}'" for status in final_statuses)
+    query = f"""
+        UPDATE raw_page_content c
+        SET last_checked_at = now()
+        FROM (
+            SELECT c.url
+            FROM raw_page_content c
+            JOIN search_page_urls s ON s.url = c.url
+            LEFT JOIN raw_property_listings r ON r.url = c.url
+            WHERE s.home_type = %(home_type)s AND s.area = %(area)s
+                AND s.state = 'parsed'
+                AND coalesce(lower(r.raw_data->>'status'), '') NOT IN ({statuses})
+                AND (
+                    c.last_checked_at IS NULL
+                    OR c.last_checked_at < now() - %(every)s * interval '1 hour'
+                )
+            ORDER BY c.last_checked_at NULLS FIRST
+            LIMIT %(limit)s
+            FOR UPDATE OF c SKIP LOCKED
+        ) due
+        WHERE c.url = due.url
+        RETURNING
+            c.url,
+            c.content_hash,
+            CASE WHEN c.content_hash IS NULL THEN c.page_content END
+    """
+    params = {
+        "home_type": home_type,
+        "area": area,
+        "every": every_hours,
+        "limit": limit,
+    }
+    with db.connection() as conn, conn.cursor() as cur:
+        cur.execute(query, params)
+        return cur.fetchall()
+
+
+async def arevisit_pages(
+    home_type: str,
+    area: str,
+    db: DatabaseClient,
+    pool: Fetcher,
+    converter: TextConverter,
+    extractor: AsyncExtractor,
+    every_hours: float = 24,
+    batch_size: int = 50,
+    limit: int | None = None,
+    use_rules: bool = True,
+) -> Counter:
+    """
+    Fetch the active listings of home_type/area again once every_hours have
+    passed since they were last checked. The content hash of the post processed
+    page is compared with the stored one, only pages that changed are stored and
+    extracted again. The updated raw_property_listings rows append a version to
+    listing_history when their price or status changed.
+    :param batch_size: pages claimed at a time
+    :param limit: pages revisited in this run at most, all due pages when None
+    :return: number of claimed, unchanged, changed and failed pages
+    """
+    counts = Counter()
+    loader = AsyncChromiumLoaderHeader([], pool=pool)
+    coverage = FieldCoverage()
+
+    async def _revisit(url: str, stored_hash: str | None, stored_page: str | None):
+        try:
+            html = await loader.ascrape_playwright(url)
+        except Exception as err:
+            logger.error(f"Revisiting {url} failed: {err}")
+            counts["failed"] += 1
+            return
+        backend = pool.pop_backend(url)
+        text = await converter.convert(html)
+        new_hash = content_hash(text, url)
+        if new_hash != stored_hash:
+            await asyncio.to_thread(page_writer.add, (url, text, backend, new_hash))
+        if new_hash == (stored_hash or content_hash(stored_page or "", url)):
+            counts["unchanged"] += 1
+            return
+        logger.info(f"{url} changed, extracting it again")
+        counts["changed"] += 1
+        await aobtain_schema_and_push(
+            text,
+            url,
+            listing_writer,
+            extractor,
+            coverage,
+            use_rules,
+            usage_writer,
+            dead_letter_writer,
+        )
+
+    with BatchWriter(
+        db,
+        "raw_page_content",
+        ["url", "page_content", "fetch_backend", "content_hash"],
+        batch_size=batch_size,
+        conflict_columns=["url"],
+        update=True,
+    ) as page_writer, BatchWriter(
+        db,
+        "raw_property_listings",
+        ["url", "raw_data"],
+        batch_size=batch_size,
+        conflict_columns=["url"],
+        update=True,
+    ) as listing_writer, BatchWriter(
+        db, "llm_token_usage", token_usage_columns, batch_size=batch_size
+    ) as usage_writer, BatchWriter(
+        db, "llm_dead_letter", dead_letter_columns, batch_size=batch_size
+    ) as dead_letter_writer:
+        while limit is None or counts["claimed"] < limit:
+            size = (
+                batch_size
+                if limit is None
+                else min(batch_size, limit - counts["claimed"])
+            )
+            due = await asyncio.to_thread(
+                claim_due_pages, db, home_type, area, every_hours, size
+            )
+            if not due:
+                break
+            counts["claimed"] += len(due)
+            await asyncio.gather(*[_revisit(*row) for row in due])
+    logger.info(f"Revisited /{home_type}/{area}: {dict(counts)}")
+    return counts
+
+
+def revisit_pages(
+    home_type: str,
+    area: str,
+    db: DatabaseClient,
+    every_hours: float = 24,
+    limit: int | None = None,
+    concurrency: int = 4,
+    backend: str = "auto",
+    load_profile: str = "lean",
+    convert_processes: int | None = None,
+    llm_concurrency: int = 8,
+    requests_per_minute: int = 500,
+    tokens_per_minute: int = 200_000,
+    client=None,
+    batch_size: int = 50,
+    use_cache: bool = True,
+    use_rules: bool = True,
+) -> Counter:
+    """
+    Synchronous wrapper around arevisit_pages, opening the fetcher, converter and
+    extractor of the run
+    :param concurrency: number of pages fetched at the same time
+    :param backend: "auto" for HTTP with browser fallback, "browser" for Chromium only
+    :param load_profile: how Chromium loads pages, "full", "lean" or "strict"
+    :param convert_processes: HTML conversion processes, one per CPU when None
+    :param llm_concurrency: maximum number of LLM requests in flight
+    :param client: async OpenAI compatible client, defaults to AsyncOpenAI()
+    :param use_cache: reuse schemas of identical pages from llm_extraction_cache
+    """
+    create_token_usage(db)
+    create_dead_letter(db)
+    if use_cache:
+        create_extraction_cache(db)
+    if client is None:
+        from openai import AsyncOpenAI
+
+        client = AsyncOpenAI(max_retries=0)
+    extractor = AsyncExtractor(
+        client,
+        concurrency=llm_concurrency,
+        requests_per_minute=requests_per_minute,
+        tokens_per_minute=tokens_per_minute,
+        cache=ExtractionCache(db) if use_cache else None,
+    )
+    nest_asyncio.apply()
+
+    async def _run() -> Counter:
+        async with open_fetcher(backend, concurrency, load_profile) as pool:
+            with TextConverter(convert_processes) as converter:
+                return await arevisit_pages(
+                    home_type,
+                    area,
+                    db,
+                    pool,
+                    converter,
+                    extractor,
+                    every_hours=every_hours,
+                    batch_size=batch_size,
+                    limit=limit,
+                    use_rules=use_rules,
+                )
+
+    return asyncio.run(_run())
@@ -0,0 +1,312 @@
+import re
+from typing import Any
+
+from fundai.utils import prompt_template
+
+
+def prompt_field_types() -> dict[str, str]:
+    """
+    Fields and SQL types declared in prompt_template, in order
+    :return: mapping of field name to TEXT, INTEGER or BOOLEAN
+    """
+    fields = {}
+    for line in prompt_template.splitlines():
+        match = re.fullmatch(r"\s*(\w+) (TEXT|INTEGER|BOOLEAN),?\s*", line)
+        if match:
+            fields[match.group(1)] = match.group(2)
+    return fields
+
+
+def build_prompt(fields: list[str]) -> str:
+    """
+    prompt_template restricted to the given fields
+    """
+    if set(prompt_field_types()) <= set(fields):
+        return prompt_template
+    lines = []
+    for line in prompt_template.splitlines():
+        match = re.fullmatch(r"\s*(\w+) (TEXT|INTEGER|BOOLEAN),?\s*", line)
+        if match is None or match.group(1) in fields:
+            lines.append(line)
+    return "\n".join(lines)
+
+
+def parse_number(value: Any) -> float | int | None:
+    """
+    Parse numbers as written on funda, e.g. "€ 435.000 k.k.", "92 m²", "€ 155,19 per maand"
+    or "Voor 1906". Returns an int when the number has no decimals.
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    value = str(value).strip()
+    if re.fullmatch(r"-?\d+(\.\d+)?", value):
+        number = float(value)
+    else:
+        match = re.search(r"\d[\d.]*(?:,\d+)?", value)
+        if match is None:
+            return None
+        number = float(match.group().rstrip(".").replace(".", "").replace(",", "."))
+    return int(number) if number.is_integer() else number
+
+
+def parse_int(value: Any) -> int | None:
+    number = parse_number(value)
+    return None if number is None else int(round(number))
+
+
+def parse_bool(value: Any) -> bool | None:
+    if value is None or isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if re.match(r"(ja|true|yes)\b", value):
+        return True
+    if re.match(r"(nee|false|no)\b", value):
+        return False
+    return None
+
+
+# Kenmerken labels that hold a field as is
+_text_labels = {
+    "status": "Status",
+    "acceptance": "Aanvaarding",
+    "type_of_construction": "Soort bouw",
+    "accessibility": "Toegankelijkheid",
+    "located_on": "Gelegen op",
+    "facilities": "Voorzieningen",
+    "insulation": "Isolatie",
+    "heating": "Verwarming",
+    "hot_water": "Warm water",
+    "ownership_status": "Eigendomssituatie",
+    "type_of_parking": "Soort parkeergelegenheid",
+}
+_int_labels = {
+    "asking_price": "Vraagprijs",
+    "asking_price_per_m2": "Vraagprijs per m²",
+    "year_of_construction": "Bouwjaar",
+    "living_area_m2": "Wonen",
+    "volume": "Inhoud",
+    "number_of_rooms": "Aantal kamers",
+    "number_of_bathrooms": "Aantal badkamers",
+    "number_of_floors": "Aantal woonlagen",
+}
+_bool_labels = {
+    "registered_with_chamber_of_commerce": "Inschrijving KvK",
+    "annual_meeting": "Jaarlijkse vergadering",
+    "periodic_contribution": "Periodieke bijdrage",
+    "reserve_fund": "Reservefonds aanwezig",
+    "maintenance_plan": "Onderhoudsplan",
+    "building_insurance": "Opstalverzekering",
+}
+_header_fields = ["address", "postal_code", "city", "neighborhood"]
+# contact details of the agency, which may sit anywhere on the page
+_contact_fields = ["agency_name", "phone_number"]
+_agency_link = re.compile(r"\[([^\]]+)\]\(https?://www\.funda\.nl/makelaars?/[^)]*\)")
+# a Dutch number not preceded by a word character, starting with the + or 0 so the
+# regex engine only tries the positions of those characters
+_phone_number = re.compile(
+    r"[+0](?<![\w+][+0])(?:(?<=\+)31[ -]?(?:\(0\))?|(?<=0))[1-9](?:[ .-]{0,3}\d){8}"
+    r"(?!\d)"
+)
+# lower cased words showing the page holds contact details the rules could not read
+_agency_hints = ("makelaar",)
+_phone_hints = ("telefoon", "bel de makelaar")
+
+# post_process_pages removes newlines, so a value runs into the next label
+# (e.g. "Bestaande bouwBouwjaar"); it ends at such a glued capital, a link or a section
+_value_end = re.compile(r"(?<=[a-z0-9²³)])(?=[A-Z])|###|\s*\[")
+_header = re.compile(
+    r"#\s+(?P<address>[^#\[]+?)\s(?P<postal_code>\d{4}\s?[A-Z]{2})\s"
+    r"(?P<city>[^#\[(]+?)(?:\[(?P<neighborhood>[^\]]+)\]|(?=#))"
+)
+
+
+def label_value(text: str, label: str) -> str | None:
+    """
+    Value following label in a Kenmerken section, None when the label is absent
+    """
+    match = re.search(rf"{re.escape(label)}\s{{3,}}", text)
+    if match is None:
+        return None
+    rest = text[match.end() :]
+    end = _value_end.search(rest)
+    return (rest[: end.start()] if end else rest).strip()
+
+
+def split_sections(page: str) -> dict[str, str] | None:
+    """
+    Split a post processed page in its header, Omschrijving and Kenmerken sections
+    :return: sections, or None when the page has no Kenmerken section
+    """
+    kenmerken = page.find("## Kenmerken")
+    if kenmerken == -1:
+        return None
+    omschrijving = page.find("## Omschrijving")
+    if omschrijving == -1 or omschrijving > kenmerken:
+        omschrijving = kenmerken
+    return {
+        "header": page[:omschrijving],
+        "omschrijving": page[omschrijving:kenmerken],
+        "kenmerken": page[kenmerken:],
+    }
+
+
+def field_section(field: str) -> str:
+    if field in _header_fields:
+        return "header"
+    if field == "description":
+        return "omschrijving"
+    if field in _contact_fields:
+        return "page"
+    return "kenmerken"
+
+
+class Extraction:
+    """
+    Result of extract_fields: the extracted fields, and the fields that still need
+    the LLM together with the part of the page it needs for them
+    """
+
+    def __init__(self, fields: dict[str, Any], unresolved: list[str], page: str):
+        self.fields = fields
+        self.unresolved = unresolved
+        self.page = page
+
+    def llm_input(self) -> str:
+        sections = split_sections(self.page)
+        if sections is None:
+            return self.page
+        needed = {field_section(f) for f in self.unresolved}
+        if not needed <= sections.keys():
+            return self.page
+        return "".join(text for name, text in sections.items() if name in needed)
+
+
+def extract_fields(page: str) -> Extraction:
+    """
+    Rule based extraction of the prompt_template fields from a post processed page.
+    Fields whose label is absent are not on the page and set to None. Fields that
+    are present but could not be parsed are left to the LLM.
+    :param page: output of post_process_pages
+    """
+    field_types = prompt_field_types()
+    sections = split_sections(page)
+    if sections is None:
+        return Extraction({}, list(field_types), page)
+    kenmerken = sections["kenmerken"]
+    fields: dict[str, Any] = {f: None for f in field_types}
+    unresolved = []
+
+    header = _header.search(sections["header"])
+    if header is None:
+        unresolved.extend(_header_fields)
+    else:
+        for field in _header_fields:
+            value = header.group(field)
+            fields[field] = value.strip() if value else None
+
+    description = sections["omschrijving"].replace("## Omschrijving", "", 1)
+    description = description.replace("Lees de volledige omschrijving", "").strip()
+    fields["description"] = description or None
+
+    for field, label in _text_labels.items():
+        fields[field] = label_value(kenmerken, label) or None
+    for field, label in _int_labels.items():
+        value = label_value(kenmerken, label)
+        if value is None:
+            continue
+        fields[field] = parse_int(value)
+        if fields[field] is None:
+            unresolved.append(field)
+    for field, label in _bool_labels.items():
+        value = label_value(kenmerken, label)
+        if value is None:
+            continue
+        fields[field] = parse_bool(value)
+        if fields[field] is None:
+            unresolved.append(field)
+
+    fields["type_of_apartment"] = label_value(
+        kenmerken, "Soort appartement"
+    ) or label_value(kenmerken, "Soort woonhuis")
+    fields["price"] = fields["asking_price"]
+    fields["price_per_m2"] = fields["asking_price_per_m2"]
+    fields["living_area"] = fields["living_area_m2"]
+
+    rooms = label_value(kenmerken, "Aantal kamers")
+    bedrooms = re.search(r"(\d+) slaapkamers?", rooms or "")
+    fields["bedrooms"] = fields["number_of_bedrooms"] = (
+        int(bedrooms.group(1)) if bedrooms else None
+    )
+    fields["bathroom_facilities"] = label_value(
+        kenmerken, "Badkamervoorzieningen"
+    ) or label_value(kenmerken, "Aantal badkamers")
+
+    vve = label_value(kenmerken, "Bijdrage VvE")
+    if vve is not None:
+        fields["vve_contribution"] = parse_number(vve)
+        if fields["vve_contribution"] is None:
+            unresolved.append("vve_contribution")
+
+    energy_label = label_value(kenmerken, "Energielabel")
+    if energy_label:
+        fields["energy_label"] = energy_label.split()[0]
+
+    # e.g. "Vaillant (gas gestookt combiketel uit 2015, eigendom)"
+    boiler = label_value(kenmerken, "Cv-ketel")
+    if boiler:
+        brand, _, details = boiler.partition("(")
+        fields["boiler_brand"] = brand.strip() or None
+        parts = [p.strip() for p in details.rstrip(")").split(",") if p.strip()]
+        if parts and parts[-1].lower() in ("eigendom", "huur", "lease"):
+            fields["boiler_ownership"] = parts.pop()
+        fields["boiler_type"] = ", ".join(parts) or None
+
+    cadastral = re.search(r"### Kadastrale gegevens(.+?)\s{3,}", kenmerken)
+    if cadastral:
+        fields["cadastral_number"] = cadastral.group(1).strip()
+
+    fields["agency_name"], fields["phone_number"] = extract_contact(page, unresolved)
+
+    return Extraction(fields, unresolved, page)
+
+
+def extract_contact(page: str, unresolved: list[str]) -> tuple[str | None, str | None]:
+    """
+    Agency name, from its funda makelaar link, and phone number of a page. A field
+    the page hints at but the rules cannot read is added to unresolved, a field
+    without any hint is not on the page and None.
+    """
+    text = page.lower()
+    agency = _agency_link.search(page)
+    if agency is None and any(hint in text for hint in _agency_hints):
+        unresolved.append("agency_name")
+    phone = _phone_number.search(page)
+    if phone is None and any(hint in text for hint in _phone_hints):
+        unresolved.append("phone_number")
+    return (
+        agency.group(1).strip() if agency else None,
+        phone.group().strip() if phone else None,
+    )
+
+
+class FieldCoverage:
+    """
+    Per field share of pages on which the rules extracted a value
+    """
+
+    def __init__(self) -> None:
+        self.pages = 0
+        self.extracted = {f: 0 for f in prompt_field_types()}
+
+    def update(self, extraction: Extraction):
+        self.pages += 1
+        for field, value in extraction.fields.items():
+            if value is not None and field not in extraction.unresolved:
+                self.extracted[field] = self.extracted.get(field, 0) + 1
+
+    def rates(self) -> dict[str, float]:
+        return {
+            f: n / self.pages if self.pages else 0.0 for f, n in self.extracted.items()
+        }
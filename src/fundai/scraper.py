@@ -1,27 +1,71 @@
-import json
-from typing import Sequence, Any
+import asyncio
+from typing import (
+    Sequence,
+    Any,
+    Awaitable,
+    Callable,
+    Iterable,
+    Iterator,
+    AsyncIterator,
+)
 import nest_asyncio
-from langchain.chains.llm import LLMChain
 from langchain_community.document_loaders import AsyncChromiumLoader
 import logging
 import re
+import time
 
-from langchain_community.document_transformers import Html2TextTransformer
 from langchain_core.documents import Document
-from langchain_core.prompts import PromptTemplate
-from langchain_core.runnables import RunnablePassthrough
-from openai import OpenAI
 from psycopg2.extras import Json
-from psycopg2.extensions import register_adapter
-from fundai.db import DatabaseClient
-from fundai.utils import prompt_template
+from fundai.browser import BrowserPool, ua
+from fundai.cache import ExtractionCache
+from fundai.convert import TextConverter
+from fundai.fetch import Fetcher, PoliteFetcher, open_fetcher
+from fundai.db import (
+    BatchWriter,
+    DatabaseClient,
+    create_dead_letter,
+    create_extraction_cache,
+    create_token_usage,
+    dead_letter_columns,
+    token_usage_columns,
+)
+from fundai.llm import (
+    AsyncExtractor,
+    SchemaAnswers,
+    backoff_delay,
+    dead_letter_row,
+    parse_reset,
+    retry_reason,
+)
+from fundai.metrics import metrics
+from fundai.rules import FieldCoverage, build_prompt, extract_fields
+from fundai.utils import prompt_template, model_name
+from fundai.workqueue import WorkQueue
 
 logger = logging.getLogger(__name__)
 
-ua = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/86.0.4240.183 Safari/537.36"
-
 
 class AsyncChromiumLoaderHeader(AsyncChromiumLoader):
+    def __init__(
+        self,
+        urls: Sequence[str],
+        *,
+        headless: bool = True,
+        pool: Fetcher | None = None,
+        concurrency: int = 4,
+    ):
+        """
+        :param urls: URLs to scrape
+        :param headless: run Chromium headless, only used when no pool is given
+        :param pool: shared browser pool or HybridFetcher, when omitted a browser
+            pool is launched per load
+        :param concurrency: maximum number of pages rendered at the same time,
+            only used when no pool is given
+        """
+        super().__init__(list(urls), headless=headless)
+        self.pool = pool
+        self.concurrency = concurrency
+
     async def ascrape_playwright(self, url: str) -> str:
         """
         Asynchronously scrape the content of a given URL using Playwright's async API.
@@ -30,25 +74,61 @@ class AsyncChromiumLoaderHeader(AsyncChromiumLoader):
             url (str): The URL to scrape.
 
         Returns:
-            str: The scraped HTML content or an error message if an exception occurs.
+            str: The scraped HTML content.
+
+        Raises:
+            PageBlocked: when the site answered with a block or captcha page.
+            Exception: any other error of the fetch, after the retries of the pool.
 
         """
-        from playwright.async_api import async_playwright
+        if self.pool is None:
+            async with BrowserPool(concurrency=1, headless=self.headless) as pool:
+                return await self._scrape_with_pool(PoliteFetcher(pool), url)
+        return await self._scrape_with_pool(self.pool, url)
 
+    @staticmethod
+    async def _scrape_with_pool(pool: Fetcher, url: str) -> str:
         logger.info("Starting scraping...")
-        results = ""
-        async with async_playwright() as p:
-            browser = await p.chromium.launch(headless=True)
-            try:
-                page = await browser.new_page(user_agent=ua)
-                await page.goto(url)
-                results = await page.content()  # Simply get the HTML content
-                logger.info("Content scraped")
-            except Exception as e:
-                results = f"Error: {e}"
-            await browser.close()
+        try:
+            with metrics.timer("fundai_stage_seconds", stage="fetch"):
+                results = await pool.fetch(url)
+        except Exception as e:
+            metrics.inc("fundai_stage_failures_total", stage="fetch")
+            logger.error(f"Scraping {url} failed: {e}")
+            raise
+        metrics.inc("fundai_stage_items_total", stage="fetch")
+        logger.info("Content scraped")
         return results
 
+    async def alazy_load(self) -> AsyncIterator[Document]:
+        """
+        Scrape all URLs through a single browser pool, yielding documents in
+        the order of the URLs. URLs that could not be scraped are left out.
+        """
+        if self.pool is None:
+            async with BrowserPool(
+                concurrency=self.concurrency, headless=self.headless
+            ) as pool:
+                polite = PoliteFetcher(pool)
+                results = await asyncio.gather(
+                    *[self._scrape_with_pool(polite, url) for url in self.urls],
+                    return_exceptions=True,
+                )
+        else:
+            results = await asyncio.gather(
+                *[self._scrape_with_pool(self.pool, url) for url in self.urls],
+                return_exceptions=True,
+            )
+        for url, content in zip(self.urls, results):
+            if not isinstance(content, BaseException):
+                yield Document(page_content=content, metadata={"source": url})
+
+    async def aload(self) -> list[Document]:
+        return [doc async for doc in self.alazy_load()]
+
+    def lazy_load(self) -> Iterator[Document]:
+        yield from asyncio.run(self.aload())
+
 
 def post_process_pages(page: str, url: str) -> str:
     start = page.find("Bewaren")
@@ -93,120 +173,633 @@ def get_links_from_page(page: str, home_type: str, area: str) -> set[str]:
     return {r for r in results if f"{home_type}/{area}" in r and "https" in r}
 
 
-def process_page(urls: Sequence[str]) -> Sequence[Document]:
+async def aprocess_page(
+    urls: Sequence[str],
+    pool: Fetcher,
+    converter: TextConverter | None = None,
+    return_exceptions: bool = False,
+) -> Sequence[Document | BaseException]:
+    """
+    Fetch all URLs with the given fetcher and convert them to text, converting
+    every page as soon as it is fetched
+    :param urls: asynchronously scrapes these URls
+    :param pool: started browser pool or HybridFetcher
+    :param converter: converts the HTML, in the event loop when omitted
+    :param return_exceptions: return the error of a page that failed in its
+        place instead of raising it, as asyncio.gather does
+    :return: sequence of langchain documents for all URLs
+    """
+    converter = converter or TextConverter(0)
+    loader = AsyncChromiumLoaderHeader([], pool=pool)
+
+    async def _process(url: str) -> Document:
+        html = await loader.ascrape_playwright(url)
+        text = await converter.convert(html)
+        return Document(page_content=text, metadata={"source": url})
+
+    return await asyncio.gather(
+        *[_process(url) for url in urls], return_exceptions=return_exceptions
+    )
+
+
+def process_page(
+    urls: Sequence[str],
+    concurrency: int = 4,
+    backend: str = "auto",
+    load_profile: str = "lean",
+    convert_processes: int | None = None,
+) -> Sequence[Document]:
     """
-    Using playwrigth, return the body of all URL in urls and convert to string
+    Return the body of all URL in urls and convert to string
     :param urls: asynchronously scrapes these URls
+    :param concurrency: number of pages fetched at the same time
+    :param backend: "auto" for HTTP with browser fallback, "browser" for Chromium only
+    :param load_profile: how Chromium loads pages, "full", "lean" or "strict"
+    :param convert_processes: HTML conversion processes, one per CPU when None
     :return: sequence of langchain documents for all URLs
     """
     nest_asyncio.apply()
-    # Scrapes the blogs above
-    loader = AsyncChromiumLoaderHeader(urls)
-    docs = loader.load()
 
-    # # Converts HTML to plain text
-    html2text = Html2TextTransformer(ignore_links=False)
-    docs_transformed = html2text.transform_documents(docs)
+    async def _process() -> Sequence[Document]:
+        async with open_fetcher(backend, concurrency, load_profile) as pool:
+            with TextConverter(convert_processes) as converter:
+                return await aprocess_page(urls, pool, converter)
 
-    return docs_transformed
+    return asyncio.run(_process())
 
 
-def get_all_links(home_type: str, area: str) -> set[str]:
+async def astream_pages(
+    urls: Iterable[str],
+    pool: Fetcher,
+    max_in_flight: int = 8,
+    converter: TextConverter | None = None,
+    on_error: Callable[[str, Exception], Awaitable[None]] | None = None,
+) -> AsyncIterator[Document]:
     """
-    Starting on the main search page, this returns the URLs of
-    all houses of every search pages, from one to max_pages
+    Fetch and convert URLs, yielding every document as soon as it is done
+    instead of waiting for the whole set
+    :param urls: URLs to scrape, consumed lazily in a worker thread
+    :param pool: started browser pool or HybridFetcher
+    :param max_in_flight: maximum number of pages scraped or waiting to be consumed
+    :param converter: converts the HTML, in the event loop when omitted
+    :param on_error: awaited with the URL and error of every page that failed,
+        failed pages are skipped
+    :return: documents converted to text, in order of completion, with the backend
+        that served them in metadata["backend"]
+    """
+    converter = converter or TextConverter(0)
+    loader = AsyncChromiumLoaderHeader([], pool=pool)
+    url_iter = iter(urls)
+    pending: dict[asyncio.Task, str] = {}
+
+    async def _scrape(url: str) -> Document:
+        html = await loader.ascrape_playwright(url)
+        backend = pool.pop_backend(url)
+        text = await converter.convert(html)
+        return Document(page_content=text, metadata={"source": url, "backend": backend})
+
+    async def _fill():
+        # pulling from a WorkQueue claims URLs, which must not block the event loop
+        while len(pending) < max_in_flight:
+            url = await asyncio.to_thread(next, url_iter, None)
+            if url is None:
+                return
+            pending[asyncio.ensure_future(_scrape(url))] = url
+
+    await _fill()
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                url = pending.pop(task)
+                if task.exception() is None:
+                    yield task.result()
+                elif on_error is not None:
+                    await on_error(url, task.exception())
+                else:
+                    logger.warning(f"Skipping {url}: {task.exception()}")
+            await _fill()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def ascrape_pages_to_db(
+    urls: Iterable[str],
+    db: DatabaseClient,
+    pool: Fetcher,
+    batch_size: int = 50,
+    max_in_flight: int = 8,
+    converter: TextConverter | None = None,
+) -> int:
+    """
+    Stream scraped pages into raw_page_content, committing every batch_size pages.
+    Batches that were committed are kept when the run is interrupted. Pages that
+    failed are not stored; when urls is a WorkQueue they are deferred, to be
+    claimed again after a backoff.
+    :return: number of pages written
+    """
+
+    async def _defer(url: str, err: Exception):
+        if isinstance(urls, WorkQueue):
+            await asyncio.to_thread(urls.defer, [url])
+
+    with BatchWriter(
+        db,
+        "raw_page_content",
+        ["url", "page_content", "fetch_backend"],
+        batch_size=batch_size,
+        conflict_columns=["url"],
+    ) as writer:
+        async for doc in astream_pages(urls, pool, max_in_flight, converter, _defer):
+            row = (doc.metadata["source"], doc.page_content, doc.metadata["backend"])
+            await asyncio.to_thread(writer.add, row)
+    return writer.written
+
+
+def scrape_pages_to_db(
+    urls: Iterable[str],
+    db: DatabaseClient,
+    concurrency: int = 4,
+    batch_size: int = 50,
+    max_in_flight: int | None = None,
+    backend: str = "auto",
+    load_profile: str = "lean",
+    convert_processes: int | None = None,
+) -> int:
+    """
+    Scrape all URLs with a single fetcher and store them in batches
+    :param urls: URLs to scrape
+    :param db: database client
+    :param concurrency: number of pages fetched at the same time
+    :param batch_size: number of pages per insert
+    :param max_in_flight: pages held in memory at most, defaults to twice the concurrency
+    :param backend: "auto" for HTTP with browser fallback, "browser" for Chromium only
+    :param load_profile: how Chromium loads pages, "full", "lean" or "strict"
+    :param convert_processes: HTML conversion processes, one per CPU when None
+    :return: number of pages written
+    """
+    nest_asyncio.apply()
+
+    async def _scrape() -> int:
+        async with open_fetcher(backend, concurrency, load_profile) as pool:
+            with TextConverter(convert_processes) as converter:
+                return await ascrape_pages_to_db(
+                    urls,
+                    db,
+                    pool,
+                    batch_size,
+                    max_in_flight or 2 * concurrency,
+                    converter,
+                )
+
+    return asyncio.run(_scrape())
+
+
+def search_page_url(
+    home_type: str, area: str, page: int, newest_first: bool = False
+) -> str:
+    url = f"https://www.funda.nl/zoeken/{home_type}?selected_area=%5B%22{area}%22%5D"
+    if newest_first:
+        url += "&sort=%22date_down%22"
+    return f"{url}&search_result={page}"
+
+
+async def aiter_links(
+    home_type: str,
+    area: str,
+    pool: Fetcher,
+    known_urls: set[str] | None = None,
+    stop_after: int | None = None,
+    converter: TextConverter | None = None,
+) -> AsyncIterator[set[str]]:
+    """
+    Starting on the main search page, yield the house URLs of every search page
+    as soon as it is rendered, in the order of the pages for the incremental crawl.
+    When stop_after is given, the results are walked newest first and the crawl
+    stops after stop_after consecutive pages without URLs outside known_urls.
+    Search pages after the first that fail are skipped; in the incremental crawl
+    they count as pages with unknown URLs, so a blocked page does not end it.
     :param home_type: return URLs for this home_type
     :param area: return URLs for this area
+    :param pool: started browser pool or HybridFetcher shared by all search pages
+    :param known_urls: URLs already stored, used by the incremental crawl
+    :param stop_after: consecutive known pages after which to stop, None for a full sweep
+    :param converter: converts the HTML, in the event loop when omitted
+    :return: URLs per search page
+    """
+    incremental = stop_after is not None
+    known_urls = known_urls or set()
+    start_url = search_page_url(home_type, area, 1, newest_first=incremental)
+    first_page = await aprocess_page([start_url], pool, converter)
+    max_pages = get_max_page(first_page[0].page_content)
+    first_links = get_links_from_page(first_page[0].page_content, home_type, area)
+    yield first_links
+    if not incremental:
+        logger.info(
+            f"Finished with main search page, will now scrape {max_pages} remaining search pages"
+        )
+        all_urls = [
+            search_page_url(home_type, area, i) for i in range(2, max_pages + 1)
+        ]
+        async for doc in astream_pages(all_urls, pool, 2 * pool.concurrency, converter):
+            yield get_links_from_page(doc.page_content, home_type, area)
+        logger.info("All search pages have been scraped")
+    else:
+        known_pages = 0 if first_links - known_urls else 1
+        page = 2
+        rendered = 1
+        # render a window of pages at a time, but judge them in order
+        while page <= max_pages and known_pages < stop_after:
+            window = range(page, min(page + pool.concurrency, max_pages + 1))
+            window_urls = [search_page_url(home_type, area, i, True) for i in window]
+            docs = await aprocess_page(
+                window_urls, pool, converter, return_exceptions=True
+            )
+            # the whole window was rendered, also the pages after a stop
+            rendered += sum(not isinstance(doc, BaseException) for doc in docs)
+            for url, doc in zip(window_urls, docs):
+                page += 1
+                if isinstance(doc, BaseException):
+                    logger.error(f"Skipping search page {url}: {doc}")
+                    known_pages = 0
+                    continue
+                links = get_links_from_page(doc.page_content, home_type, area)
+                yield links
+                known_pages = 0 if links - known_urls else known_pages + 1
+                if known_pages >= stop_after:
+                    break
+        logger.info(
+            f"Incremental crawl rendered {rendered} of {max_pages} search pages"
+        )
+
+
+async def aget_all_links(
+    home_type: str,
+    area: str,
+    pool: Fetcher,
+    known_urls: set[str] | None = None,
+    stop_after: int | None = None,
+    converter: TextConverter | None = None,
+) -> set[str]:
+    """
+    Starting on the main search page, this returns the URLs of
+    all houses of every search pages, from one to max_pages.
+    See aiter_links for the parameters.
     :return: URls of all
     """
-    start_url = f"https://www.funda.nl/zoeken/{home_type}?selected_area=%5B%22{area}%22%5D&search_result=1"
-    page = process_page([start_url])
-    max_pages = get_max_page(page[0].page_content)
-    logger.info(
-        f"Finished with main search page, will now scrape {max_pages} remaining search pages"
-    )
-    all_urls = [
-        f"https://www.funda.nl/zoeken/{home_type}?selected_area=%5B%22{area}%22%5D&search_result={i}"
-        for i in range(1, max_pages + 1)
-    ]
-    all_pages = process_page(all_urls)
-    logger.info("All search pages have been scraped")
     fetched_links = set()
-    for p in all_pages:
-        fetched_links = fetched_links.union(
-            get_links_from_page(p.page_content, home_type, area)
-        )
+    async for links in aiter_links(
+        home_type, area, pool, known_urls, stop_after, converter
+    ):
+        fetched_links = fetched_links.union(links)
     logger.info(
         f"{len(fetched_links)} house links have been found on /{home_type}/{area}"
     )
     return fetched_links
 
 
-def obtain_schema_openai(page_content: str, url: str, client) -> dict[str, Any]:
+def get_all_links(
+    home_type: str,
+    area: str,
+    concurrency: int = 4,
+    known_urls: set[str] | None = None,
+    stop_after: int | None = None,
+    backend: str = "auto",
+    load_profile: str = "lean",
+    convert_processes: int | None = None,
+) -> set[str]:
+    """
+    Synchronous wrapper around aget_all_links, opening a single fetcher for the crawl
+    :param home_type: return URLs for this home_type
+    :param area: return URLs for this area
+    :param concurrency: number of search pages fetched at the same time
+    :param known_urls: URLs already stored, used by the incremental crawl
+    :param stop_after: consecutive known pages after which to stop, None for a full sweep
+    :param backend: "auto" for HTTP with browser fallback, "browser" for Chromium only
+    :param load_profile: how Chromium loads pages, "full", "lean" or "strict"
+    :param convert_processes: HTML conversion processes, one per CPU when None
+    :return: URls of all
+    """
+    nest_asyncio.apply()
 
-    completion = client.chat.completions.create(
-        model="gpt-3.5-turbo-1106",
-        messages=[
-            {"role": "system", "content": prompt_template},
-            {"role": "user", "content": page_content},
-        ],
-    )
-    logger.info(f"Tokens used: {completion.usage}")
-    schema_string = completion.choices[0].message.content
-    schema_string = (
-        schema_string.replace("```json", "")
-        .replace("```", "")
-        .replace('"\n ', '",\n ')
-        .replace("\n", "")
-    )
-    try:
-        # fix erroneous JSON format
-        schema = json.loads(schema_string)
-    except Exception as err:
-        print(schema_string[:5])
-        print(schema_string[-5:])
-        print(schema_string)
+    async def _get_all_links() -> set[str]:
+        async with open_fetcher(backend, concurrency, load_profile) as pool:
+            with TextConverter(convert_processes) as converter:
+                return await aget_all_links(
+                    home_type, area, pool, known_urls, stop_after, converter
+                )
 
-        raise err
+    return asyncio.run(_get_all_links())
 
-    logger.info(f"Schema for {url} extracted")
-    return schema
+
+def _create_completion(
+    client, prompt: str, page_content: str, max_retries: int, base_backoff: float
+):
+    attempt = 0
+    while True:
+        try:
+            return client.chat.completions.create(
+                model=model_name,
+                messages=[
+                    {"role": "system", "content": prompt},
+                    {"role": "user", "content": page_content},
+                ],
+            )
+        except Exception as err:
+            reason = retry_reason(err)
+            if reason is None or attempt >= max_retries:
+                raise
+            response = getattr(err, "response", None)
+            retry_after = parse_reset(
+                response.headers.get("retry-after") if response is not None else None
+            )
+            delay = backoff_delay(attempt, base_backoff, retry_after=retry_after)
+            logger.warning(f"LLM request failed ({reason}), retrying in {delay:.2f}s")
+            attempt += 1
+            time.sleep(delay)
 
 
-def obtain_schema_and_push(page: str, url: str, db: DatabaseClient, *args, **kwargs):
+def obtain_schema_openai(
+    page_content: str,
+    url: str,
+    client,
+    prompt: str = prompt_template,
+    max_attempts: int = 3,
+    max_retries: int = 10,
+    base_backoff: float = 1.0,
+) -> dict[str, Any]:
     """
-    Post process page contents, extract data schema using chain and insert into db
+    Extract the data schema of a page, repairing the JSON and coercing the values
+    to the types of prompt_template locally and asking again for the invalid
+    fields only, see SchemaAnswers. Rate limited, failed and unanswered requests
+    are retried with the jittered backoff of AsyncExtractor.
+    :param client: OpenAI compatible client, created with max_retries=0 so its own
+        retries do not add to these
+    :param max_retries: retries of a rate limited or failed request
+    :param base_backoff: seconds the backoff is drawn below on the first retry
+    :raises ExtractionError: when no answer holds a JSON object
     """
-    split_p = post_process_pages(page, url)
-    i = 0
-    while i < 10:
-        try:
-            schema = obtain_schema_openai(split_p, url, *args, **kwargs)
-            i = 11
-        except Exception as err:
-            logger.error(f"Parsing data schema failed, retry number: {i}", err)
-            i += 1
+    answers = SchemaAnswers(url, prompt, max_attempts)
+    while answers.next_prompt is not None:
+        completion = _create_completion(
+            client, answers.next_prompt, page_content, max_retries, base_backoff
+        )
+        logger.info(f"Tokens used: {completion.usage}")
+        if answers.add(completion.choices[0].message.content) == "invalid_json":
+            time.sleep(backoff_delay(answers.attempts - 1, base_backoff))
+    schema = answers.result()
+    logger.info(f"Schema for {url} extracted")
+    return schema
+
+
+def push_schema(schema: dict[str, Any], url: str, db: DatabaseClient):
     insert_query = f"""
          INSERT INTO raw_property_listings (url, raw_data) 
          VALUES ('{url}', %s);
      """
 
-    with db.conn.cursor() as conn:
-        conn.execute(insert_query, [Json(schema)])
+    db.execute(insert_query, [Json(schema)])
     logger.info(f"Schema for {url} pushed successfully")
 
 
-def parse_schema(home_type: str, area: str, db: DatabaseClient):
+def obtain_schema_and_push(
+    page: str, url: str, db: DatabaseClient, *args, max_attempts: int = 3, **kwargs
+) -> bool:
+    """
+    Post process page contents, extract data schema using chain and insert into db.
+    Pages without a valid schema after max_attempts answers, or whose requests
+    failed, go to llm_dead_letter.
+    :return: whether the schema was extracted
+    """
+    split_p = post_process_pages(page, url)
+    try:
+        schema = obtain_schema_openai(
+            split_p, url, *args, max_attempts=max_attempts, **kwargs
+        )
+    except Exception as err:
+        logger.error(f"Extracting data schema for {url} failed: {err}")
+        db.insert_values(
+            [dead_letter_row(url, model_name, err)],
+            "llm_dead_letter",
+            dead_letter_columns,
+        )
+        return False
+    push_schema(schema, url, db)
+    return True
+
+
+async def aextract_schema(
+    split_p: str,
+    url: str,
+    extractor: AsyncExtractor,
+    coverage: FieldCoverage | None = None,
+) -> dict[str, Any]:
+    """
+    Extract the fields of a post processed page with the rules of fundai.rules,
+    only asking the LLM for the fields the rules could not resolve, with just the
+    sections of the page those fields are in
+    """
+    extraction = extract_fields(split_p)
+    if coverage is not None:
+        coverage.update(extraction)
+    if not extraction.unresolved:
+        logger.info(f"Schema for {url} extracted without LLM")
+        return extraction.fields
+    llm_schema = await extractor.extract(
+        extraction.llm_input(), url, prompt=build_prompt(extraction.unresolved)
+    )
+    return {
+        **extraction.fields,
+        **{field: llm_schema.get(field) for field in extraction.unresolved},
+    }
+
+
+async def aobtain_schema_and_push(
+    page: str,
+    url: str,
+    writer: BatchWriter,
+    extractor: AsyncExtractor,
+    coverage: FieldCoverage | None = None,
+    use_rules: bool = True,
+    usage_writer: BatchWriter | None = None,
+    dead_letter_writer: BatchWriter | None = None,
+) -> bool:
+    """
+    Async variant of obtain_schema_and_push using the rate limited extractor,
+    schemas are buffered in writer and inserted in bulk
+    :param usage_writer: buffers the token usage of the page for llm_token_usage
+    :param dead_letter_writer: buffers failed extractions for llm_dead_letter
+    :return: whether the schema was extracted
+    """
+    split_p = post_process_pages(page, url)
+    try:
+        with metrics.timer("fundai_stage_seconds", stage="extract"):
+            if use_rules:
+                schema = await aextract_schema(split_p, url, extractor, coverage)
+            else:
+                schema = await extractor.extract(split_p, url)
+    except Exception as err:
+        logger.error(f"Extracting data schema for {url} failed: {err}")
+        metrics.inc("fundai_stage_failures_total", stage="extract")
+        if dead_letter_writer is not None:
+            row = dead_letter_row(url, extractor.model, err)
+            await asyncio.to_thread(dead_letter_writer.add, row)
+        return False
+    finally:
+        usage = extractor.pop_usage(url)
+        if usage is not None and usage_writer is not None:
+            row = (url, extractor.model, *(usage[c] for c in token_usage_columns[2:]))
+            await asyncio.to_thread(usage_writer.add, row)
+    metrics.inc("fundai_stage_items_total", stage="extract")
+    await asyncio.to_thread(writer.add, (url, Json(schema)))
+    return True
+
+
+async def aparse_schema(
+    pages: Iterable[tuple[str, str]],
+    db: DatabaseClient,
+    extractor: AsyncExtractor,
+    batch_size: int = 100,
+    use_rules: bool = True,
+):
+    """
+    Extract the schemas of all (url, page_content) pairs concurrently and
+    insert them into raw_property_listings in batches of batch_size, together
+    with the tokens spent per page in llm_token_usage and the failed pages in
+    llm_dead_letter.
+    Pages are consumed lazily, at most twice the extractor concurrency is held in memory.
+    They are pulled in a worker thread, so fetching or claiming the next batch from
+    the database does not block the requests in flight.
+    """
+    pages = iter(pages)
+    coverage = FieldCoverage()
+    max_in_flight = 2 * extractor.concurrency
+    pending: set[asyncio.Task] = set()
+    n_pages = n_parsed = 0
+    with BatchWriter(
+        db,
+        "raw_property_listings",
+        ["url", "raw_data"],
+        batch_size=batch_size,
+        conflict_columns=["url"],
+    ) as writer, BatchWriter(
+        db, "llm_token_usage", token_usage_columns, batch_size=batch_size
+    ) as usage_writer, BatchWriter(
+        db, "llm_dead_letter", dead_letter_columns, batch_size=batch_size
+    ) as dead_letter_writer:
+        while True:
+            row = await asyncio.to_thread(next, pages, None)
+            if row is None:
+                break
+            url, page = row
+            n_pages += 1
+            pending.add(
+                asyncio.ensure_future(
+                    aobtain_schema_and_push(
+                        page,
+                        url,
+                        writer,
+                        extractor,
+                        coverage,
+                        use_rules,
+                        usage_writer,
+                        dead_letter_writer,
+                    )
+                )
+            )
+            if len(pending) >= max_in_flight:
+                done, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                pending.difference_update(done)
+                n_parsed += sum(task.result() for task in done)
+        n_parsed += sum(await asyncio.gather(*pending))
+    logger.info(
+        f"Parsed {n_parsed} of {n_pages} pages with {extractor.requests} requests, "
+        f"{extractor.retries} retries and {extractor.tokens_used} tokens"
+    )
+    if extractor.cache is not None:
+        logger.info(f"Extraction cache: {extractor.cache.stats()}")
+    if use_rules:
+        logger.info(f"Rule based field coverage: {coverage.rates()}")
+
+
+def pending_pages(
+    home_type: str, area: str, db: DatabaseClient, itersize: int = 500
+) -> Iterator[tuple[str, str]]:
+    """
+    Stream the (url, page_content) pairs of home_type/area that were scraped but
+    not parsed yet
+    :param itersize: pages fetched from the database per round trip
+    """
     query = f"""
        SELECT 
-           url
-           ,page_content
-       from raw_page_content 
-       WHERE url LIKE '%/{home_type}/{area}/%' AND url NOT in (SELECT url FROM raw_property_listings)
+           c.url
+           ,c.page_content
+       from search_page_urls s
+       JOIN raw_page_content c ON c.url = s.url
+       WHERE s.home_type = '{home_type}' AND s.area = '{area}' AND s.state = 'scraped'
        """
-    pages = db.read(query)
-    logger.info(f"Will try to parse {len(pages)} pages")
-    # Create llm client
-    client = OpenAI()
-    for p in pages:
-        obtain_schema_and_push(p[1], p[0], db, client)
+    return (row for batch in db.iter_batches(query, itersize) for row in batch)
+
+
+def claimed_pages(queue: WorkQueue, db: DatabaseClient) -> Iterator[tuple[str, str]]:
+    """
+    Stream the (url, page_content) pairs of the URLs claimed from queue, a batch
+    is claimed once the previous one was consumed
+    """
+    query = "SELECT url, page_content FROM raw_page_content WHERE url = ANY(%s)"
+    for urls in queue.batches():
+        with db.connection() as conn, conn.cursor() as cur:
+            cur.execute(query, [urls])
+            yield from cur.fetchall()
+
+
+def parse_schema(
+    home_type: str,
+    area: str,
+    db: DatabaseClient,
+    concurrency: int = 8,
+    requests_per_minute: int = 500,
+    tokens_per_minute: int = 200_000,
+    client=None,
+    itersize: int = 500,
+    use_cache: bool = True,
+    use_rules: bool = True,
+    queue: WorkQueue | None = None,
+):
+    """
+    Extract the data schema of every page not parsed yet for home_type/area
+    :param concurrency: maximum number of LLM requests in flight
+    :param requests_per_minute: request budget of the API key
+    :param tokens_per_minute: token budget of the API key
+    :param client: async OpenAI compatible client, defaults to AsyncOpenAI()
+    :param itersize: pages fetched from the database per round trip
+    :param use_cache: reuse schemas of identical pages from llm_extraction_cache
+    :param use_rules: extract fields with fundai.rules, only using the LLM for the rest
+    :param queue: claim the pages from this queue of scraped URLs, so several
+        workers can parse home_type/area at the same time
+    """
+    if queue is not None:
+        pages = claimed_pages(queue, db)
+    else:
+        pages = pending_pages(home_type, area, db, itersize)
+    create_token_usage(db)
+    create_dead_letter(db)
+    if use_cache:
+        create_extraction_cache(db)
+    # Create llm client, retries are handled by the extractor
+    if client is None:
+        from openai import AsyncOpenAI
+
+        client = AsyncOpenAI(max_retries=0)
+    extractor = AsyncExtractor(
+        client,
+        concurrency=concurrency,
+        requests_per_minute=requests_per_minute,
+        tokens_per_minute=tokens_per_minute,
+        cache=ExtractionCache(db) if use_cache else None,
+    )
+    nest_asyncio.apply()
+    asyncio.run(aparse_schema(pages, db, extractor, use_rules=use_rules))
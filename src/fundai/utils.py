@@ -1,3 +1,5 @@
+model_name = "gpt-3.5-turbo-1106"
+
 prompt_template = """
 Instruction: You are used to extract data from text. Only return a correct JSON according the following schema without any comments.
     address TEXT,
@@ -0,0 +1,170 @@
+import logging
+import os
+import socket
+from typing import Iterator
+
+from fundai.db import DatabaseClient
+
+logger = logging.getLogger(__name__)
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    """
+    Postgres backed queue of the search_page_urls of home_type/area in a given
+    state, 'new' to scrape or 'scraped' to parse. Workers claim batches of URLs
+    with SELECT ... FOR UPDATE SKIP LOCKED and hold them under a lease, so
+    processes on any machine sharing the database split the work instead of
+    duplicating it. The triggers of fundai.db.create_work_state release a URL
+    when its state changes; URLs whose lease expired, e.g. because their worker
+    died, are claimed again, at most max_attempts times.
+    """
+
+    def __init__(
+        self,
+        db: DatabaseClient,
+        home_type: str,
+        area: str,
+        state: str,
+        batch_size: int = 50,
+        lease_seconds: float = 600,
+        max_attempts: int = 3,
+        worker_id: str | None = None,
+    ) -> None:
+        self.db = db
+        self.home_type = home_type
+        self.area = area
+        self.state = state
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = worker_id or default_worker_id()
+        self.claimed = 0
+
+    def claim(self) -> list[str]:
+        """
+        Claim the next batch of URLs that are unclaimed or whose lease expired,
+        renewing the lease of the URLs this worker still holds
+        :return: claimed URLs, empty when no work is left
+        """
+        self.renew()
+        query = """
+            UPDATE search_page_urls s
+            SET
+                claimed_by = %(worker)s,
+                lease_until = now() + make_interval(secs => %(lease)s),
+                attempts = s.attempts + 1
+            FROM (
+                SELECT id
+                FROM search_page_urls
+                WHERE home_type = %(home_type)s AND area = %(area)s
+                    AND state = %(state)s
+                    AND (lease_until IS NULL OR lease_until < now())
+                    AND attempts < %(max_attempts)s
+                ORDER BY id
+                LIMIT %(limit)s
+                FOR UPDATE SKIP LOCKED
+            ) c
+            WHERE s.id = c.id
+            RETURNING s.url
+        """
+        params = {
+            "worker": self.worker_id,
+            "lease": self.lease_seconds,
+            "home_type": self.home_type,
+            "area": self.area,
+            "state": self.state,
+            "max_attempts": self.max_attempts,
+            "limit": self.batch_size,
+        }
+        with self.db.connection() as conn, conn.cursor() as cur:
+            cur.execute(query, params)
+            urls = [row[0] for row in cur.fetchall()]
+        self.claimed += len(urls)
+        logger.info(f"{self.worker_id} claimed {len(urls)} {self.state} URLs")
+        return urls
+
+    def renew(self) -> int:
+        """
+        Extend the lease of the URLs this worker holds that are still in state
+        :return: number of URLs renewed
+        """
+        query = """
+            UPDATE search_page_urls
+            SET lease_until = now() + make_interval(secs => %s)
+            WHERE claimed_by = %s AND state = %s AND lease_until >= now()
+        """
+        with self.db.connection() as conn, conn.cursor() as cur:
+            cur.execute(query, [self.lease_seconds, self.worker_id, self.state])
+            return cur.rowcount
+
+    def release(self) -> int:
+        """
+        Give back the URLs this worker claimed but did not finish, without
+        counting the attempt, so other workers can claim them right away.
+        Done when the worker is interrupted, URLs that failed otherwise stay
+        leased until their lease expires.
+        :return: number of URLs released
+        """
+        query = """
+            UPDATE search_page_urls
+            SET
+                claimed_by = NULL,
+                lease_until = NULL,
+                attempts = greatest(attempts - 1, 0)
+            WHERE claimed_by = %s AND state = %s AND lease_until IS NOT NULL
+        """
+        with self.db.connection() as conn, conn.cursor() as cur:
+            cur.execute(query, [self.worker_id, self.state])
+            released = cur.rowcount
+        if released:
+            logger.info(f"{self.worker_id} released {released} {self.state} URLs")
+        return released
+
+    def defer(self, urls: list[str], backoff: float = 60) -> int:
+        """
+        Give back URLs this worker failed on, e.g. because the site blocked them,
+        to be claimed again once a backoff of backoff * 2 ** (attempts - 1)
+        seconds passed. The attempt stays counted, so a URL failing max_attempts
+        times is given up. This worker's later claims skip them until then.
+        :return: number of URLs deferred
+        """
+        query = """
+            UPDATE search_page_urls
+            SET
+                claimed_by = NULL,
+                lease_until = now() + make_interval(
+                    secs => %s * power(2, greatest(attempts - 1, 0))
+                )
+            WHERE url = ANY(%s) AND claimed_by = %s AND state = %s
+        """
+        with self.db.connection() as conn, conn.cursor() as cur:
+            cur.execute(query, [backoff, list(urls), self.worker_id, self.state])
+            deferred = cur.rowcount
+        logger.info(f"{self.worker_id} deferred {deferred} {self.state} URLs")
+        return deferred
+
+    def batches(self) -> Iterator[list[str]]:
+        """
+        Claim batches until no work is left, the next batch is only claimed once
+        the previous one was consumed
+        """
+        while True:
+            urls = self.claim()
+            if not urls:
+                return
+            yield urls
+
+    def __iter__(self) -> Iterator[str]:
+        for urls in self.batches():
+            yield from urls
+
+    def __enter__(self) -> "WorkQueue":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.release()
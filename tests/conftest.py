@@ -0,0 +1,37 @@
+import os
+import uuid
+
+import psycopg2
+import pytest
+
+from fundai.db import DatabaseClient, load_config
+
+
+@pytest.fixture
+def postgres():
+    """
+    DatabaseClient on an empty schema of the server in FUNDAI_TEST_DATABASE_INI
+    (database.ini by default), dropped afterwards. Tests using it are skipped
+    when no server is configured or reachable.
+    """
+    try:
+        config = load_config(os.environ.get("FUNDAI_TEST_DATABASE_INI", "database.ini"))
+    except Exception:
+        pytest.skip("no database configured")
+    schema = f"fundai_test_{uuid.uuid4().hex[:12]}"
+    try:
+        admin = DatabaseClient(config, min_connections=1, max_connections=1)
+    except psycopg2.OperationalError:
+        pytest.skip("database not reachable")
+    admin.execute(f"CREATE SCHEMA {schema}")
+    db = DatabaseClient(
+        {**config, "options": f"-c search_path={schema}"},
+        min_connections=1,
+        max_connections=4,
+    )
+    try:
+        yield db
+    finally:
+        db.close()
+        admin.execute(f"DROP SCHEMA {schema} CASCADE")
+        admin.close()
@@ -0,0 +1,104 @@
+import json
+
+from mock import MagicMock
+
+from fundai.batch import batch_fields_files, export_batch, ingest_batch_output
+
+
+def get_raw_page_content() -> str:
+    with open("./tests/raw_page_content.txt", "r") as f:
+        return f.read()
+
+
+def completion_line(url: str, content: str, status_code: int = 200) -> str:
+    body = {
+        "model": "gpt-3.5-turbo-1106",
+        "choices": [{"message": {"role": "assistant", "content": content}}],
+        "usage": {"prompt_tokens": 900, "completion_tokens": 100, "total_tokens": 1000},
+    }
+    response = {"status_code": status_code, "body": body}
+    return json.dumps({"custom_id": url, "response": response, "error": None})
+
+
+def test_export_batch_chunks_requests(tmp_path):
+    db = MagicMock()
+    pages = [
+        (f"https://www.funda.nl/koop/rotterdam/huis-{i}/", f"Bewaren huis {i}")
+        for i in range(5)
+    ]
+    files = export_batch(pages, str(tmp_path), db, max_requests=2)
+
+    [fields] = batch_fields_files(str(tmp_path))
+    export_id = fields.name.removeprefix("fields-").removesuffix(".jsonl")
+    assert [f.name for f in files] == [
+        f"requests-{export_id}-0001.jsonl",
+        f"requests-{export_id}-0002.jsonl",
+        f"requests-{export_id}-0003.jsonl",
+    ]
+    requests = [json.loads(line) for f in files for line in f.read_text().splitlines()]
+    assert [r["custom_id"] for r in requests] == [url for url, _ in pages]
+    assert requests[0]["url"] == "/v1/chat/completions"
+    assert requests[0]["body"]["messages"][1]["content"] == "Bewaren huis 0"
+    # pages without Kenmerken are sent whole, so no rule fields are kept
+    assert fields.read_text() == ""
+    db.insert_values.assert_not_called()
+
+
+def test_export_batch_keeps_earlier_exports(tmp_path):
+    page = get_raw_page_content().replace("Bouwjaar     1937", "Bouwjaar     onbekend")
+    urls = [f"https://www.funda.nl/koop/rotterdam/huis-{i}/" for i in range(2)]
+    first = export_batch([(urls[0], page)], str(tmp_path), MagicMock())
+    second = export_batch([(urls[1], page)], str(tmp_path), MagicMock())
+
+    assert len(first) == len(second) == 1 and first != second
+    assert all(f.exists() for f in first + second)
+    records = [
+        json.loads(line)
+        for path in batch_fields_files(str(tmp_path))
+        for line in path.read_text().splitlines()
+    ]
+    assert sorted(r["custom_id"] for r in records) == urls
+    assert records[0]["unresolved"] == ["year_of_construction"]
+
+
+def test_export_batch_inserts_pages_resolved_by_rules(tmp_path):
+    db = MagicMock()
+    url = "https://www.funda.nl/koop/rotterdam/appartement-43494363-nobelstraat-37-c/"
+    files = export_batch([(url, get_raw_page_content())], str(tmp_path), db)
+
+    assert files == []
+    [rows, table, columns] = db.insert_values.call_args[0]
+    assert table == "raw_property_listings"
+    assert rows[0][0] == url and rows[0][1].adapted["city"] == "Rotterdam"
+
+
+def test_ingest_batch_output_merges_rule_fields(tmp_path):
+    url = "https://www.funda.nl/koop/rotterdam/huis-1/"
+    fields = {"custom_id": url, "fields": {"city": "Rotterdam", "volume": None}}
+    fields["unresolved"] = ["volume"]
+    (tmp_path / "fields-1.jsonl").write_text(json.dumps(fields) + "\n")
+    results = tmp_path / "output.jsonl"
+    results.write_text(
+        "\n".join(
+            [
+                completion_line(url, '```json\n{"volume": 312, "city": "Delft"}\n```'),
+                completion_line("https://www.funda.nl/koop/rotterdam/huis-2/", "{"),
+                completion_line("https://www.funda.nl/koop/rotterdam/huis-3/", "", 500),
+            ]
+        )
+    )
+    db = MagicMock()
+
+    ingested, failed = ingest_batch_output(
+        [str(results)], db, fields_paths=batch_fields_files(str(tmp_path))
+    )
+
+    assert (ingested, failed) == (1, 2)
+    calls = {call[0][1]: call for call in db.insert_values.call_args_list}
+    listing = calls["raw_property_listings"]
+    assert listing[0][0][0][1].adapted == {"city": "Rotterdam", "volume": 312}
+    assert listing[1]["update"] and listing[1]["conflict_columns"] == ["url"]
+    usage = calls["llm_token_usage"][0][0]
+    assert [row[0] for row in usage][:1] == [url] and len(usage) == 3
+    dead_letter = calls["llm_dead_letter"][0][0]
+    assert [row[2] for row in dead_letter] == ["invalid_json", "request_failed"]
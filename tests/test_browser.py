@@ -0,0 +1,209 @@
+import asyncio
+
+import pytest
+
+from types import SimpleNamespace
+
+from fundai.browser import BrowserPool, LoadProfile, get_load_profile
+from fundai.metrics import metrics
+
+# requests a listing page makes besides the document itself
+subresources = [
+    ("https://assets.fstatic.nl/app.js", "script", 120_000),
+    ("https://cloud.funda.nl/photo-1.jpg", "image", 300_000),
+    ("https://assets.fstatic.nl/font.woff2", "font", 40_000),
+    ("https://www.googletagmanager.com/gtm.js", "script", 90_000),
+]
+
+
+class FakeResponse:
+    """
+    Response sent chunked, without a Content-Length
+    """
+
+    def __init__(self, size: int):
+        self.headers = {"transfer-encoding": "chunked"}
+        self.request = SimpleNamespace(sizes=self.sizes)
+        self.size = size
+
+    async def sizes(self) -> dict[str, int]:
+        await asyncio.sleep(0)
+        return {"responseBodySize": self.size, "responseHeadersSize": 300}
+
+
+class FakeRoute:
+    def __init__(self, url: str, resource_type: str):
+        self.request = SimpleNamespace(url=url, resource_type=resource_type)
+        self.aborted = None
+
+    async def abort(self):
+        self.aborted = True
+
+    async def continue_(self):
+        self.aborted = False
+
+
+class FakePage:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.handlers = {}
+        self.route_handler = None
+
+    async def route(self, pattern: str, handler):
+        self.route_handler = handler
+
+    def on(self, event: str, handler):
+        self.handlers[event] = handler
+
+    async def goto(self, url: str, wait_until: str = "load", timeout: float = 30000):
+        if self.fail:
+            raise TimeoutError("navigation timed out")
+        self.url = url
+        self.wait_until = wait_until
+        requests = [(url, "document", 50_000)] + subresources
+        for request_url, resource_type, size in requests:
+            if self.route_handler is not None:
+                route = FakeRoute(request_url, resource_type)
+                await self.route_handler(route)
+                if route.aborted:
+                    continue
+            self.handlers["response"](FakeResponse(size))
+
+    async def content(self) -> str:
+        return f"<html>{self.url}</html>"
+
+    async def close(self):
+        pass
+
+
+class FakeContext:
+    def __init__(self, browser):
+        self.browser = browser
+        self.closed = False
+
+    async def new_page(self):
+        return FakePage(fail=self.browser.fail_next)
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeBrowser:
+    def __init__(self):
+        self.contexts = []
+        self.connected = True
+        self.fail_next = False
+
+    def is_connected(self) -> bool:
+        return self.connected
+
+    async def new_context(self, user_agent: str):
+        context = FakeContext(self)
+        self.contexts.append(context)
+        return context
+
+    async def close(self):
+        self.connected = False
+
+
+class FakeChromium:
+    def __init__(self):
+        self.browsers = []
+
+    async def launch(self, headless: bool):
+        browser = FakeBrowser()
+        self.browsers.append(browser)
+        return browser
+
+
+class FakePlaywright:
+    def __init__(self):
+        self.chromium = FakeChromium()
+
+    async def stop(self):
+        pass
+
+
+async def start_fake_pool(**kwargs) -> BrowserPool:
+    pool = BrowserPool(**kwargs)
+    pool._semaphore = asyncio.Semaphore(pool.concurrency)
+    pool._launch_lock = asyncio.Lock()
+    pool._playwright = FakePlaywright()
+    await pool._launch()
+    return pool
+
+
+def test_pool_reuses_single_browser():
+    async def run():
+        pool = await start_fake_pool(concurrency=2, max_pages_per_context=100)
+        urls = [f"https://www.funda.nl/{i}" for i in range(20)]
+        pages = await asyncio.gather(*[pool.fetch(u) for u in urls])
+        browsers = pool._playwright.chromium.browsers
+        await pool.close()
+        return pages, browsers
+
+    pages, browsers = asyncio.run(run())
+    assert pages[3] == "<html>https://www.funda.nl/3</html>"
+    assert len(browsers) == 1
+    assert len(browsers[0].contexts) <= 2
+
+
+def test_pool_recycles_used_and_failed_contexts():
+    async def run():
+        pool = await start_fake_pool(concurrency=1, max_pages_per_context=3)
+        for i in range(6):
+            await pool.fetch(f"https://www.funda.nl/{i}")
+        browser = pool._playwright.chromium.browsers[0]
+        browser.fail_next = True
+        with pytest.raises(TimeoutError):
+            await pool.fetch("https://www.funda.nl/broken")
+        browser.fail_next = False
+        browser.connected = False
+        await pool.fetch("https://www.funda.nl/after-crash")
+        return pool
+
+    pool = asyncio.run(run())
+    assert pool.recycled == 3
+    assert pool.launches == 2
+
+
+def test_load_profile_blocks_resource_types_and_domains():
+    lean = get_load_profile("lean")
+    assert lean.blocks("https://cloud.funda.nl/photo-1.jpg", "image")
+    assert lean.blocks("https://www.googletagmanager.com/gtm.js", "script")
+    assert not lean.blocks("https://assets.fstatic.nl/app.js", "script")
+    strict = get_load_profile("strict")
+    assert strict.blocks("https://cdn.example.com/map.js", "script")
+    assert not strict.blocks("https://www.funda.nl/koop/rotterdam/", "document")
+    assert not get_load_profile("full").intercepts
+    with pytest.raises(ValueError):
+        get_load_profile("minimal")
+    with pytest.raises(ValueError):
+        LoadProfile(wait_until="idle")
+
+
+def test_lean_profile_reports_bytes_saved_per_page():
+    async def run(profile: str) -> dict[str, float]:
+        pool = await start_fake_pool(concurrency=2, profile=profile)
+        await asyncio.gather(
+            *[pool.fetch(f"https://www.funda.nl/{i}") for i in range(4)]
+        )
+        await pool.close()
+        return pool.page_stats()
+
+    metrics.reset()
+    full = asyncio.run(run("full"))
+    lean = asyncio.run(run("lean"))
+    assert full["bytes_per_page"] == 600_000
+    assert "bytes_saved_per_page" not in full
+    assert lean["bytes_per_page"] == 170_000
+    assert lean["blocked_per_page"] == 3
+    # the first page is loaded in full as the reference
+    assert lean["pages"] == 3 and lean["reference_pages"] == 1
+    assert lean["bytes_saved_per_page"] == 430_000
+    assert lean["bytes_saved_share"] == pytest.approx(430 / 600)
+    loaded = {
+        series["labels"]["profile"]: series["value"]
+        for series in metrics.to_dict()["counters"]["fundai_browser_bytes_total"]
+    }
+    assert loaded == {"full": 4 * 600_000 + 600_000, "lean": 3 * 170_000}
@@ -0,0 +1,33 @@
+import asyncio
+
+from langchain_community.document_transformers import Html2TextTransformer
+from langchain_core.documents import Document
+
+from fundai.convert import TextConverter, html_to_text
+from fundai.scraper import get_links_from_page
+
+pages = [
+    "<html><body><h1>Nobelstraat 37 C</h1>"
+    "<a href='https://www.funda.nl/koop/rotterdam/appartement-1/'>Bewaren</a>"
+    "<p>Vraagprijs <b>€ 435.000 k.k.</b></p><ul><li>Volgende</li></ul>",
+    "<table><tr><td>Bouwjaar</td><td>1906</td></tr>",
+    "<pre>Kenmerken</pre><div><img src='foto.jpg' alt='foto'>Wonen 92 m²</div>",
+]
+
+
+def test_html_to_text_matches_transformer():
+    transformer = Html2TextTransformer(ignore_links=False)
+    for page in pages:
+        expected = transformer.transform_documents([Document(page_content=page)])
+        assert html_to_text(page) == expected[0].page_content
+
+
+def test_text_converter_processes_match_inline_conversion():
+    async def convert_all(converter: TextConverter) -> list[str]:
+        return await asyncio.gather(*[converter.convert(page) for page in pages])
+
+    with TextConverter(2) as converter:
+        converted = asyncio.run(convert_all(converter))
+    assert converted == [html_to_text(page) for page in pages]
+    links = get_links_from_page(converted[0], "koop", "rotterdam")
+    assert links == {"https://www.funda.nl/koop/rotterdam/appartement-1/"}
@@ -0,0 +1,58 @@
+import pandas as pd
+import pytest
+from mock import MagicMock
+
+from fundai.dashboard.data import DashboardData, listing_filter
+
+
+def test_listing_filter_only_constrains_set_filters():
+    where, params = listing_filter()
+    assert where == "WHERE TRUE" and params == {}
+
+    where, params = listing_filter(
+        city="Rotterdam", neighborhoods=["Kralingen"], max_price=500_000
+    )
+    assert "lower(pl.city) = lower(%(city)s)" in where
+    assert "pl.neighborhood = ANY(%(neighborhoods)s)" in where
+    assert "<= %(max_price)s" in where and "min_price" not in where
+    assert params == {
+        "city": "Rotterdam",
+        "neighborhoods": ["Kralingen"],
+        "max_price": 500_000,
+    }
+
+
+def test_dashboard_data_caches_results_for_ttl():
+    db = MagicMock()
+    db.read_df.return_value = pd.DataFrame({"energy_label": ["A"], "listings": [6]})
+    data = DashboardData(db, ttl=60)
+
+    first = data.energy_label_counts(city="Rotterdam")
+    first.loc[0, "listings"] = 0
+    second = data.energy_label_counts(city="Rotterdam")
+    data.energy_label_counts(city="Delft")
+
+    assert second.loc[0, "listings"] == 6
+    assert db.read_df.call_count == 2
+    assert (data.hits, data.misses) == (1, 2)
+    assert db.read_df.call_args.kwargs["params"] == {"city": "Delft"}
+
+    data.ttl = 0
+    data.clear()
+    data.energy_label_counts(city="Delft")
+    data.energy_label_counts(city="Delft")
+    assert db.read_df.call_count == 4
+
+
+def test_dashboard_data_only_selects_known_columns():
+    db = MagicMock()
+    db.read_df.return_value = pd.DataFrame()
+    data = DashboardData(db)
+
+    data.listings(["address", "asking_price"], limit=10)
+    query = db.read_df.call_args.args[0]
+    assert "SELECT pl.address, pl.asking_price" in query
+    with pytest.raises(ValueError):
+        data.listings(["address; DROP TABLE property_listing"])
+    with pytest.raises(ValueError):
+        data.time_series("fortnight")
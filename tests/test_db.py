@@ -0,0 +1,315 @@
+from datetime import datetime
+
+import psycopg2
+import pytest
+from mock import MagicMock, patch
+from psycopg2.extensions import STATUS_READY
+from psycopg2.extras import Json
+
+from fundai.dashboard.data import listing_filter
+from fundai.db import (
+    CopyRowStream,
+    DatabaseClient,
+    compress_raw_pages,
+    copy_value,
+    create_dead_letter,
+    create_work_state,
+    dead_letter_columns,
+    init_search_urls,
+)
+from fundai.scraper import pending_pages
+
+
+def test_copy_value_escapes_special_characters():
+    assert copy_value(None) == "\\N"
+    assert copy_value("a\tb\nc\\d") == "a\\tb\\nc\\\\d"
+    assert copy_value(Json({"city": "Rotterdam"})) == '{"city": "Rotterdam"}'
+    assert copy_value(True) == "t"
+    assert copy_value(datetime(2024, 5, 1, 12)) == "2024-05-01T12:00:00"
+
+
+def test_copy_row_stream_reads_rows_lazily():
+    rows = ((f"https://www.funda.nl/koop/rotterdam/huis-{i}/", i) for i in range(1000))
+    stream = CopyRowStream(rows)
+    first = stream.read(10)
+    assert len(first) == 10
+    assert stream.n_rows == 1
+    rest = stream.read()
+    lines = (first + rest).splitlines()
+    assert len(lines) == 1000
+    assert lines[-1] == "https://www.funda.nl/koop/rotterdam/huis-999/\t999"
+    assert stream.read(10) == ""
+
+
+class FakeConnection:
+    def __init__(self, closed: int = 0):
+        self.closed = closed
+        self.autocommit = False
+        self.status = STATUS_READY
+
+    def cursor(self):
+        return MagicMock()
+
+
+def test_database_client_replaces_broken_connections():
+    broken, healthy = FakeConnection(closed=2), FakeConnection()
+    with patch("fundai.db.ThreadedConnectionPool") as pool_class:
+        pool = pool_class.return_value
+        pool.getconn.side_effect = [broken, healthy, healthy]
+        db = DatabaseClient({"host": "localhost", "max_connections": "2"})
+
+        with db.connection() as conn:
+            assert conn is healthy and conn.autocommit
+        with db.connection() as conn:
+            assert conn is healthy
+
+    assert pool_class.call_args[0][:2] == (2, 2)
+    assert "max_connections" not in pool_class.call_args[1]
+    assert db.reconnects == 1
+    pool.putconn.assert_any_call(broken, close=True)
+    pool.putconn.assert_called_with(healthy, close=False)
+
+
+def test_iter_batches_and_iter_df_stream_in_chunks(postgres: DatabaseClient):
+    query = "SELECT i, 'page ' || i AS page_content FROM generate_series(1, 25) i"
+
+    batches = list(postgres.iter_batches(query, batch_size=10))
+    assert [len(b) for b in batches] == [10, 10, 5]
+    assert batches[2][-1] == (25, "page 25")
+
+    frames = list(postgres.read_df(query, chunksize=10))
+    assert [len(df) for df in frames] == [10, 10, 5]
+    assert list(frames[0].columns) == ["i", "page_content"]
+    assert list(postgres.iter_df(f"{query} WHERE false")) == []
+    # the cursor's connection went back to the pool in autocommit mode
+    with postgres.connection() as conn:
+        assert conn.autocommit
+
+
+def test_lenient_casts_of_llm_values(postgres: DatabaseClient):
+    init_search_urls(postgres)
+    values = [
+        "'€ 435.000 k.k.'",
+        "'92 m²'",
+        "'1.234,56'",
+        "' -12 '",
+        "'onbekend'",
+        "NULL",
+        "'€ 99.999.999.999'",
+    ]
+    rows = postgres.read(
+        "SELECT fundai_to_numeric(v), fundai_to_int(v) FROM (VALUES "
+        + ", ".join(f"({v})" for v in values)
+        + ") t(v)"
+    )
+    assert [(float(n) if n is not None else None, i) for n, i in rows] == [
+        (435000.0, 435000),
+        (92.0, 92),
+        (1234.56, 1235),
+        (-12.0, -12),
+        (None, None),
+        (None, None),
+        (99999999999.0, None),
+    ]
+    rows = postgres.read(
+        "SELECT v, fundai_to_bool(v) FROM (VALUES ('Ja'), ('nee'), ('true'), "
+        "('F'), ('misschien')) t(v)"
+    )
+    assert [b for _, b in rows] == [True, False, True, False, None]
+
+
+def test_out_of_range_value_does_not_abort_a_copy_batch(postgres: DatabaseClient):
+    init_search_urls(postgres)
+    urls = [f"https://www.funda.nl/koop/rotterdam/huis-{i}/" for i in range(3)]
+    postgres.insert_values(
+        [(datetime(2024, 5, 1), url) for url in urls],
+        "search_page_urls",
+        ["date", "url"],
+    )
+    prices = ["€ 435.000 k.k.", "€ 99.999.999.999", "€ 250.000"]
+    postgres.insert_values(
+        [(url, Json({"price": price})) for url, price in zip(urls, prices)],
+        "raw_property_listings",
+        ["url", "raw_data"],
+    )
+    rows = postgres.read("SELECT url, price FROM property_listing ORDER BY url")
+    assert [price for _, price in rows] == [435000, None, 250000]
+
+
+def test_dashboard_filters_use_the_property_listing_indexes(
+    postgres: DatabaseClient,
+):
+    init_search_urls(postgres)
+    urls = [f"https://www.funda.nl/koop/rotterdam/huis-{i}/" for i in range(50)]
+    postgres.insert_values(
+        [(datetime(2024, 5, 1), url) for url in urls],
+        "search_page_urls",
+        ["date", "url"],
+    )
+    postgres.insert_values(
+        [
+            (url, Json({"city": "Rotterdam", "asking_price": f"€ {i}00.000 k.k."}))
+            for i, url in enumerate(urls)
+        ],
+        "raw_property_listings",
+        ["url", "raw_data"],
+    )
+    where, params = listing_filter(city="rotterdam", max_price=300_000)
+    with postgres.connection() as conn, conn.cursor() as cur:
+        cur.execute("ANALYZE property_listing")
+        cur.execute(f"SELECT count(*) FROM property_listing pl {where}", params)
+        assert cur.fetchone()[0] == 4
+        cur.execute("SET enable_seqscan = off")
+        try:
+            cur.execute(
+                f"EXPLAIN SELECT count(*) FROM property_listing pl {where}", params
+            )
+            plan = "\n".join(row[0] for row in cur.fetchall())
+        finally:
+            cur.execute("RESET enable_seqscan")
+    assert "Seq Scan" not in plan
+    assert (
+        "property_listing_city_lower_idx" in plan
+        or "property_listing_asking_price_or_price_idx" in plan
+    )
+
+
+def test_work_state_follows_scraped_and_parsed_pages(postgres: DatabaseClient):
+    init_search_urls(postgres)
+    urls = [f"https://www.funda.nl/koop/rotterdam/huis-{i}/" for i in range(3)]
+    postgres.insert_values(
+        [(datetime(2024, 5, 1), url) for url in urls],
+        "search_page_urls",
+        ["date", "url"],
+    )
+    postgres.execute(
+        "UPDATE search_page_urls SET claimed_by = 'w1', attempts = 1, "
+        "lease_until = now() + interval '1 hour'"
+    )
+
+    def states() -> list[tuple]:
+        return postgres.read(
+            "SELECT home_type, area, state, claimed_by, attempts "
+            "FROM search_page_urls ORDER BY url"
+        )
+
+    assert states()[0] == ("koop", "rotterdam", "new", "w1", 1)
+    postgres.insert_values(
+        [(url, "page") for url in urls[:2]], "raw_page_content", ["url", "page_content"]
+    )
+    postgres.insert_values(
+        [(urls[0], Json({}))], "raw_property_listings", ["url", "raw_data"]
+    )
+    assert [s[2:] for s in states()] == [
+        ("parsed", None, 0),
+        ("scraped", None, 0),
+        ("new", "w1", 1),
+    ]
+    postgres.execute("DELETE FROM raw_property_listings")
+    assert [s[2] for s in states()] == ["scraped", "scraped", "new"]
+
+
+def test_dead_lettered_pages_leave_the_scraped_state(postgres: DatabaseClient):
+    init_search_urls(postgres)
+    create_dead_letter(postgres)
+    urls = [f"https://www.funda.nl/koop/rotterdam/huis-{i}/" for i in range(2)]
+    postgres.insert_values(
+        [(None, url) for url in urls], "search_page_urls", ["date", "url"]
+    )
+    postgres.insert_values(
+        [(url, "page") for url in urls], "raw_page_content", ["url", "page_content"]
+    )
+    postgres.execute("UPDATE search_page_urls SET claimed_by = 'w1', attempts = 1")
+
+    postgres.insert_values(
+        [(urls[0], "gpt", "invalid_json", "Sorry")],
+        "llm_dead_letter",
+        dead_letter_columns,
+    )
+
+    states = "SELECT state, claimed_by FROM search_page_urls ORDER BY url"
+    assert postgres.read(states) == [("failed", None), ("scraped", "w1")]
+    assert [url for url, _ in pending_pages("koop", "rotterdam", postgres)] == urls[1:]
+    create_work_state(postgres)
+    assert postgres.read(states)[0] == ("failed", None)
+    # a failed page that is parsed after all, e.g. from a batch, is done
+    postgres.insert_values(
+        [(urls[0], Json({}))], "raw_property_listings", ["url", "raw_data"]
+    )
+    assert postgres.read(states)[0] == ("parsed", None)
+
+
+def test_work_state_is_backfilled_on_existing_databases(postgres: DatabaseClient):
+    postgres.execute(
+        "CREATE TABLE search_page_urls "
+        "(id SERIAL PRIMARY KEY, date TIMESTAMP, url VARCHAR(255) UNIQUE)"
+    )
+    postgres.execute(
+        "CREATE TABLE raw_page_content (url VARCHAR(255) UNIQUE, page_content TEXT)"
+    )
+    postgres.execute(
+        "CREATE TABLE raw_property_listings "
+        "(id SERIAL PRIMARY KEY, url VARCHAR(255) UNIQUE, raw_data JSONB)"
+    )
+    urls = [f"https://www.funda.nl/huur/delft/huis-{i}/" for i in range(3)]
+    postgres.insert_values(
+        [(None, url) for url in urls], "search_page_urls", ["date", "url"]
+    )
+    postgres.insert_values(
+        [(url, "page") for url in urls[:2]], "raw_page_content", ["url", "page_content"]
+    )
+    postgres.insert_values(
+        [(urls[0], Json({}))], "raw_property_listings", ["url", "raw_data"]
+    )
+
+    create_work_state(postgres)
+
+    rows = postgres.read(
+        "SELECT home_type, area, state FROM search_page_urls ORDER BY url"
+    )
+    assert rows == [
+        ("huur", "delft", "parsed"),
+        ("huur", "delft", "scraped"),
+        ("huur", "delft", "new"),
+    ]
+
+
+@pytest.mark.parametrize("method", ["pglz", "lz4"])
+def test_compress_raw_pages_recompresses_existing_rows(
+    postgres: DatabaseClient, method: str
+):
+    postgres.execute(
+        "CREATE TABLE raw_page_content (url VARCHAR(255) UNIQUE, page_content TEXT)"
+    )
+    try:
+        postgres.execute(
+            f"ALTER TABLE raw_page_content ALTER COLUMN page_content "
+            f"SET COMPRESSION {method}"
+        )
+    except psycopg2.errors.FeatureNotSupported:
+        pytest.skip(f"server built without {method}")
+    # pages written before the migration, stored uncompressed
+    postgres.execute(
+        "ALTER TABLE raw_page_content ALTER COLUMN page_content SET STORAGE EXTERNAL"
+    )
+    pages = {
+        f"https://www.funda.nl/koop/delft/huis-{i}/": f"Bewaren {i} " * 1000
+        for i in range(5)
+    }
+    pages["https://www.funda.nl/koop/delft/klein/"] = "Bewaren"
+    postgres.insert_values(pages.items(), "raw_page_content", ["url", "page_content"])
+    compression = (
+        "SELECT url, pg_column_compression(page_content) FROM raw_page_content"
+    )
+    assert {c for _, c in postgres.read(compression)} == {None}
+
+    assert compress_raw_pages(postgres, method, batch_size=2) == 5
+
+    compressed = dict(postgres.read(compression))
+    assert compressed.pop("https://www.funda.nl/koop/delft/klein/") is None
+    assert set(compressed.values()) == {method}
+    assert (
+        dict(postgres.read("SELECT url, page_content FROM raw_page_content")) == pages
+    )
+    # rows already compressed with the method are left alone
+    assert compress_raw_pages(postgres, method) == 0
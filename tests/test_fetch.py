@@ -0,0 +1,104 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from fundai.fetch import HttpFetcher, HybridFetcher, has_expected_content
+from fundai.politeness import PageBlocked
+
+
+class MockFundaHandler(BaseHTTPRequestHandler):
+    """
+    Serves a complete listing, a listing without its content (as when funda serves a
+    bot check), a listing failing with a server error and a blocked listing
+    """
+
+    def do_GET(self):
+        if self.path.endswith("huis-3/"):
+            self.send_response(500)
+            self.end_headers()
+            return
+        if self.path.endswith("huis-4/"):
+            self.send_response(403)
+            self.send_header("Retry-After", "120")
+            self.end_headers()
+            return
+        if self.path.endswith("huis-1/"):
+            body = "<html><body><h1>Nobelstraat 37 C</h1><a>Bewaren</a></body></html>"
+        else:
+            body = "<html><body><p>Je bent bijna op de pagina</p></body></html>"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def mock_funda_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockFundaHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+class FakeBrowser:
+    def __init__(self):
+        self.fetched = []
+
+    async def fetch(self, url: str) -> str:
+        self.fetched.append(url)
+        return "<html><body><h1>Rendered</h1><a>Bewaren</a></body></html>"
+
+
+def test_has_expected_content():
+    listing = "https://www.funda.nl/koop/rotterdam/huis-1/"
+    search = "https://www.funda.nl/zoeken/koop?selected_area=%5B%22rotterdam%22%5D"
+    assert has_expected_content(listing, "<a>Bewaren</a>")
+    assert not has_expected_content(listing, "<p>Je bent bijna op de pagina</p>")
+    assert has_expected_content(search, "<ul><li>Volgende</li></ul>")
+    assert not has_expected_content(search, "<a>Bewaren</a>")
+    pager = '<li class="next"><a href="?page=2">\n  <span>Volgende</span></a></li>'
+    assert has_expected_content(search, pager)
+    assert not has_expected_content(search, "<p>Volgende</p>")
+    assert not has_expected_content(listing, '<p title="Bewaren">Elders</p>')
+
+
+def test_hybrid_fetcher_falls_back_to_browser(mock_funda_url: str):
+    browser = FakeBrowser()
+    urls = [f"{mock_funda_url}/koop/rotterdam/huis-{i}/" for i in range(1, 4)]
+
+    async def fetch_all():
+        fetcher = HybridFetcher(HttpFetcher(concurrency=2), browser=browser)
+        pages = await asyncio.gather(*[fetcher.fetch(url) for url in urls])
+        await fetcher.close()
+        return fetcher, pages
+
+    fetcher, pages = asyncio.run(fetch_all())
+    assert "Nobelstraat 37 C" in pages[0]
+    assert "Rendered" in pages[1] and "Rendered" in pages[2]
+    assert sorted(browser.fetched) == urls[1:]
+    assert fetcher.stats == {"http": 1, "browser": 2}
+    assert [fetcher.pop_backend(url) for url in urls] == ["http", "browser", "browser"]
+    assert fetcher.pop_backend(urls[0]) is None
+
+
+def test_hybrid_fetcher_raises_throttled_pages(mock_funda_url: str):
+    browser = FakeBrowser()
+    url = f"{mock_funda_url}/koop/rotterdam/huis-4/"
+
+    async def fetch():
+        fetcher = HybridFetcher(HttpFetcher(), browser=browser)
+        try:
+            return await fetcher.fetch(url)
+        finally:
+            await fetcher.close()
+
+    with pytest.raises(PageBlocked) as err:
+        asyncio.run(fetch())
+    assert err.value.reason == "status_403" and err.value.retry_after == 120
+    assert browser.fetched == []
@@ -0,0 +1,50 @@
+import ast
+import subprocess
+import sys
+
+import fundai
+
+# seconds, importing langchain, openai and pandas takes about two
+import_budget = 1.0
+heavy_modules = ("langchain", "langchain_community", "openai", "pandas", "playwright")
+
+
+def test_cli_import_stays_light():
+    code = (
+        "import sys, fundai.main; "
+        f"print(','.join(m for m in {heavy_modules!r} if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.strip() == ""
+    # last column of -X importtime is the module, the one before its cumulative us
+    cumulative = {
+        line.split("|")[2].strip(): int(line.split("|")[1])
+        for line in result.stderr.splitlines()
+        if line.startswith("import time:") and line.split("|")[1].strip().isdigit()
+    }
+    assert cumulative["fundai.main"] / 1e6 < import_budget
+
+
+def test_all_lists_the_lazily_reexported_names():
+    defined = []
+    for module_name in fundai._reexported:
+        path = f"./src/{module_name.replace('.', '/')}.py"
+        with open(path) as f:
+            for node in ast.parse(f.read()).body:
+                if isinstance(node, ast.Assign):
+                    defined += [t.id for t in node.targets if isinstance(t, ast.Name)]
+                elif isinstance(
+                    node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+                ):
+                    defined.append(node.name)
+    public = [name for name in defined if not name.startswith("_")]
+    assert fundai.__all__ == [name for name in public if name != "logger"]
+    assert set(fundai.__all__) <= set(dir(fundai))
+    from fundai import scraper
+
+    assert fundai.get_max_page is scraper.get_max_page
@@ -0,0 +1,284 @@
+import asyncio
+import json
+import threading
+from types import SimpleNamespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+from mock import MagicMock
+from openai import AsyncOpenAI, RateLimitError
+
+from fundai.llm import AsyncExtractor, ExtractionError, parse_reset
+from fundai.rules import build_prompt
+from fundai.scraper import aparse_schema, obtain_schema_and_push
+
+
+def get_structured_page_content() -> str:
+    with open("./tests/structured_page_content.txt", "r") as f:
+        return f.read()
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    """
+    Minimal OpenAI compatible chat completion endpoint, answering the first
+    request with a 429 and every following request with the fixture schema
+    """
+
+    statuses: list[int] = []
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        json.loads(self.rfile.read(length))
+        if not self.statuses:
+            self.statuses.append(429)
+            body = json.dumps({"error": {"message": "Rate limit reached"}})
+            self.send_response(429)
+            self.send_header("retry-after", "0")
+            self.send_header("x-ratelimit-remaining-requests", "0")
+            self.send_header("x-ratelimit-reset-requests", "20ms")
+        else:
+            self.statuses.append(200)
+            body = json.dumps(
+                {
+                    "id": "chatcmpl-1",
+                    "object": "chat.completion",
+                    "created": 0,
+                    "model": "gpt-3.5-turbo-1106",
+                    "choices": [
+                        {
+                            "index": 0,
+                            "finish_reason": "stop",
+                            "message": {
+                                "role": "assistant",
+                                "content": get_structured_page_content(),
+                            },
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": 900,
+                        "completion_tokens": 500,
+                        "total_tokens": 1400,
+                    },
+                }
+            )
+            self.send_response(200)
+            self.send_header("x-ratelimit-remaining-requests", "499")
+            self.send_header("x-ratelimit-remaining-tokens", "190000")
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def mock_openai_url():
+    MockOpenAIHandler.statuses = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockOpenAIHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/v1"
+    server.shutdown()
+
+
+def test_parse_reset():
+    assert parse_reset("6m0s") == 360
+    assert parse_reset("20ms") == pytest.approx(0.02)
+    assert parse_reset("1.5") == 1.5
+    assert parse_reset(None) == 0
+
+
+def test_extractor_retries_rate_limited_requests(mock_openai_url: str):
+    client = AsyncOpenAI(base_url=mock_openai_url, api_key="test", max_retries=0)
+    extractor = AsyncExtractor(client, concurrency=4, base_backoff=0.01)
+    db = MagicMock()
+    pages = [
+        (f"https://www.funda.nl/koop/rotterdam/appartement-{i}/", "Bewaren ...")
+        for i in range(5)
+    ]
+
+    asyncio.run(aparse_schema(pages, db, extractor, batch_size=2))
+
+    assert MockOpenAIHandler.statuses.count(429) == 1
+    assert extractor.retries == 1
+    assert extractor.tokens_used == 5 * 1400
+    calls = {}
+    for call in db.insert_values.call_args_list:
+        calls.setdefault(call[0][1], []).append(call[0][0])
+    assert len(calls["raw_property_listings"]) == 3
+    inserted = [row for rows in calls["raw_property_listings"] for row in rows]
+    assert sorted(url for url, _ in inserted) == sorted(url for url, _ in pages)
+    usage = [row for rows in calls["llm_token_usage"] for row in rows]
+    assert sum(row[-1] for row in usage) == 5 * 1400
+    assert {row[1] for row in usage} == {"gpt-3.5-turbo-1106"}
+
+
+class DictCache:
+    def __init__(self):
+        self.schemas = {}
+
+    def get(self, page_content: str, prompt: str):
+        return self.schemas.get((page_content, prompt))
+
+    def put(self, page_content: str, schema: dict, prompt: str):
+        self.schemas[(page_content, prompt)] = schema
+
+
+def test_extractor_skips_api_for_cached_pages(mock_openai_url: str):
+    client = AsyncOpenAI(base_url=mock_openai_url, api_key="test", max_retries=0)
+    cache = DictCache()
+    extractor = AsyncExtractor(client, base_backoff=0.01, cache=cache)
+
+    async def extract_twice():
+        first = await extractor.extract("Bewaren Nobelstraat 37 C", "url")
+        second = await extractor.extract("Bewaren Nobelstraat 37 C", "url")
+        return first, second
+
+    first, second = asyncio.run(extract_twice())
+    assert first == second
+    assert first["city"] == "Rotterdam"
+    assert MockOpenAIHandler.statuses == [429, 200]
+
+
+class ScriptedClient:
+    """
+    Async client answering the chat completion requests with the given outputs,
+    recording the prompts
+    """
+
+    def __init__(self, outputs: list[str]):
+        self.outputs = outputs
+        self.prompts = []
+        self.chat = SimpleNamespace(
+            completions=SimpleNamespace(
+                with_raw_response=SimpleNamespace(create=self.create)
+            )
+        )
+
+    async def create(self, model: str, messages: list[dict]):
+        self.prompts.append(messages[0]["content"])
+        completion = SimpleNamespace(
+            choices=[
+                SimpleNamespace(message=SimpleNamespace(content=self.outputs.pop(0)))
+            ],
+            usage=SimpleNamespace(
+                prompt_tokens=90, completion_tokens=10, total_tokens=100
+            ),
+        )
+        return SimpleNamespace(headers={}, parse=lambda: completion)
+
+
+def test_extractor_asks_again_for_invalid_fields_only():
+    client = ScriptedClient(
+        [
+            '```json\n{"city": "Delft", "volume": "onbekend", "maintenance_plan": "Ja"\n```',
+            '{"volume": "312 m³"}',
+        ]
+    )
+    extractor = AsyncExtractor(client, base_backoff=0.01)
+    prompt = build_prompt(["city", "volume", "maintenance_plan"])
+
+    schema = asyncio.run(extractor.extract("Bewaren ...", "url", prompt=prompt))
+
+    assert schema == {"city": "Delft", "volume": 312, "maintenance_plan": True}
+    assert client.prompts == [prompt, build_prompt(["volume"])]
+    assert extractor.pop_usage("url")["total_tokens"] == 200
+
+
+def test_extractor_raises_after_max_attempts():
+    client = ScriptedClient(["Sorry", "Sorry", "Sorry"])
+    extractor = AsyncExtractor(client, base_backoff=0.01)
+
+    with pytest.raises(ExtractionError) as err:
+        asyncio.run(extractor.extract("Bewaren ...", "url"))
+
+    assert err.value.reason == "invalid_json" and err.value.output == "Sorry"
+    assert extractor.retries == 2
+
+
+class SyncScriptedClient:
+    """
+    Client answering the chat completion requests with the given outputs, raising
+    the outputs that are exceptions
+    """
+
+    def __init__(self, outputs: list):
+        self.outputs = outputs
+        self.prompts = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model: str, messages: list[dict]):
+        self.prompts.append(messages[0]["content"])
+        output = self.outputs.pop(0)
+        if isinstance(output, Exception):
+            raise output
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=output))],
+            usage=None,
+        )
+
+
+def test_obtain_schema_and_push_asks_again_for_invalid_fields_only():
+    url = "https://www.funda.nl/koop/rotterdam/huis-1/"
+    answer = json.loads(get_structured_page_content())
+    client = SyncScriptedClient(
+        [json.dumps({**answer, "volume": "onbekend"}), '{"volume": "312 m³"}']
+    )
+    db = MagicMock()
+
+    assert obtain_schema_and_push("Bewaren ...", url, db, client)
+
+    assert client.prompts[1] == build_prompt(["volume"])
+    [schema] = db.execute.call_args[0][1]
+    assert schema.adapted["volume"] == 312
+    assert schema.adapted["city"] == answer["city"]
+    db.insert_values.assert_not_called()
+
+
+def test_obtain_schema_and_push_backs_off_rate_limited_requests(monkeypatch):
+    url = "https://www.funda.nl/koop/rotterdam/huis-1/"
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    rate_limited = RateLimitError(
+        "Rate limit reached",
+        response=httpx.Response(429, headers={"retry-after": "0"}, request=request),
+        body=None,
+    )
+    client = SyncScriptedClient(
+        [rate_limited, rate_limited, "Sorry", get_structured_page_content()]
+    )
+    delays = []
+    monkeypatch.setattr("fundai.scraper.time.sleep", delays.append)
+
+    assert obtain_schema_and_push("Bewaren ...", url, MagicMock(), client)
+
+    assert len(client.prompts) == 4
+    # full jitter below 1, 2 and again 1 second, as in AsyncExtractor
+    assert len(delays) == 3 and len(set(delays)) == 3
+    assert all(0 <= d <= cap for d, cap in zip(delays, [1, 2, 1]))
+
+
+@pytest.mark.parametrize(
+    "outputs, max_attempts, reason",
+    [
+        ([ConnectionError("connection reset")], 3, "request_failed"),
+        (["Sorry", "Sorry"], 2, "invalid_json"),
+        ([], 0, "invalid_json"),
+    ],
+)
+def test_obtain_schema_and_push_dead_letters_failed_pages(
+    outputs: list, max_attempts: int, reason: str
+):
+    url = "https://www.funda.nl/koop/rotterdam/huis-1/"
+    client = SyncScriptedClient(outputs)
+    db = MagicMock()
+
+    assert not obtain_schema_and_push(
+        "Bewaren ...", url, db, client, max_attempts=max_attempts
+    )
+
+    [rows, table, _] = db.insert_values.call_args[0]
+    assert table == "llm_dead_letter"
+    assert rows[0][0] == url and rows[0][2] == reason
+    db.execute.assert_not_called()
@@ -0,0 +1,30 @@
+from fundai.metrics import Histogram, Metrics
+
+
+def test_histogram_quantiles_interpolate_within_buckets():
+    hist = Histogram(buckets=(1.0, 2.0, 4.0))
+    for value in [0.5] * 50 + [1.5] * 45 + [3.0] * 5:
+        hist.observe(value)
+    assert hist.quantile(0.5) == 1.0
+    assert hist.quantile(0.95) == 2.0
+    assert Histogram().quantile(0.5) is None
+
+
+def test_metrics_export_prometheus_and_json():
+    metrics = Metrics()
+    metrics.inc("fundai_stage_items_total", stage="fetch")
+    metrics.inc("fundai_stage_items_total", 2, stage="fetch")
+    with metrics.timer("fundai_stage_seconds", stage="fetch"):
+        pass
+
+    text = metrics.to_prometheus()
+    assert 'fundai_stage_items_total{stage="fetch"} 3' in text
+    assert 'fundai_stage_seconds_bucket{le="0.005",stage="fetch"} 1' in text
+    assert 'fundai_stage_seconds_bucket{le="+Inf",stage="fetch"} 1' in text
+    assert 'fundai_stage_seconds_count{stage="fetch"} 1' in text
+
+    summary = metrics.to_dict()
+    [items] = summary["counters"]["fundai_stage_items_total"]
+    assert items["labels"] == {"stage": "fetch"} and items["value"] == 3
+    [latency] = summary["histograms"]["fundai_stage_seconds"]
+    assert latency["count"] == 1 and latency["p95"] <= 0.005
@@ -0,0 +1,189 @@
+import asyncio
+from collections import Counter
+
+from fundai.db import DatabaseClient, create_dead_letter, init_search_urls
+from fundai.llm import AsyncExtractor
+from fundai.pipeline import _close_after, _drain, arun_pipeline
+from fundai.politeness import PageBlocked
+from fundai.scraper import get_links_from_page
+
+
+def read_fixture(name: str) -> str:
+    with open(f"./tests/{name}", "r") as f:
+        return f.read()
+
+
+search_page = read_fixture("raw_search_page.txt").replace("\\n", "\n")
+listing_page = (
+    "Menu\n" + read_fixture("raw_page_content.txt") + "\n#### Wat is jouw huis waard?\n"
+)
+listing_urls = sorted(get_links_from_page(search_page, "koop", "rotterdam"))
+
+
+class FakeFetcher:
+    """
+    Serves the search page fixture as the first search page, search pages without
+    listings after it and the listing fixture for every listing, counting the
+    pages fetched
+    """
+
+    concurrency = 2
+
+    def __init__(self, failing: set[str] = frozenset()):
+        self.failing = failing
+        self.fetched = 0
+
+    async def fetch(self, url: str) -> str:
+        await asyncio.sleep(0)
+        if url in self.failing:
+            raise PageBlocked(url, "captcha")
+        if "/zoeken/" in url:
+            return search_page if url.endswith("search_result=1") else "Geen huizen"
+        self.fetched += 1
+        return listing_page
+
+    def pop_backend(self, url: str) -> str:
+        return "http"
+
+
+class SlowConverter:
+    """
+    Converter returning pages as they are, slower than the fetcher, that fails on
+    the given listing. Records the most pages fetched and not yet converted.
+    """
+
+    processes = 1
+
+    def __init__(self, fetcher: FakeFetcher, failing: str | None = None):
+        self.fetcher = fetcher
+        self.failing = failing
+        self.converted = 0
+        self.max_waiting = 0
+
+    async def convert(self, html: str) -> str:
+        if html is listing_page:
+            self.max_waiting = max(
+                self.max_waiting, self.fetcher.fetched - self.converted
+            )
+            self.converted += 1
+            await asyncio.sleep(0.005)
+            if self.converted == 3:
+                raise ValueError("broken page")
+        return html
+
+
+class RefusingClient:
+    """
+    LLM client failing every request, the fixture listing is resolved by the rules
+    """
+
+    def __init__(self):
+        self.chat = self
+
+    @property
+    def completions(self):
+        raise AssertionError("the rules resolve the fixture listing")
+
+
+def run_pipeline(db: DatabaseClient, fetcher: FakeFetcher, converter) -> Counter:
+    async def run() -> Counter:
+        return await asyncio.wait_for(
+            arun_pipeline(
+                "koop",
+                "rotterdam",
+                db,
+                fetcher,
+                converter,
+                AsyncExtractor(RefusingClient(), concurrency=1),
+                queue_size=2,
+                batch_size=4,
+            ),
+            timeout=30,
+        )
+
+    return asyncio.run(run())
+
+
+def test_stages_hand_items_through_bounded_queues():
+    first: asyncio.Queue = asyncio.Queue(2)
+    second: asyncio.Queue = asyncio.Queue(2)
+    collected = []
+    depths = []
+
+    async def produce():
+        for i in range(20):
+            await first.put(i)
+            depths.append(first.qsize())
+
+    async def double(i: int):
+        if i == 5:
+            raise ValueError("broken page")
+        await second.put(2 * i)
+
+    async def collect(i: int):
+        await asyncio.sleep(0.001)
+        collected.append(i)
+
+    async def run():
+        await asyncio.gather(
+            _close_after(first, produce()),
+            _close_after(second, _drain(first, double, 3)),
+            _drain(second, collect, 2),
+        )
+
+    asyncio.run(run())
+
+    assert sorted(collected) == [2 * i for i in range(20) if i != 5]
+    assert max(depths) <= 2
+
+
+def test_pipeline_runs_pages_from_crawl_to_extract(postgres: DatabaseClient):
+    init_search_urls(postgres)
+    create_dead_letter(postgres)
+    # a page a previous run scraped but did not parse
+    backlog_url = "https://www.funda.nl/koop/rotterdam/huis-0-vorige-run/"
+    postgres.insert_values([(None, backlog_url)], "search_page_urls", ["date", "url"])
+    postgres.insert_values(
+        [(backlog_url, listing_page)], "raw_page_content", ["url", "page_content"]
+    )
+    fetcher = FakeFetcher(failing={listing_urls[0]})
+    converter = SlowConverter(fetcher)
+
+    counts = run_pipeline(postgres, fetcher, converter)
+
+    n = len(listing_urls)
+    assert counts == {
+        "discovered": n,
+        "fetched": n - 1,
+        "fetch_failed": 1,
+        "scraped": n - 2,
+        "parsed": n - 1,
+    }
+    # fetched pages wait in a queue of 2, one per fetch worker and the one converting
+    assert converter.max_waiting <= 2 + fetcher.concurrency + converter.processes
+    states = dict(postgres.read("SELECT url, state FROM search_page_urls"))
+    assert Counter(states.values()) == {"parsed": n - 1, "new": 2}
+    assert states[backlog_url] == "parsed"
+    assert states[listing_urls[0]] == "new"
+    rows = postgres.read("SELECT raw_data->>'city' FROM raw_property_listings")
+    assert {city for city, in rows} == {"Rotterdam"}
+
+
+def test_pipeline_shuts_down_when_the_crawl_fails(postgres: DatabaseClient):
+    init_search_urls(postgres)
+    create_dead_letter(postgres)
+    backlog_url = "https://www.funda.nl/koop/rotterdam/huis-0-vorige-run/"
+    postgres.insert_values([(None, backlog_url)], "search_page_urls", ["date", "url"])
+    postgres.insert_values(
+        [(backlog_url, listing_page)], "raw_page_content", ["url", "page_content"]
+    )
+    start_url = (
+        "https://www.funda.nl/zoeken/koop?selected_area=%5B%22rotterdam%22%5D"
+        "&sort=%22date_down%22&search_result=1"
+    )
+    fetcher = FakeFetcher(failing={start_url})
+
+    counts = run_pipeline(postgres, fetcher, SlowConverter(fetcher))
+
+    assert counts == {"parsed": 1}
+    assert postgres.read("SELECT state FROM search_page_urls") == [("parsed",)]
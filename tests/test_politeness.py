@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+from fundai.fetch import PoliteFetcher
+from fundai.politeness import AimdScheduler, PageBlocked, detect_block
+
+listing = "https://www.funda.nl/koop/rotterdam/huis-1/"
+page = "<html><body><h1>Nobelstraat 37 C</h1>{}</body></html>".format("x" * 1000)
+bot_check = "<html><body><p>Je bent bijna op de pagina die je zoekt</p>{}</body></html>"
+
+
+def test_detect_block():
+    assert detect_block(page) is None
+    assert detect_block(bot_check.format(" " * 1000)) == "captcha"
+    assert detect_block("<html><body></body></html>") == "empty_page"
+    assert detect_block(f"<h1>Access Denied</h1>{'.' * 1000}") == "blocked"
+    # long pages only count as blocked on the markers of a bot check
+    assert detect_block(f"<p>captcha</p>{'.' * 30_000}") is None
+
+
+def test_scheduler_increases_additively_and_decreases_multiplicatively():
+    scheduler = AimdScheduler(initial=2, max_limit=8, cooldown=0, backoff=10)
+    for _ in range(20):
+        scheduler.record(listing, 0.5)
+    state = scheduler.host(listing)
+    assert 6 < state.limit <= 8
+
+    limit = state.limit
+    scheduler.record(listing, 0.5, PageBlocked(listing, "status_429", retry_after=3))
+    assert state.limit == pytest.approx(limit / 2)
+    assert state.paused_until > 0
+
+    slow = AimdScheduler(initial=4, target_latency=1.0, cooldown=60)
+    slow.record(listing, 10.0)
+    slow.record(listing, 10.0)
+    # the second slow page falls within the cooldown of the first decrease
+    assert slow.limit(listing) == 2
+
+
+def test_scheduler_bounds_pages_in_flight_per_host():
+    scheduler = AimdScheduler(initial=2, max_limit=2)
+    in_flight = {"www.funda.nl": 0, "cloud.funda.nl": 0}
+    peak = dict(in_flight)
+
+    async def fetch(url: str):
+        host = url.split("/")[2]
+        async with scheduler.slot(url):
+            in_flight[host] += 1
+            peak[host] = max(peak[host], in_flight[host])
+            await asyncio.sleep(0.001)
+            in_flight[host] -= 1
+
+    async def run():
+        urls = [f"https://{h}/{i}" for h in in_flight for i in range(10)]
+        await asyncio.gather(*[fetch(url) for url in urls])
+
+    asyncio.run(run())
+    assert peak == {"www.funda.nl": 2, "cloud.funda.nl": 2}
+
+
+class FlakyFetcher:
+    concurrency = 4
+
+    def __init__(self, pages: list[str]):
+        self.pages = pages
+        self.served_by = {}
+
+    async def fetch(self, url: str) -> str:
+        self.served_by[url] = "http"
+        return self.pages.pop(0)
+
+    def pop_backend(self, url: str) -> str | None:
+        return self.served_by.pop(url, None)
+
+
+def test_polite_fetcher_retries_blocked_pages():
+    captcha = bot_check.format(" " * 1000)
+    fetcher = PoliteFetcher(FlakyFetcher([captcha, page]), AimdScheduler(backoff=0.01))
+    assert asyncio.run(fetcher.fetch(listing)) == page
+    assert fetcher.stats == {"blocked": 1, "retried": 1, "fetched": 1}
+    assert fetcher.pop_backend(listing) == "http"
+
+    flaky = FlakyFetcher(["", ""])
+    fetcher = PoliteFetcher(flaky, AimdScheduler(backoff=0.01), max_retries=1)
+    with pytest.raises(PageBlocked) as err:
+        asyncio.run(fetcher.fetch(listing))
+    assert err.value.reason == "empty_page"
+    # blocked pages never reach pop_backend, their backend is not kept
+    assert flaky.served_by == {}
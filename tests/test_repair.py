@@ -0,0 +1,59 @@
+import pytest
+
+from fundai.repair import coerce_schema, prompt_fields, repair_json
+from fundai.rules import build_prompt
+
+
+def get_structured_page_content() -> str:
+    with open("./tests/structured_page_content.txt", "r") as f:
+        return f.read()
+
+
+def test_repair_json_strips_fences_and_prose():
+    output = f"Here is the schema:\n```json\n{get_structured_page_content()}\n```"
+    assert repair_json(output)["city"] == "Rotterdam"
+
+
+def test_repair_json_fixes_common_defects():
+    output = (
+        '{\n "city": "Delft"\n "volume": 312,\n "garden": True,\n "garage": None,\n}'
+    )
+    assert repair_json(output) == {
+        "city": "Delft",
+        "volume": 312,
+        "garden": True,
+        "garage": None,
+    }
+
+
+def test_repair_json_closes_truncated_output():
+    assert repair_json('{"city": "Delft", "volume": 312, "status": "Besch') == {
+        "city": "Delft",
+        "volume": 312,
+    }
+    assert repair_json('{"city": "Delft", "facilities": ["Lift", "Tuin"') == {
+        "city": "Delft",
+        "facilities": ["Lift", "Tuin"],
+    }
+    with pytest.raises(ValueError):
+        repair_json('{"city')
+    with pytest.raises(ValueError):
+        repair_json("I could not find the listing")
+
+
+def test_coerce_schema_to_prompt_types():
+    fields = prompt_fields(build_prompt(["year_of_construction", "volume", "city"]))
+    assert fields == {
+        "city": "TEXT",
+        "year_of_construction": "INTEGER",
+        "volume": "INTEGER",
+    }
+    schema, invalid = coerce_schema(
+        {"year_of_construction": "Voor 1906", "volume": "onbekend", "city": "Delft"},
+        fields,
+    )
+    assert schema == {"city": "Delft", "year_of_construction": 1906, "volume": None}
+    assert invalid == ["volume"]
+    schema, invalid = coerce_schema({"maintenance_plan": "Ja", "price": "null"})
+    assert schema["maintenance_plan"] is True and schema["price"] is None
+    assert invalid == []
@@ -0,0 +1,222 @@
+import asyncio
+from datetime import datetime
+
+from psycopg2.extras import Json
+
+from fundai import revisit
+from fundai.db import DatabaseClient, init_search_urls
+from fundai.llm import AsyncExtractor
+from fundai.revisit import arevisit_pages, claim_due_pages, content_hash
+
+
+def get_raw_page_content() -> str:
+    with open("./tests/raw_page_content.txt", "r") as f:
+        return f.read()
+
+
+def full_page(listing: str) -> str:
+    return f"Menu\n{listing}\n#### Wat is jouw huis waard?\nFooter"
+
+
+def test_content_hash_ignores_page_around_listing():
+    url = "https://www.funda.nl/koop/rotterdam/appartement-43494363-nobelstraat-37-c/"
+    listing = get_raw_page_content()
+    page = f"Menu\n{listing}\n#### Wat is jouw huis waard?\nFooter"
+
+    moved = f"Other menu\n{listing}\n#### Wat is jouw huis waard?\nOther footer"
+    assert content_hash(page, url) == content_hash(moved, url)
+    reduced = page.replace("435.000", "399.000")
+    assert reduced != page
+    assert content_hash(page, url) != content_hash(reduced, url)
+
+
+class FakeFetcher:
+    """
+    Serves the given pages, failing on URLs without a page
+    """
+
+    def __init__(self, pages: dict[str, str]):
+        self.pages = pages
+
+    async def fetch(self, url: str) -> str:
+        if url not in self.pages:
+            raise ConnectionError(f"{url} did not answer")
+        return self.pages[url]
+
+    def pop_backend(self, url: str) -> str:
+        return "http"
+
+
+class FakeConverter:
+    async def convert(self, html: str) -> str:
+        return html
+
+
+class FakeDatabase:
+    """
+    Records the rows written, by table
+    """
+
+    def __init__(self):
+        self.rows: dict[str, list[tuple]] = {}
+
+    def insert_values(self, values, table_name: str, column_names, **kwargs) -> int:
+        values = list(values)
+        self.rows.setdefault(table_name, []).extend(values)
+        return len(values)
+
+
+def test_arevisit_pages_counts_unchanged_changed_and_failed_pages(monkeypatch):
+    page = full_page(get_raw_page_content())
+    reduced = page.replace("Vraagprijs     € 435.000", "Vraagprijs     € 399.000")
+    assert reduced != page
+    url = "https://www.funda.nl/koop/rotterdam/huis-{}/"
+    same_hash, same_page, changed, failed = (url.format(i) for i in range(4))
+    due = [
+        [(same_hash, content_hash(page, same_hash), None), (same_page, None, page)],
+        [(changed, content_hash(page, changed), None), (failed, None, page)],
+    ]
+    claims = []
+
+    def fake_claim(db, home_type, area, every_hours, limit):
+        claims.append(limit)
+        return due.pop(0) if due else []
+
+    monkeypatch.setattr(revisit, "claim_due_pages", fake_claim)
+    fetcher = FakeFetcher({same_hash: page, same_page: page, changed: reduced})
+    db = FakeDatabase()
+
+    counts = asyncio.run(
+        arevisit_pages(
+            "koop",
+            "rotterdam",
+            db,
+            fetcher,
+            FakeConverter(),
+            AsyncExtractor(None),
+            batch_size=2,
+        )
+    )
+
+    assert counts == {"claimed": 4, "unchanged": 2, "changed": 1, "failed": 1}
+    assert claims == [2, 2, 2]
+    # the page without a stored hash gets one, the changed page is stored again
+    pages = {row[0]: row for row in db.rows["raw_page_content"]}
+    assert set(pages) == {same_page, changed}
+    assert pages[same_page][3] == content_hash(page, same_page)
+    assert pages[changed][1] == reduced
+    [(listing_url, schema)] = db.rows["raw_property_listings"]
+    assert listing_url == changed and schema.adapted["asking_price"] == 399000
+
+
+def test_arevisit_pages_stops_at_limit(monkeypatch):
+    claims = []
+
+    def fake_claim(db, home_type, area, every_hours, limit):
+        claims.append(limit)
+        return [
+            (f"https://www.funda.nl/koop/rotterdam/huis-{len(claims)}-{i}/", None, "")
+            for i in range(limit)
+        ]
+
+    monkeypatch.setattr(revisit, "claim_due_pages", fake_claim)
+
+    counts = asyncio.run(
+        arevisit_pages(
+            "koop",
+            "rotterdam",
+            FakeDatabase(),
+            FakeFetcher({}),
+            FakeConverter(),
+            AsyncExtractor(None),
+            batch_size=2,
+            limit=5,
+        )
+    )
+
+    assert claims == [2, 2, 1]
+    assert counts == {"claimed": 5, "failed": 5}
+
+
+def store_listings(db: DatabaseClient, statuses: dict[str, str]):
+    init_search_urls(db)
+    db.insert_values(
+        [(datetime(2024, 5, 1), url) for url in statuses],
+        "search_page_urls",
+        ["date", "url"],
+    )
+    db.insert_values(
+        [(url, "page") for url in statuses], "raw_page_content", ["url", "page_content"]
+    )
+    db.insert_values(
+        [(url, Json({"status": status})) for url, status in statuses.items()],
+        "raw_property_listings",
+        ["url", "raw_data"],
+    )
+
+
+def test_claim_due_pages_skips_final_recent_and_locked_pages(postgres: DatabaseClient):
+    url = "https://www.funda.nl/koop/rotterdam/huis-{}/"
+    statuses = {
+        url.format(0): "Beschikbaar",
+        url.format(1): "Verkocht",
+        url.format(2): "Onder bod",
+        url.format(3): "Beschikbaar",
+        url.format(4): "Beschikbaar",
+        "https://www.funda.nl/huur/delft/huis-5/": "Beschikbaar",
+    }
+    store_listings(postgres, statuses)
+    postgres.execute(
+        "UPDATE raw_page_content SET last_checked_at = now() - interval '2 days' "
+        "WHERE url <> %s",
+        [url.format(3)],
+    )
+
+    with postgres.connection() as conn, conn.cursor() as cur:
+        cur.execute("BEGIN")
+        try:
+            cur.execute(
+                "SELECT 1 FROM raw_page_content WHERE url = %s FOR UPDATE",
+                [url.format(4)],
+            )
+            claimed = claim_due_pages(postgres, "koop", "rotterdam", limit=10)
+        finally:
+            cur.execute("ROLLBACK")
+
+    assert sorted(row[0] for row in claimed) == [url.format(0), url.format(2)]
+    assert claimed[0][1:] == (None, "page")
+    # claiming marks the pages checked, the locked one is due for the next worker
+    claimed = claim_due_pages(postgres, "koop", "rotterdam", limit=10)
+    assert [row[0] for row in claimed] == [url.format(4)]
+    assert claim_due_pages(postgres, "koop", "rotterdam", limit=10) == []
+    assert len(claim_due_pages(postgres, "koop", "rotterdam", every_hours=0)) == 4
+
+
+def test_listing_history_versions_price_and_status_changes(postgres: DatabaseClient):
+    url = "https://www.funda.nl/koop/rotterdam/huis-1/"
+    store_listings(postgres, {url: "Beschikbaar"})
+
+    def upsert(schema: dict):
+        postgres.insert_values(
+            [(url, Json(schema))],
+            "raw_property_listings",
+            ["url", "raw_data"],
+            conflict_columns=["url"],
+            update=True,
+        )
+
+    upsert({"status": "Beschikbaar", "asking_price": "€ 435.000 k.k."})
+    upsert({"status": "Beschikbaar", "asking_price": "435000", "city": "Rotterdam"})
+    upsert({"status": "Beschikbaar", "asking_price": 399000})
+    upsert({"status": "Verkocht", "asking_price": 399000, "price": 405000})
+
+    history = postgres.read(
+        "SELECT version, price, asking_price, status FROM listing_history "
+        "ORDER BY version"
+    )
+    assert history == [
+        (1, None, None, "Beschikbaar"),
+        (2, None, 435000, "Beschikbaar"),
+        (3, None, 399000, "Beschikbaar"),
+        (4, 405000, 399000, "Verkocht"),
+    ]
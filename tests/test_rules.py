@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+from fundai.rules import (
+    FieldCoverage,
+    build_prompt,
+    extract_fields,
+    parse_bool,
+    parse_int,
+    prompt_field_types,
+)
+from fundai.utils import prompt_template
+
+
+@pytest.fixture
+def page() -> str:
+    with open("./tests/raw_page_content.txt", "r") as f:
+        return f.read()
+
+
+@pytest.fixture
+def llm_schema() -> dict:
+    with open("./tests/structured_page_content.txt", "r") as f:
+        return json.load(f)
+
+
+def normalize(field: str, value):
+    kind = prompt_field_types()[field]
+    if kind == "INTEGER":
+        return parse_int(value)
+    if kind == "BOOLEAN":
+        return parse_bool(value)
+    return value
+
+
+# fields the LLM fixture fills from a different Kenmerken label than the rules
+llm_disagreements = {"accessibility", "facilities", "boiler_type", "boiler_ownership"}
+
+
+def test_extract_fields_matches_llm_schema(page: str, llm_schema: dict):
+    extraction = extract_fields(page)
+    assert extraction.unresolved == []
+    assert set(extraction.fields) == set(prompt_field_types())
+    for field, value in extraction.fields.items():
+        if field in llm_disagreements or field == "description":
+            continue
+        assert normalize(field, value) == normalize(field, llm_schema[field]), field
+    assert extraction.fields["vve_contribution"] == 155.19
+    assert extraction.fields["description"].startswith("Ruime en lichte 4-kamerwoning")
+
+
+def test_unstructured_page_is_left_to_llm():
+    page = "Bewaren Nobelstraat 37 C zonder kenmerken"
+    extraction = extract_fields(page)
+    assert extraction.unresolved == list(prompt_field_types())
+    assert extraction.llm_input() == page
+    assert build_prompt(extraction.unresolved) == prompt_template
+
+
+def test_unparsable_values_only_send_their_section(page: str):
+    page = page.replace("Bouwjaar     1937", "Bouwjaar     onbekend")
+    extraction = extract_fields(page)
+    assert extraction.unresolved == ["year_of_construction"]
+    assert extraction.llm_input().startswith("## Kenmerken")
+    prompt = build_prompt(extraction.unresolved)
+    assert "year_of_construction INTEGER" in prompt
+    assert "price INTEGER" not in prompt
+
+
+def test_field_coverage(page: str):
+    coverage = FieldCoverage()
+    coverage.update(extract_fields(page))
+    coverage.update(extract_fields("no structure"))
+    rates = coverage.rates()
+    assert rates["price"] == 0.5
+    assert rates["phone_number"] == 0.0
+
+
+def test_contact_details_are_extracted(page: str):
+    page += (
+        "\n[Makelaardij Zuid](https://www.funda.nl/makelaars/amsterdam/12345-zuid/)"
+        "\nBel 020 - 123 45 67\n"
+    )
+    extraction = extract_fields(page)
+    assert extraction.unresolved == []
+    assert extraction.fields["agency_name"] == "Makelaardij Zuid"
+    assert extraction.fields["phone_number"] == "020 - 123 45 67"
+
+
+def test_unreadable_contact_details_are_left_to_llm(page: str):
+    page += "\nMakelaar: Makelaardij Zuid, toon telefoonnummer\n"
+    extraction = extract_fields(page)
+    assert extraction.unresolved == ["agency_name", "phone_number"]
+    assert extraction.llm_input() == page
+    assert "agency_name TEXT" in build_prompt(extraction.unresolved)
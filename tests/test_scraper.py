@@ -1,6 +1,16 @@
+import asyncio
+import logging
+import threading
+
 import pytest
 from mock import MagicMock
-from fundai.scraper import get_links_from_page, get_max_page
+from fundai.politeness import PageBlocked
+from fundai.scraper import (
+    aget_all_links,
+    astream_pages,
+    get_links_from_page,
+    get_max_page,
+)
 
 
 @pytest.fixture
@@ -40,3 +50,156 @@ def test_get_links_from_pages(search_page: str):
 def test_get_max_page(search_page: str):
     m = get_max_page(search_page)
     assert m == 190
+
+
+class FakePool:
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def fetch(self, url: str) -> str:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.001)
+        self.in_flight -= 1
+        return f"<html><body><h1>{url}</h1></body></html>"
+
+    def pop_backend(self, url: str) -> str:
+        return "browser"
+
+
+def test_astream_pages_bounds_pages_in_flight():
+    urls = [f"https://www.funda.nl/koop/rotterdam/huis-{i}/" for i in range(25)]
+    pool = FakePool()
+
+    async def collect():
+        return [doc async for doc in astream_pages(iter(urls), pool, max_in_flight=4)]
+
+    docs = asyncio.run(collect())
+    assert sorted(d.metadata["source"] for d in docs) == sorted(urls)
+    assert docs[0].page_content.startswith("# https://www.funda.nl/")
+    assert pool.max_in_flight <= 4
+    assert {d.metadata["backend"] for d in docs} == {"browser"}
+
+
+def test_astream_pages_pulls_urls_off_the_event_loop():
+    urls = [f"https://www.funda.nl/koop/rotterdam/huis-{i}/" for i in range(5)]
+    pulled_in = set()
+
+    def claim():
+        # stands in for a WorkQueue claiming URLs in the database
+        for url in urls:
+            pulled_in.add(threading.get_ident())
+            yield url
+
+    async def collect():
+        return [doc async for doc in astream_pages(claim(), FakePool(), 2)]
+
+    docs = asyncio.run(collect())
+    assert len(docs) == 5
+    assert threading.get_ident() not in pulled_in
+
+
+class FakeSearchPool:
+    """
+    Serves search result pages holding three listings each, newest first
+    """
+
+    concurrency = 3
+
+    def __init__(self, n_pages: int):
+        self.n_pages = n_pages
+        self.requested = []
+
+    async def fetch(self, url: str) -> str:
+        page = int(url.rsplit("=", 1)[1])
+        self.requested.append(page)
+        links = "".join(
+            f'<a href="https://www.funda.nl/koop/rotterdam/huis-{page}-{i}/">huis</a>'
+            for i in range(3)
+        )
+        pager = "".join(f"<li>{i}</li>" for i in range(1, self.n_pages + 1))
+        return f"<html><body>{links}<ul><li>Vorige</li>{pager}<li>Volgende</li></ul></body></html>"
+
+    def pop_backend(self, url: str) -> str:
+        return "browser"
+
+
+def test_incremental_crawl_stops_at_known_pages(caplog):
+    caplog.set_level(logging.INFO, logger="fundai.scraper")
+    pool = FakeSearchPool(n_pages=20)
+    known = {
+        f"https://www.funda.nl/koop/rotterdam/huis-{p}-{i}/"
+        for p in range(4, 21)
+        for i in range(3)
+    }
+
+    links = asyncio.run(aget_all_links("koop", "rotterdam", pool, known, stop_after=2))
+
+    assert {
+        f"https://www.funda.nl/koop/rotterdam/huis-{p}-0/" for p in range(1, 4)
+    } <= links
+    assert max(pool.requested) < 10
+    rendered = f"rendered {len(pool.requested)} of 20 search pages"
+    assert rendered in caplog.text
+
+
+def test_full_sweep_renders_every_page():
+    pool = FakeSearchPool(n_pages=6)
+
+    links = asyncio.run(aget_all_links("koop", "rotterdam", pool))
+
+    assert sorted(pool.requested) == [1, 2, 3, 4, 5, 6]
+    assert len(links) == 18
+
+
+class BlockingPool(FakePool):
+    async def fetch(self, url: str) -> str:
+        if url.endswith("huis-3/"):
+            raise PageBlocked(url, "captcha")
+        return await super().fetch(url)
+
+
+def test_astream_pages_skips_failed_pages():
+    urls = [f"https://www.funda.nl/koop/rotterdam/huis-{i}/" for i in range(6)]
+    failed = []
+
+    async def on_error(url: str, err: Exception):
+        failed.append((url, err.reason))
+
+    async def collect():
+        pool = BlockingPool()
+        return [doc async for doc in astream_pages(urls, pool, 4, None, on_error)]
+
+    docs = asyncio.run(collect())
+    assert len(docs) == 5
+    assert failed == [(urls[3], "captcha")]
+
+
+class BlockingSearchPool(FakeSearchPool):
+    def __init__(self, n_pages: int, blocked: set[int]):
+        super().__init__(n_pages)
+        self.blocked = blocked
+
+    async def fetch(self, url: str) -> str:
+        if int(url.rsplit("=", 1)[1]) in self.blocked:
+            raise PageBlocked(url, "status_429")
+        return await super().fetch(url)
+
+
+def test_incremental_crawl_skips_failed_search_pages():
+    pool = BlockingSearchPool(n_pages=20, blocked={4})
+    known = {
+        f"https://www.funda.nl/koop/rotterdam/huis-{p}-{i}/"
+        for p in range(4, 21)
+        for i in range(3)
+    }
+
+    links = asyncio.run(aget_all_links("koop", "rotterdam", pool, known, stop_after=2))
+
+    assert {
+        f"https://www.funda.nl/koop/rotterdam/huis-{p}-0/" for p in range(1, 4)
+    } <= links
+    # the blocked page may hold new URLs, so two known pages after it are needed
+    assert {5, 6} <= set(pool.requested)
+    assert max(pool.requested) < 10
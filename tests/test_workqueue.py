@@ -0,0 +1,51 @@
+import pytest
+from mock import MagicMock
+
+from fundai.workqueue import WorkQueue
+
+
+def fake_db(batches: list[list[str]]) -> tuple[MagicMock, MagicMock]:
+    db = MagicMock()
+    cur = db.connection.return_value.__enter__.return_value.cursor.return_value
+    cur = cur.__enter__.return_value
+    cur.fetchall.side_effect = [[(url,) for url in urls] for urls in batches]
+    return db, cur
+
+
+def claim_params(cur: MagicMock) -> list[dict]:
+    return [c[0][1] for c in cur.execute.call_args_list if "SKIP LOCKED" in c[0][0]]
+
+
+def test_work_queue_claims_batches_until_empty():
+    db, cur = fake_db([["a", "b"], ["c"], []])
+    queue = WorkQueue(db, "koop", "rotterdam", "new", batch_size=2, worker_id="w1")
+
+    assert list(queue) == ["a", "b", "c"]
+    assert queue.claimed == 3
+    params = claim_params(cur)
+    assert len(params) == 3
+    assert params[0]["worker"] == "w1" and params[0]["state"] == "new"
+    assert params[0]["limit"] == 2
+
+
+def test_work_queue_releases_claims_when_interrupted():
+    db, cur = fake_db([["a", "b"]])
+
+    with pytest.raises(KeyboardInterrupt):
+        with WorkQueue(db, "koop", "rotterdam", "scraped", worker_id="w1") as queue:
+            for _ in queue:
+                raise KeyboardInterrupt
+
+    release = cur.execute.call_args_list[-1][0]
+    assert "claimed_by = NULL" in release[0] and release[1] == ["w1", "scraped"]
+
+
+def test_work_queue_defers_failed_urls_with_backoff():
+    db, cur = fake_db([])
+    queue = WorkQueue(db, "koop", "rotterdam", "new", worker_id="w1")
+
+    queue.defer(["a"], backoff=30)
+
+    query, params = cur.execute.call_args[0]
+    assert "power(2" in query and "claimed_by = NULL" in query
+    assert params == [30, ["a"], "w1", "new"]